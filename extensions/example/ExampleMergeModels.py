@@ -1,9 +1,13 @@
+import os
+
 import torch
 import gc
 from collections import OrderedDict
 from typing import TYPE_CHECKING
 from jobs.process import BaseExtensionProcess
-from toolkit.config_modules import ModelConfig
+from toolkit.config_modules import ModelConfig, MergeModelConfig
+from toolkit.merging import CheckpointMerger
+from toolkit.metadata import get_meta_for_safetensors
 from toolkit.stable_diffusion_model import StableDiffusion
 from toolkit.train_tools import get_torch_dtype
 from tqdm import tqdm
@@ -65,6 +69,12 @@ class ExampleMergeModels(BaseExtensionProcess):
         super().run()
         print(f"Running process: {self.__class__.__name__}")
 
+        # safetensors files can be merged a tensor at a time without loading the models
+        if all([os.path.isfile(model.name_or_path) and model.name_or_path.endswith('.safetensors')
+                for model in self.models_to_merge]):
+            self.run_streaming()
+            return
+
         # let's adjust our weights first to normalize them so the total is 1.0
         total_weight = sum([model.weight for model in self.models_to_merge])
         weight_adjust = 1.0 / total_weight
@@ -127,3 +137,18 @@ class ExampleMergeModels(BaseExtensionProcess):
         # do cleanup here
         del output_model
         flush()
+
+    def run_streaming(self):
+        # the merger normalizes the weights itself
+        merger = CheckpointMerger(
+            [MergeModelConfig(path=model.name_or_path, weight=model.weight) for model in self.models_to_merge],
+            method='weighted_sum',
+            device=self.device,
+        )
+        print(f"Saving merged model to {self.save_path}")
+        merger.save(
+            self.save_path,
+            dtype=self.save_dtype,
+            metadata=get_meta_for_safetensors(self.meta, self.job.name)
+        )
+        print(f"Saved merged model to {self.save_path}")
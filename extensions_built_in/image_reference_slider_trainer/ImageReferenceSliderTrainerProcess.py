@@ -7,10 +7,10 @@ from typing import Optional, Union, List
 from torch.utils.data import ConcatDataset, DataLoader
 
 from toolkit.config_modules import ReferenceDatasetConfig
-from toolkit.data_loader import PairedImageDataset
-from toolkit.prompt_utils import concat_prompt_embeds, split_prompt_embeds
+from toolkit.data_loader import PairedImageDataset, get_dataloader
+from toolkit.prompt_utils import concat_prompt_embeds
 from toolkit.stable_diffusion_model import StableDiffusion, PromptEmbeds
-from toolkit.train_tools import get_torch_dtype, apply_snr_weight
+from toolkit.train_tools import get_torch_dtype
 import gc
 from toolkit import train_tools
 import torch
@@ -28,6 +28,12 @@ class ReferenceSliderConfig:
         self.additional_losses: List[str] = kwargs.get('additional_losses', [])
         self.weight_jitter: float = kwargs.get('weight_jitter', 0.0)
         self.datasets: List[ReferenceDatasetConfig] = [ReferenceDatasetConfig(**d) for d in kwargs.get('datasets', [])]
+        # encode every pair once and keep its latents on disk next to the pairs
+        self.cache_latents: bool = kwargs.get('cache_latents', False)
+        # samples per forward pass, positive and negative samples run in the same batch.
+        # None runs everything at once (split in positive and negative passes on sdxl),
+        # 'auto' starts with everything at once and halves it when cuda runs out of memory
+        self.micro_batch_size: Union[int, str, None] = kwargs.get('micro_batch_size', None)
 
 
 class ImageReferenceSliderTrainerProcess(BaseSDTrainProcess):
@@ -42,6 +48,9 @@ class ImageReferenceSliderTrainerProcess(BaseSDTrainProcess):
         self.device = self.get_conf('device', self.job.device)
         self.device_torch = torch.device(self.device)
         self.slider_config = ReferenceSliderConfig(**self.get_conf('slider', {}))
+        self.micro_batch_size: Optional[int] = None
+        if isinstance(self.slider_config.micro_batch_size, int):
+            self.micro_batch_size = self.slider_config.micro_batch_size
 
     def load_datasets(self):
         if self.data_loader is None:
@@ -60,14 +69,16 @@ class ImageReferenceSliderTrainerProcess(BaseSDTrainProcess):
                     'neg_folder': dataset.neg_folder,
                 }
                 image_dataset = PairedImageDataset(config)
+                if self.slider_config.cache_latents:
+                    image_dataset.cache_latents_all_latents(self.sd)
                 datasets.append(image_dataset)
 
             concatenated_dataset = ConcatDataset(datasets)
-            self.data_loader = DataLoader(
+            self.data_loader = get_dataloader(
                 concatenated_dataset,
+                self.dataloader_config,
                 batch_size=self.train_config.batch_size,
                 shuffle=True,
-                num_workers=2
             )
 
     def before_model_load(self):
@@ -80,36 +91,107 @@ class ImageReferenceSliderTrainerProcess(BaseSDTrainProcess):
 
         pass
 
+    def get_micro_batch_size(self, total_batch_size: int) -> int:
+        if self.micro_batch_size is not None:
+            return max(1, min(self.micro_batch_size, total_batch_size))
+        if self.model_config.is_xl and self.slider_config.micro_batch_size != 'auto':
+            # sdxl spikes a ton on back prop, run positive and negative separately
+            return max(1, total_batch_size // 2)
+        return total_batch_size
+
+    def train_micro_batches(
+            self,
+            noisy_latents: torch.Tensor,
+            noise: torch.Tensor,
+            timesteps: torch.Tensor,
+            conditional_embeds: PromptEmbeds,
+            network_multiplier: List[float],
+            micro_batch_size: int,
+    ) -> float:
+        dtype = get_torch_dtype(self.train_config.dtype)
+        noise_scheduler = self.sd.noise_scheduler
+        total_batch_size = noisy_latents.shape[0]
+        loss_float = 0.0
+        for start_idx in range(0, total_batch_size, micro_batch_size):
+            end_idx = min(start_idx + micro_batch_size, total_batch_size)
+            chunk_latents = noisy_latents[start_idx:end_idx]
+            chunk_noise = noise[start_idx:end_idx]
+            chunk_timesteps = timesteps[start_idx:end_idx]
+            chunk_embeds = PromptEmbeds([
+                conditional_embeds.text_embeds[start_idx:end_idx],
+                conditional_embeds.pooled_embeds[start_idx:end_idx]
+                if conditional_embeds.pooled_embeds is not None else None,
+            ])
+            with self.network:
+                assert self.network.is_active
+
+                # one multiplier per sample
+                self.network.multiplier = network_multiplier[start_idx:end_idx]
+
+                noise_pred = self.sd.predict_noise(
+                    latents=chunk_latents.to(self.device_torch, dtype=dtype),
+                    conditional_embeddings=chunk_embeds.to(self.device_torch, dtype=dtype),
+                    timestep=chunk_timesteps,
+                )
+                chunk_noise = chunk_noise.to(self.device_torch, dtype=dtype)
+
+                if self.sd.prediction_type == 'v_prediction':
+                    # v-parameterization training
+                    target = noise_scheduler.get_velocity(chunk_latents, chunk_noise, chunk_timesteps)
+                else:
+                    target = chunk_noise
+
+                loss = torch.nn.functional.mse_loss(noise_pred.float(), target.float(), reduction="none")
+                loss = loss.mean([1, 2, 3])
+
+                # min snr gamma or other timestep weighting
+                loss = self.loss_weighting(loss, chunk_timesteps, noise_scheduler)
+
+                # weight by chunk size so the gradients match one pass over the whole batch
+                loss = loss.mean() * (end_idx - start_idx) / total_batch_size
+                loss_float += loss.item()
+
+                # back propagate loss to free ram
+                loss.backward()
+                del noise_pred, target, loss
+        return loss_float
+
     def hook_train_loop(self, batch):
         with torch.no_grad():
             imgs, prompts, network_weights = batch
-            network_pos_weight, network_neg_weight = network_weights
+            # the dataset returns (neg_weight, pos_weight)
+            network_neg_weight, network_pos_weight = network_weights
+
+            dtype = get_torch_dtype(self.train_config.dtype)
+            batch_size = imgs.shape[0]
 
             if isinstance(network_pos_weight, torch.Tensor):
-                network_pos_weight = network_pos_weight.item()
+                network_pos_weight = network_pos_weight.tolist()
+            else:
+                network_pos_weight = [network_pos_weight] * batch_size
             if isinstance(network_neg_weight, torch.Tensor):
-                network_neg_weight = network_neg_weight.item()
+                network_neg_weight = network_neg_weight.tolist()
+            else:
+                network_neg_weight = [network_neg_weight] * batch_size
 
             # get an array of random floats between -weight_jitter and weight_jitter
             weight_jitter = self.slider_config.weight_jitter
             if weight_jitter > 0.0:
                 jitter_list = random.uniform(-weight_jitter, weight_jitter)
-                network_pos_weight += jitter_list
-                network_neg_weight += (jitter_list * -1.0)
-
-            # if items in network_weight list are tensors, convert them to floats
-
-            dtype = get_torch_dtype(self.train_config.dtype)
-            imgs: torch.Tensor = imgs.to(self.device_torch, dtype=dtype)
-            # split batched images in half so left is negative and right is positive
-            negative_images, positive_images = torch.chunk(imgs, 2, dim=3)
-
-            positive_latents = self.sd.encode_images(positive_images)
-            negative_latents = self.sd.encode_images(negative_images)
-
-            height = positive_images.shape[2]
-            width = positive_images.shape[3]
-            batch_size = positive_images.shape[0]
+                network_pos_weight = [weight + jitter_list for weight in network_pos_weight]
+                network_neg_weight = [weight + (jitter_list * -1.0) for weight in network_neg_weight]
+
+            if self.slider_config.cache_latents:
+                # cached latents are stacked negative first
+                latents = imgs.to(self.device_torch, dtype=dtype)
+                negative_latents, positive_latents = latents[:, 0], latents[:, 1]
+            else:
+                imgs: torch.Tensor = imgs.to(self.device_torch, dtype=dtype)
+                # split batched images in half so left is negative and right is positive
+                negative_images, positive_images = torch.chunk(imgs, 2, dim=3)
+                # both halves in one vae call
+                latents = self.sd.encode_images(torch.cat([positive_images, negative_images], dim=0))
+                positive_latents, negative_latents = torch.chunk(latents, 2, dim=0)
 
             if self.train_config.gradient_checkpointing:
                 # may get disabled elsewhere
@@ -126,99 +208,57 @@ class ImageReferenceSliderTrainerProcess(BaseSDTrainProcess):
             timesteps = torch.randint(0, self.train_config.max_denoising_steps, (1,), device=self.device_torch)
             timesteps = timesteps.long()
 
-            # get noise
+            # get noise, the same noise for both halves
             noise_positive = self.sd.get_latent_noise(
-                pixel_height=height,
-                pixel_width=width,
+                height=positive_latents.shape[2],
+                width=positive_latents.shape[3],
                 batch_size=batch_size,
                 noise_offset=self.train_config.noise_offset,
             ).to(self.device_torch, dtype=dtype)
 
-            noise_negative = noise_positive.clone()
+            noise = torch.cat([noise_positive, noise_positive], dim=0)
+            latents = torch.cat([positive_latents, negative_latents], dim=0)
+            timesteps = torch.cat([timesteps] * latents.shape[0], dim=0)
 
             # Add noise to the latents according to the noise magnitude at each timestep
             # (this is the forward diffusion process)
-            noisy_positive_latents = noise_scheduler.add_noise(positive_latents, noise_positive, timesteps)
-            noisy_negative_latents = noise_scheduler.add_noise(negative_latents, noise_negative, timesteps)
+            noisy_latents = noise_scheduler.add_noise(latents, noise, timesteps)
 
-            noisy_latents = torch.cat([noisy_positive_latents, noisy_negative_latents], dim=0)
-            noise = torch.cat([noise_positive, noise_negative], dim=0)
-            timesteps = torch.cat([timesteps, timesteps], dim=0)
-            network_multiplier = [network_pos_weight * 1.0, network_neg_weight * -1.0]
+            # positive samples first, matching the latents
+            network_multiplier = [weight * 1.0 for weight in network_pos_weight] + \
+                                 [weight * -1.0 for weight in network_neg_weight]
 
         flush()
 
-        loss_float = None
-        loss_mirror_float = None
-
         self.optimizer.zero_grad()
         noisy_latents.requires_grad = False
 
         # if training text encoder enable grads, else do context of no grad
         with torch.set_grad_enabled(self.train_config.train_text_encoder):
-            # text encoding
-            embedding_list = []
-            # embed the prompts
-            for prompt in prompts:
-                embedding = self.sd.encode_prompt(prompt).to(self.device_torch, dtype=dtype)
-                embedding_list.append(embedding)
-            conditional_embeds = concat_prompt_embeds(embedding_list)
+            # embed all the prompts at once
+            conditional_embeds = self.sd.encode_prompt(list(prompts)).to(self.device_torch, dtype=dtype)
             conditional_embeds = concat_prompt_embeds([conditional_embeds, conditional_embeds])
 
-        if self.model_config.is_xl:
-            # todo also allow for setting this for low ram in general, but sdxl spikes a ton on back prop
-            network_multiplier_list = network_multiplier
-            noisy_latent_list = torch.chunk(noisy_latents, 2, dim=0)
-            noise_list = torch.chunk(noise, 2, dim=0)
-            timesteps_list = torch.chunk(timesteps, 2, dim=0)
-            conditional_embeds_list = split_prompt_embeds(conditional_embeds)
-        else:
-            network_multiplier_list = [network_multiplier]
-            noisy_latent_list = [noisy_latents]
-            noise_list = [noise]
-            timesteps_list = [timesteps]
-            conditional_embeds_list = [conditional_embeds]
-
-        losses = []
-        # allow to chunk it out to save vram
-        for network_multiplier, noisy_latents, noise, timesteps, conditional_embeds in zip(
-                network_multiplier_list, noisy_latent_list, noise_list, timesteps_list, conditional_embeds_list
-        ):
-            with self.network:
-                assert self.network.is_active
-
-                self.network.multiplier = network_multiplier
-
-                noise_pred = self.sd.predict_noise(
-                    latents=noisy_latents.to(self.device_torch, dtype=dtype),
-                    conditional_embeddings=conditional_embeds.to(self.device_torch, dtype=dtype),
-                    timestep=timesteps,
+        total_batch_size = noisy_latents.shape[0]
+        while True:
+            micro_batch_size = self.get_micro_batch_size(total_batch_size)
+            out_of_memory = False
+            try:
+                loss_float = self.train_micro_batches(
+                    noisy_latents, noise, timesteps, conditional_embeds, network_multiplier, micro_batch_size
                 )
-                noise = noise.to(self.device_torch, dtype=dtype)
-
-                if self.sd.prediction_type == 'v_prediction':
-                    # v-parameterization training
-                    target = noise_scheduler.get_velocity(noisy_latents, noise, timesteps)
-                else:
-                    target = noise
-
-                loss = torch.nn.functional.mse_loss(noise_pred.float(), target.float(), reduction="none")
-                loss = loss.mean([1, 2, 3])
-
-                # todo add snr gamma here
-                if self.train_config.min_snr_gamma is not None and self.train_config.min_snr_gamma > 0.000001:
-                    # add min_snr_gamma
-                    loss = apply_snr_weight(loss, timesteps, noise_scheduler, self.train_config.min_snr_gamma)
-
-                loss = loss.mean()
-                loss_slide_float = loss.item()
-
-                loss_float = loss.item()
-                losses.append(loss_float)
-
-                # back propagate loss to free ram
-                loss.backward()
-                flush()
+            except torch.cuda.OutOfMemoryError:
+                if self.slider_config.micro_batch_size != 'auto' or micro_batch_size == 1:
+                    raise
+                out_of_memory = True
+            if not out_of_memory:
+                break
+            # drop the partial gradients and run the whole step again with smaller micro batches
+            self.optimizer.zero_grad()
+            flush()
+            self.micro_batch_size = micro_batch_size // 2
+            print(f"Out of memory with micro batch size {micro_batch_size}, trying {self.micro_batch_size}")
+        flush()
 
         # apply gradients
         optimizer.step()
@@ -228,7 +268,7 @@ class ImageReferenceSliderTrainerProcess(BaseSDTrainProcess):
         self.network.multiplier = 1.0
 
         loss_dict = OrderedDict(
-            {'loss': sum(losses) / len(losses) if len(losses) > 0 else 0.0}
+            {'loss': loss_float}
         )
 
         return loss_dict
@@ -1,8 +1,7 @@
 from collections import OrderedDict
 from torch.utils.data import DataLoader
-from toolkit.prompt_utils import concat_prompt_embeds, split_prompt_embeds
 from toolkit.stable_diffusion_model import StableDiffusion, BlankNetwork
-from toolkit.train_tools import get_torch_dtype, apply_snr_weight
+from toolkit.train_tools import get_torch_dtype
 import gc
 import torch
 from jobs.process import BaseSDTrainProcess
@@ -23,14 +22,15 @@ class SDTrainer(BaseSDTrainProcess):
 
     def hook_before_train_loop(self):
         self.sd.vae.eval()
-        self.sd.vae.to(self.device_torch)
+        if not self.is_latents_cached:
+            self.sd.vae.to(self.device_torch)
 
         # textual inversion
         if self.embedding is not None:
-            # keep original embeddings as reference
-            self.orig_embeds_params = self.sd.text_encoder.get_input_embeddings().weight.data.clone()
+            # only the embedding vectors train, the token tables stay frozen
             # set text encoder to train. Not sure if this is necessary but diffusers example did it
-            self.sd.text_encoder.train()
+            for text_encoder in self.embedding.text_encoders:
+                text_encoder.train()
 
     def hook_train_loop(self, batch):
         dtype = get_torch_dtype(self.train_config.dtype)
@@ -56,12 +56,9 @@ class SDTrainer(BaseSDTrainProcess):
         # activate network if it exits
         with network:
             with torch.set_grad_enabled(grad_on_text_encoder):
-                embedding_list = []
-                # embed the prompts
-                for prompt in conditioned_prompts:
-                    embedding = self.sd.encode_prompt(prompt).to(self.device_torch, dtype=dtype)
-                    embedding_list.append(embedding)
-                conditional_embeds = concat_prompt_embeds(embedding_list)
+                # embed all the prompts in one pass. Duplicates are only encoded once
+                # and embeddings are cached when the text encoder is frozen
+                conditional_embeds = self.sd.encode_prompt(conditioned_prompts).to(self.device_torch, dtype=dtype)
 
             noise_pred = self.sd.predict_noise(
                 latents=noisy_latents.to(self.device_torch, dtype=dtype),
@@ -81,9 +78,8 @@ class SDTrainer(BaseSDTrainProcess):
         loss = torch.nn.functional.mse_loss(noise_pred.float(), target.float(), reduction="none")
         loss = loss.mean([1, 2, 3])
 
-        if self.train_config.min_snr_gamma is not None and self.train_config.min_snr_gamma > 0.000001:
-            # add min_snr_gamma
-            loss = apply_snr_weight(loss, timesteps, self.sd.noise_scheduler, self.train_config.min_snr_gamma)
+        # min snr gamma or other timestep weighting
+        loss = self.loss_weighting(loss, timesteps, self.sd.noise_scheduler)
 
         loss = loss.mean()
 
@@ -96,16 +92,6 @@ class SDTrainer(BaseSDTrainProcess):
         self.optimizer.zero_grad()
         self.lr_scheduler.step()
 
-        if self.embedding is not None:
-            # Let's make sure we don't update any embedding weights besides the newly added token
-            index_no_updates = torch.ones((len(self.sd.tokenizer),), dtype=torch.bool)
-            index_no_updates[
-            min(self.embedding.placeholder_token_ids): max(self.embedding.placeholder_token_ids) + 1] = False
-            with torch.no_grad():
-                self.sd.text_encoder.get_input_embeddings().weight[
-                    index_no_updates
-                ] = self.orig_embeds_params[index_no_updates]
-
         loss_dict = OrderedDict(
             {'loss': loss.item()}
         )
@@ -7,10 +7,10 @@ from typing import Optional, Union, List
 from torch.utils.data import ConcatDataset, DataLoader
 
 from toolkit.config_modules import ReferenceDatasetConfig
-from toolkit.data_loader import PairedImageDataset
+from toolkit.data_loader import PairedImageDataset, get_dataloader
 from toolkit.prompt_utils import concat_prompt_embeds, split_prompt_embeds, build_latent_image_batch_for_prompt_pair
 from toolkit.stable_diffusion_model import StableDiffusion, PromptEmbeds
-from toolkit.train_tools import get_torch_dtype, apply_snr_weight
+from toolkit.train_tools import get_torch_dtype
 import gc
 from toolkit import train_tools
 import torch
@@ -22,14 +22,12 @@ from collections import OrderedDict
 from tqdm import tqdm
 
 from toolkit.config_modules import SliderConfig
-from toolkit.train_tools import get_torch_dtype, apply_snr_weight
+from toolkit.train_tools import get_torch_dtype
 import gc
 from toolkit import train_tools
 from toolkit.prompt_utils import \
-    EncodedPromptPair, ACTION_TYPES_SLIDER, \
-    EncodedAnchor, concat_prompt_pairs, \
-    concat_anchors, PromptEmbedsCache, encode_prompts_to_cache, build_prompt_pair_batch_from_cache, split_anchors, \
-    split_prompt_pairs
+    EncodedAnchor, PackedPromptPair, PromptPairBank, \
+    PromptEmbedsCache, encode_prompts_to_cache, build_prompt_pair_bank_from_cache
 
 import torch
 
@@ -63,7 +61,7 @@ class UltimateSliderTrainerProcess(BaseSDTrainProcess):
         self.slider_config = UltimateSliderConfig(**self.get_conf('slider', {}))
 
         self.prompt_cache = PromptEmbedsCache()
-        self.prompt_pairs: list[EncodedPromptPair] = []
+        self.prompt_pairs: Optional[PromptPairBank] = None
         self.anchor_pairs: list[EncodedAnchor] = []
         # keep track of prompt chunk size
         self.prompt_chunk_size = 1
@@ -96,11 +94,11 @@ class UltimateSliderTrainerProcess(BaseSDTrainProcess):
                 self.dataset_prompts += image_dataset.get_all_prompts()
 
             concatenated_dataset = ConcatDataset(datasets)
-            self.data_loader = DataLoader(
+            self.data_loader = get_dataloader(
                 concatenated_dataset,
+                self.dataloader_config,
                 batch_size=self.train_config.batch_size,
                 shuffle=True,
-                num_workers=2
             )
 
     def before_model_load(self):
@@ -170,26 +168,19 @@ class UltimateSliderTrainerProcess(BaseSDTrainProcess):
                 prompt_tensor_file=self.slider_config.prompt_tensors
             )
 
-            prompt_pairs = []
-            prompt_batches = []
-            for neutral in tqdm(neutral_list, desc="Building Prompt Pairs", leave=False):
-                for target in self.slider_config.targets:
-                    prompt_pair_batch = build_prompt_pair_batch_from_cache(
-                        cache=cache,
-                        target=target,
-                        neutral=neutral,
-
-                    )
-                    if self.slider_config.batch_full_slide:
-                        # concat the prompt pairs
-                        # this allows us to run the entire 4 part process in one shot (for slider)
-                        self.prompt_chunk_size = 4
-                        concat_prompt_pair_batch = concat_prompt_pairs(prompt_pair_batch).to('cpu')
-                        prompt_pairs += [concat_prompt_pair_batch]
-                    else:
-                        self.prompt_chunk_size = 1
-                        # do them one at a time (probably not necessary after new optimizations)
-                        prompt_pairs += [x.to('cpu') for x in prompt_pair_batch]
+            # batch_full_slide runs the entire 4 part process in one shot (for slider)
+            self.prompt_chunk_size = 4 if self.slider_config.batch_full_slide else 1
+            # pack every pair into one table on the device, steps just index into it
+            prompt_pairs = build_prompt_pair_bank_from_cache(
+                cache=cache,
+                targets=self.slider_config.targets,
+                neutral_list=neutral_list,
+                batch_full_slide=self.slider_config.batch_full_slide,
+                num_images=self.train_config.batch_size,
+                device=self.device_torch,
+                dtype=get_torch_dtype(self.train_config.dtype),
+                keep_on_device=self.slider_config.keep_prompts_on_device,
+            )
 
         # move to cpu to save vram
         # We don't need text encoder anymore, but keep it on cpu for sampling
@@ -226,12 +217,8 @@ class UltimateSliderTrainerProcess(BaseSDTrainProcess):
             lr_scheduler = self.lr_scheduler
 
             ### TARGET_PROMPTS ###
-            # get a random pair
-            prompt_pair: EncodedPromptPair = self.prompt_pairs[
-                torch.randint(0, len(self.prompt_pairs), (1,)).item()
-            ]
-            # move to device and dtype
-            prompt_pair.to(self.device_torch, dtype=dtype)
+            # get a random pair, its embeddings are already on the device
+            prompt_pair: PackedPromptPair = self.prompt_pairs.sample()
 
             ### PREP REFERENCE IMAGES ###
 
@@ -302,10 +289,9 @@ class UltimateSliderTrainerProcess(BaseSDTrainProcess):
             # 4.20 GB RAM for 512x512
             positive_latents = self.sd.predict_noise(
                 latents=noisy_cfg_latents,
-                text_embeddings=train_tools.concat_prompt_embeddings(
-                    prompt_pair.positive_target,  # negative prompt
-                    prompt_pair.negative_target,  # positive prompt
-                    self.train_config.batch_size,
+                text_embeddings=prompt_pair.get_cfg_embeds(
+                    'positive_target',  # negative prompt
+                    'negative_target',  # positive prompt
                 ),
                 timestep=current_timestep,
                 guidance_scale=1.0
@@ -314,10 +300,9 @@ class UltimateSliderTrainerProcess(BaseSDTrainProcess):
 
             neutral_latents = self.sd.predict_noise(
                 latents=noisy_cfg_latents,
-                text_embeddings=train_tools.concat_prompt_embeddings(
-                    prompt_pair.positive_target,  # negative prompt
-                    prompt_pair.empty_prompt,  # positive prompt (normally neutral
-                    self.train_config.batch_size,
+                text_embeddings=prompt_pair.get_cfg_embeds(
+                    'positive_target',  # negative prompt
+                    'empty_prompt',  # positive prompt (normally neutral
                 ),
                 timestep=current_timestep,
                 guidance_scale=1.0
@@ -326,10 +311,9 @@ class UltimateSliderTrainerProcess(BaseSDTrainProcess):
 
             unconditional_latents = self.sd.predict_noise(
                 latents=noisy_cfg_latents,
-                text_embeddings=train_tools.concat_prompt_embeddings(
-                    prompt_pair.positive_target,  # negative prompt
-                    prompt_pair.positive_target,  # positive prompt
-                    self.train_config.batch_size,
+                text_embeddings=prompt_pair.get_cfg_embeds(
+                    'positive_target',  # negative prompt
+                    'positive_target',  # positive prompt
                 ),
                 timestep=current_timestep,
                 guidance_scale=1.0
@@ -339,7 +323,7 @@ class UltimateSliderTrainerProcess(BaseSDTrainProcess):
             positive_latents_chunks = torch.chunk(positive_latents, self.prompt_chunk_size, dim=0)
             neutral_latents_chunks = torch.chunk(neutral_latents, self.prompt_chunk_size, dim=0)
             unconditional_latents_chunks = torch.chunk(unconditional_latents, self.prompt_chunk_size, dim=0)
-            prompt_pair_chunks = split_prompt_pairs(prompt_pair, self.prompt_chunk_size)
+            prompt_pair_chunks = prompt_pair.split(self.prompt_chunk_size)
             noisy_cfg_latents_chunks = torch.chunk(noisy_cfg_latents, self.prompt_chunk_size, dim=0)
             assert len(prompt_pair_chunks) == len(noisy_cfg_latents_chunks)
 
@@ -425,10 +409,8 @@ class UltimateSliderTrainerProcess(BaseSDTrainProcess):
                 loss = torch.nn.functional.mse_loss(noise_pred.float(), target.float(), reduction="none")
                 loss = loss.mean([1, 2, 3])
 
-                # todo add snr gamma here
-                if self.train_config.min_snr_gamma is not None and self.train_config.min_snr_gamma > 0.000001:
-                    # add min_snr_gamma
-                    loss = apply_snr_weight(loss, timesteps, noise_scheduler, self.train_config.min_snr_gamma)
+                # min snr gamma or other timestep weighting
+                loss = self.loss_weighting(loss, timesteps, noise_scheduler)
 
                 loss = loss.mean()
                 loss = loss * self.slider_config.img_loss_weight
@@ -463,10 +445,9 @@ class UltimateSliderTrainerProcess(BaseSDTrainProcess):
 
                 target_latents = self.sd.predict_noise(
                     latents=noisy_cfg_latent_chunk,
-                    text_embeddings=train_tools.concat_prompt_embeddings(
-                        prompt_pair_chunk.positive_target,  # negative prompt
-                        prompt_pair_chunk.target_class,  # positive prompt
-                        self.train_config.batch_size,
+                    text_embeddings=prompt_pair_chunk.get_cfg_embeds(
+                        'positive_target',  # negative prompt
+                        'target_class',  # positive prompt
                     ),
                     timestep=current_timestep,
                     guidance_scale=1.0
@@ -476,18 +457,8 @@ class UltimateSliderTrainerProcess(BaseSDTrainProcess):
 
                 offset = guidance_scale * (positive_latents_chunk - unconditional_latents_chunk)
 
-                # make offset multiplier based on actions
-                offset_multiplier_list = []
-                for action in prompt_pair_chunk.action_list:
-                    if action == ACTION_TYPES_SLIDER.ERASE_NEGATIVE:
-                        offset_multiplier_list += [-1.0]
-                    elif action == ACTION_TYPES_SLIDER.ENHANCE_NEGATIVE:
-                        offset_multiplier_list += [1.0]
-
-                offset_multiplier = torch.tensor(offset_multiplier_list).to(offset.device, dtype=offset.dtype)
-                # make offset multiplier match rank of offset
-                offset_multiplier = offset_multiplier.view(offset.shape[0], 1, 1, 1)
-                offset *= offset_multiplier
+                # offset multiplier based on actions, already shaped to match offset
+                offset *= prompt_pair_chunk.offset_multiplier.to(offset.dtype)
 
                 offset_neutral = neutral_latents_chunk
                 # offsets are already adjusted on a per-batch basis
@@ -497,12 +468,11 @@ class UltimateSliderTrainerProcess(BaseSDTrainProcess):
                 loss = torch.nn.functional.mse_loss(target_latents.float(), offset_neutral.float(), reduction="none")
                 loss = loss.mean([1, 2, 3])
 
-                if self.train_config.min_snr_gamma is not None and self.train_config.min_snr_gamma > 0.000001:
+                if self.loss_weighting.is_active:
                     # match batch size
                     timesteps_index_list = [current_timestep_index for _ in range(target_latents.shape[0])]
                     # add min_snr_gamma
-                    loss = apply_snr_weight(loss, timesteps_index_list, noise_scheduler,
-                                            self.train_config.min_snr_gamma)
+                    loss = self.loss_weighting(loss, timesteps_index_list, noise_scheduler)
 
                 loss = loss.mean() * prompt_pair_chunk.weight * self.slider_config.cfg_loss_weight
 
@@ -1,3 +1,5 @@
+import os
+
 from toolkit.kohya_model_util import load_models_from_stable_diffusion_checkpoint
 from collections import OrderedDict
 from jobs import BaseJob
@@ -30,12 +32,28 @@ class ExtractJob(BaseJob):
         self.output_folder = self.get_conf('output_folder', required=True)
         self.is_v2 = self.get_conf('is_v2', False)
         self.device = self.get_conf('device', 'cpu')
+        # read safetensors checkpoints a layer at a time instead of loading both models
+        self.lazy_load = self.get_conf('lazy_load', True) and \
+                         self.is_lazy_loadable(self.base_model_path) and \
+                         self.is_lazy_loadable(self.extract_model_path)
 
         # loads the processes from the config
         self.load_processes(process_dict)
 
+    @staticmethod
+    def is_lazy_loadable(model_path: str) -> bool:
+        return os.path.isfile(model_path) and model_path.endswith('.safetensors')
+
     def run(self):
         super().run()
+        if self.lazy_load:
+            print(f"Reading layers on demand from {self.base_model_path} and {self.extract_model_path}")
+            print("")
+            print(f"Running  {len(self.process)} process{'' if len(self.process) == 1 else 'es'}")
+            for process in self.process:
+                process.run()
+            return
+
         # load models
         print(f"Loading models for extraction")
         print(f" - Loading base model: {self.base_model_path}")
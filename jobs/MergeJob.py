@@ -4,6 +4,9 @@ from jobs import BaseJob
 from toolkit.train_tools import get_torch_dtype
 
 process_dict = {
+    'models': 'MergeModelsProcess',
+    'locon': 'MergeLoconProcess',
+    'lora': 'MergeLoconProcess',
 }
 
 
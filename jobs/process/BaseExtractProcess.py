@@ -4,7 +4,9 @@ from collections import OrderedDict
 from safetensors.torch import save_file
 
 from jobs.process.BaseProcess import BaseProcess
+from toolkit.lycoris_utils import extract_diff, extract_diff_from_files
 from toolkit.metadata import get_meta_for_safetensors
+from toolkit.saving import SafetensorsStreamWriter
 
 from typing import ForwardRef
 
@@ -31,6 +33,10 @@ class BaseExtractProcess(BaseProcess):
         self.torch_dtype = get_torch_dtype(self.dtype)
         self.extract_unet = self.get_conf('extract_unet', self.job.extract_unet)
         self.extract_text_encoder = self.get_conf('extract_text_encoder', self.job.extract_text_encoder)
+        # None picks from the cpu count, gpu extraction always uses 1
+        self.num_workers = self.get_conf('num_workers', None)
+        # layers are only started while their estimated memory fits in this
+        self.memory_budget_mb = self.get_conf('memory_budget_mb', 4096, as_type=int)
 
     def run(self):
         # here instead of init because child init needs to go first
@@ -84,3 +90,18 @@ class BaseExtractProcess(BaseProcess):
         save_file(state_dict, self.output_path, save_meta)
 
         print(f"Saved to {self.output_path}")
+
+    def extract_diff(self, *args, **kwargs):
+        # the job either loaded both models or reads the checkpoints a layer at a time
+        if self.job.lazy_load:
+            return extract_diff_from_files(self.job.base_model_path, self.job.extract_model_path, *args, **kwargs)
+        return extract_diff(self.job.model_base, self.job.model_extract, *args, **kwargs)
+
+    def get_output_writer(self) -> SafetensorsStreamWriter:
+        # layers are written as they are extracted, call save_writer when done
+        return SafetensorsStreamWriter(self.output_path, dtype=self.torch_dtype)
+
+    def save_writer(self, writer: SafetensorsStreamWriter):
+        save_meta = get_meta_for_safetensors(self.meta, self.job.name)
+        writer.close(save_meta)
+        print(f"Saved to {self.output_path}")
@@ -5,9 +5,12 @@ from typing import Union
 
 from torch.utils.data import DataLoader
 
-from toolkit.data_loader import get_dataloader_from_datasets
+from toolkit.checkpoint_writer import AsyncCheckpointWriter, atomic_save_state_dict
+from toolkit.data_loader import get_dataloader_from_datasets, cache_latents_for_dataloader
 from toolkit.embedding import Embedding
 from toolkit.lora_special import LoRASpecialNetwork
+from toolkit.meta_init import init_empty_weights
+from toolkit.loss_weighting import TimestepLossWeighting
 from toolkit.optimizer import get_optimizer
 from toolkit.paths import CONFIG_ROOT
 
@@ -16,6 +19,7 @@ from toolkit.stable_diffusion_model import StableDiffusion
 
 from jobs.process import BaseTrainProcess
 from toolkit.metadata import get_meta_for_safetensors, load_metadata_from_safetensors, add_base_model_info_to_meta
+from toolkit.saving import save_ldm_state_dict_from_diffusers
 from toolkit.train_tools import get_torch_dtype
 import gc
 
@@ -23,7 +27,7 @@ import torch
 from tqdm import tqdm
 
 from toolkit.config_modules import SaveConfig, LogingConfig, SampleConfig, NetworkConfig, TrainConfig, ModelConfig, \
-    GenerateImageConfig, EmbeddingConfig, DatasetConfig
+    GenerateImageConfig, EmbeddingConfig, DatasetConfig, DataLoaderConfig
 
 
 def flush():
@@ -60,10 +64,17 @@ class BaseSDTrainProcess(BaseTrainProcess):
             self.has_first_sample_requested = False
             self.first_sample_config = self.sample_config
         self.logging_config = LogingConfig(**self.get_conf('logging', {}))
+        self.loss_weighting = TimestepLossWeighting.from_train_config(self.train_config)
+        self.checkpoint_writer: Union[AsyncCheckpointWriter, None] = None
+        if self.save_config.async_save:
+            self.checkpoint_writer = AsyncCheckpointWriter()
+        self.dataloader_config = DataLoaderConfig(**self.get_conf('dataloader', {}))
         self.optimizer = None
         self.lr_scheduler = None
         self.data_loader: Union[DataLoader, None] = None
         self.data_loader_reg: Union[DataLoader, None] = None
+        # true when every dataset serves cached latents and the vae is not needed for training
+        self.is_latents_cached = False
         self.trigger_word = self.get_conf('trigger_word', None)
 
         raw_datasets = self.get_conf('datasets', None)
@@ -145,7 +156,7 @@ class BaseSDTrainProcess(BaseTrainProcess):
             ))
 
         # send to be generated
-        self.sd.generate_images(gen_img_config_list)
+        self.sd.generate_images(gen_img_config_list, max_batch_size=sample_config.batch_size)
 
     def update_training_metadata(self):
         o_dict = OrderedDict({
@@ -213,11 +224,18 @@ class BaseSDTrainProcess(BaseTrainProcess):
             if self.network_config.normalize:
                 # apply the normalization
                 self.network.apply_stored_normalizer()
-            self.network.save_weights(
-                file_path,
-                dtype=get_torch_dtype(self.save_config.dtype),
-                metadata=save_meta
-            )
+            if self.checkpoint_writer is not None:
+                state_dict = self.checkpoint_writer.snapshot(
+                    self.network.state_dict(),
+                    dtype=get_torch_dtype(self.save_config.dtype)
+                )
+                self.checkpoint_writer.submit(self._write_checkpoint, state_dict, file_path, save_meta)
+            else:
+                self.network.save_weights(
+                    file_path,
+                    dtype=get_torch_dtype(self.save_config.dtype),
+                    metadata=save_meta
+                )
             self.network.multiplier = prev_multiplier
         elif self.embedding is not None:
             # set current step
@@ -227,6 +245,19 @@ class BaseSDTrainProcess(BaseTrainProcess):
                 # replace extension
                 file_path = os.path.splitext(file_path)[0] + ".pt"
             self.embedding.save(file_path)
+        elif self.checkpoint_writer is not None:
+            # the ldm conversion runs in the writer, we only pay for the copy
+            state_dict = self.checkpoint_writer.snapshot(
+                self.sd.state_dict(),
+                dtype=get_torch_dtype(self.save_config.dtype)
+            )
+            self.checkpoint_writer.submit(
+                self._write_checkpoint,
+                state_dict,
+                file_path,
+                save_meta,
+                sd_version=self.sd.get_version_string()
+            )
         else:
             self.sd.save(
                 file_path,
@@ -234,6 +265,22 @@ class BaseSDTrainProcess(BaseTrainProcess):
                 get_torch_dtype(self.save_config.dtype)
             )
 
+        if self.checkpoint_writer is None or self.embedding is not None:
+            self.print(f"Saved to {file_path}")
+            self.clean_up_saves()
+
+    def _write_checkpoint(self, state_dict, file_path, save_meta, sd_version=None):
+        # runs on the checkpoint writer thread
+        if sd_version is not None:
+            save_ldm_state_dict_from_diffusers(
+                state_dict,
+                file_path,
+                save_meta,
+                save_dtype=get_torch_dtype(self.save_config.dtype),
+                sd_version=sd_version
+            )
+        else:
+            atomic_save_state_dict(state_dict, file_path, save_meta)
         self.print(f"Saved to {file_path}")
         self.clean_up_saves()
 
@@ -277,16 +324,19 @@ class BaseSDTrainProcess(BaseTrainProcess):
     def load_weights(self, path):
         if self.network is not None:
             self.network.load_weights(path)
-            meta = load_metadata_from_safetensors(path)
-            # if 'training_info' in Orderdict keys
-            if 'training_info' in meta and 'step' in meta['training_info']:
-                self.step_num = meta['training_info']['step']
-                self.start_step = self.step_num
-                print(f"Found step {self.step_num} in metadata, starting from there")
+            self.load_training_info(path)
 
         else:
             print("load_weights not implemented for non-network models")
 
+    def load_training_info(self, path):
+        meta = load_metadata_from_safetensors(path)
+        # if 'training_info' in Orderdict keys
+        if 'training_info' in meta and 'step' in meta['training_info']:
+            self.step_num = meta['training_info']['step']
+            self.start_step = self.step_num
+            print(f"Found step {self.step_num} in metadata, starting from there")
+
     def process_general_training_batch(self, batch):
         with torch.no_grad():
             imgs, prompts, dataset_config = batch
@@ -300,6 +350,15 @@ class BaseSDTrainProcess(BaseTrainProcess):
                 is_reg_list = is_reg_list.numpy().tolist()
             is_reg_list = [bool(x) for x in is_reg_list]
 
+            # datasets with cached latents send latents instead of pixels
+            if isinstance(dataset_config, list):
+                is_latents_list = [x.get('is_latents', 0) for x in dataset_config]
+            else:
+                is_latents_list = dataset_config.get('is_latents', [0 for _ in range(imgs.shape[0])])
+            if isinstance(is_latents_list, torch.Tensor):
+                is_latents_list = is_latents_list.numpy().tolist()
+            is_latents = all([bool(x) for x in is_latents_list])
+
             conditioned_prompts = []
 
             for prompt, is_reg in zip(prompts, is_reg_list):
@@ -325,7 +384,10 @@ class BaseSDTrainProcess(BaseTrainProcess):
 
             dtype = get_torch_dtype(self.train_config.dtype)
             imgs = imgs.to(self.device_torch, dtype=dtype)
-            latents = self.sd.encode_images(imgs)
+            if is_latents:
+                latents = imgs
+            else:
+                latents = self.sd.encode_images(imgs)
 
             self.sd.noise_scheduler.set_timesteps(
                 self.train_config.max_denoising_steps, device=self.device_torch
@@ -336,8 +398,8 @@ class BaseSDTrainProcess(BaseTrainProcess):
 
             # get noise
             noise = self.sd.get_latent_noise(
-                pixel_height=imgs.shape[2],
-                pixel_width=imgs.shape[3],
+                height=latents.shape[2],
+                width=latents.shape[3],
                 batch_size=batch_size,
                 noise_offset=self.train_config.noise_offset
             ).to(self.device_torch, dtype=dtype)
@@ -359,15 +421,26 @@ class BaseSDTrainProcess(BaseTrainProcess):
         self.before_dataset_load()
         # load datasets if passed in the root process
         if self.datasets is not None:
-            self.data_loader = get_dataloader_from_datasets(self.datasets, self.train_config.batch_size)
+            self.data_loader = get_dataloader_from_datasets(
+                self.datasets, self.train_config.batch_size, self.dataloader_config
+            )
         if self.datasets_reg is not None:
-            self.data_loader_reg = get_dataloader_from_datasets(self.datasets_reg, self.train_config.batch_size)
+            self.data_loader_reg = get_dataloader_from_datasets(
+                self.datasets_reg, self.train_config.batch_size, self.dataloader_config
+            )
 
         ### HOOK ###
         self.hook_before_model_load()
         # run base sd process run
         self.sd.load_model()
 
+        if self.train_config.train_text_encoder or self.embed_config is not None:
+            # cached and stored embeddings would go stale as soon as the text encoder or embedding is updated
+            if self.sd.prompt_embeds_store is not None:
+                print("Training the text encoder, not using the prompt embeds store")
+            self.sd.prompt_embeds_store = None
+            self.sd.prompt_embeds_cache = None
+
         if self.train_config.gradient_checkpointing:
             # may get disabled elsewhere
             self.sd.unet.enable_gradient_checkpointing()
@@ -399,18 +472,34 @@ class BaseSDTrainProcess(BaseTrainProcess):
         vae.requires_grad_(False)
         vae.eval()
 
+        # encode any uncached images once, the vae can stay on the cpu if everything is cached
+        is_latents_cached_list = []
+        for data_loader in [self.data_loader, self.data_loader_reg]:
+            if data_loader is not None:
+                is_latents_cached_list.append(cache_latents_for_dataloader(data_loader, self.sd))
+        self.is_latents_cached = len(is_latents_cached_list) > 0 and all(is_latents_cached_list)
+        flush()
+
         if self.network_config is not None:
-            self.network = LoRASpecialNetwork(
-                text_encoder=text_encoder,
-                unet=unet,
-                lora_dim=self.network_config.linear,
-                multiplier=1.0,
-                alpha=self.network_config.linear_alpha,
-                train_unet=self.train_config.train_unet,
-                train_text_encoder=self.train_config.train_text_encoder,
-                conv_lora_dim=self.network_config.conv,
-                conv_alpha=self.network_config.conv_alpha,
-            )
+            latest_save_path = self.get_latest_save_path()
+            # when resuming, build the network empty and load the saved weights straight into it
+            load_on_meta = self.model_config.low_cpu_mem_usage and latest_save_path is not None
+            with init_empty_weights(load_on_meta):
+                self.network = LoRASpecialNetwork(
+                    text_encoder=text_encoder,
+                    unet=unet,
+                    lora_dim=self.network_config.linear,
+                    multiplier=1.0,
+                    alpha=self.network_config.linear_alpha,
+                    train_unet=self.train_config.train_unet,
+                    train_text_encoder=self.train_config.train_text_encoder,
+                    conv_lora_dim=self.network_config.conv,
+                    conv_alpha=self.network_config.conv_alpha,
+                )
+            if load_on_meta:
+                self.print(f"#### IMPORTANT RESUMING FROM {latest_save_path} ####")
+                self.print(f"Loading from {latest_save_path}")
+                self.network.materialize_weights(latest_save_path)
 
             self.network.force_to(self.device_torch, dtype=dtype)
             # give network to sd so it can use it
@@ -437,11 +526,14 @@ class BaseSDTrainProcess(BaseTrainProcess):
             # set the network to normalize if we are
             self.network.is_normalizing = self.network_config.normalize
 
-            latest_save_path = self.get_latest_save_path()
             if latest_save_path is not None:
-                self.print(f"#### IMPORTANT RESUMING FROM {latest_save_path} ####")
-                self.print(f"Loading from {latest_save_path}")
-                self.load_weights(latest_save_path)
+                if load_on_meta:
+                    # weights are already loaded, only the step is left
+                    self.load_training_info(latest_save_path)
+                else:
+                    self.print(f"#### IMPORTANT RESUMING FROM {latest_save_path} ####")
+                    self.print(f"Loading from {latest_save_path}")
+                    self.load_weights(latest_save_path)
                 self.network.multiplier = 1.0
         elif self.embed_config is not None:
             self.embedding = Embedding(
@@ -612,6 +704,11 @@ class BaseSDTrainProcess(BaseTrainProcess):
         self.sample(self.step_num + 1)
         print("")
         self.save()
+        if self.checkpoint_writer is not None:
+            # make sure everything is on disk before we exit
+            self.checkpoint_writer.close()
+        if self.sd.prompt_embeds_store is not None:
+            self.sd.prompt_embeds_store.flush()
 
         del (
             self.sd,
@@ -1,5 +1,4 @@
 from collections import OrderedDict
-from toolkit.lycoris_utils import extract_diff
 from .BaseExtractProcess import BaseExtractProcess
 
 mode_dict = {
@@ -44,22 +43,28 @@ class ExtractLoconProcess(BaseExtractProcess):
         super().run()
         print(f"Running process: {self.mode}, lin: {self.linear_param}, conv: {self.conv_param}")
 
-        state_dict, extract_diff_meta = extract_diff(
-            self.job.model_base,
-            self.job.model_extract,
-            self.mode,
-            self.linear_param,
-            self.conv_param,
-            self.job.device,
-            self.use_sparse_bias,
-            self.sparsity,
-            not self.disable_cp,
-            extract_unet=self.extract_unet,
-            extract_text_encoder=self.extract_text_encoder
-        )
+        writer = self.get_output_writer()
+        try:
+            _, extract_diff_meta = self.extract_diff(
+                self.mode,
+                self.linear_param,
+                self.conv_param,
+                self.job.device,
+                self.use_sparse_bias,
+                self.sparsity,
+                not self.disable_cp,
+                extract_unet=self.extract_unet,
+                extract_text_encoder=self.extract_text_encoder,
+                num_workers=self.num_workers,
+                memory_budget_mb=self.memory_budget_mb,
+                writer=writer,
+            )
+        except Exception:
+            writer.abort()
+            raise
 
         self.add_meta(extract_diff_meta)
-        self.save(state_dict)
+        self.save_writer(writer)
 
     def get_output_path(self, prefix=None, suffix=None):
         if suffix is None:
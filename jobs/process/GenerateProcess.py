@@ -32,6 +32,7 @@ class GenerateConfig:
         self.guidance_rescale = kwargs.get('guidance_rescale', 0.0)
         self.ext = kwargs.get('ext', 'png')
         self.prompt_file = kwargs.get('prompt_file', False)
+        self.batch_size = kwargs.get('batch_size', 4)
         if self.prompts is None:
             raise ValueError("Prompts must be set")
         if isinstance(self.prompts, str):
@@ -98,7 +99,7 @@ class GenerateProcess(BaseProcess):
                 add_prompt_file=self.generate_config.prompt_file
             ))
         # generate images
-        self.sd.generate_images(prompt_image_configs)
+        self.sd.generate_images(prompt_image_configs, max_batch_size=self.generate_config.batch_size)
 
         print("Done generating images")
         # cleanup
@@ -1,20 +1,32 @@
 from collections import OrderedDict
-from toolkit.lycoris_utils import extract_diff
-from .BaseExtractProcess import BaseExtractProcess
 
+from jobs.process.BaseMergeProcess import BaseMergeProcess
+from toolkit.config_modules import MergeModelConfig
+from toolkit.merging import CheckpointMerger, merge_loras
+from toolkit.metadata import get_meta_for_safetensors
 
-class MergeLoconProcess(BaseExtractProcess):
+
+class MergeLoconProcess(BaseMergeProcess):
     def __init__(self, process_id: int, job, config: OrderedDict):
         super().__init__(process_id, job, config)
+        # merge into this checkpoint, or into a single lora when it is not set
+        self.base_model = self.get_conf('base_model', None)
+        self.num_threads = self.get_conf('num_threads', 1, as_type=int)
+        self.loras = [MergeModelConfig(**lora) for lora in self.get_conf('loras', required=True, as_type=list)]
 
     def run(self):
         super().run()
-        new_state_dict = {}
-        raise NotImplementedError("This is not implemented yet")
-
-
-    def get_output_path(self, prefix=None, suffix=None):
-        if suffix is None:
-            suffix = f"_{self.mode}_{self.linear_param}_{self.conv_param}"
-        return super().get_output_path(prefix, suffix)
-
+        save_meta = get_meta_for_safetensors(self.meta, self.job.name)
+        if self.base_model is not None:
+            print(f"Merging {len(self.loras)} loras into {self.base_model}")
+            merger = CheckpointMerger(
+                [MergeModelConfig(path=self.base_model)],
+                loras=self.loras,
+                num_threads=self.num_threads,
+                device=self.job.device,
+            )
+            merger.save(self.output_path, dtype=self.torch_dtype, metadata=save_meta)
+        else:
+            print(f"Merging {len(self.loras)} loras")
+            merge_loras(self.loras, self.output_path, dtype=self.torch_dtype, metadata=save_meta, device=self.job.device)
+        print(f"Saved to {self.output_path}")
@@ -0,0 +1,34 @@
+from collections import OrderedDict
+
+from jobs.process.BaseMergeProcess import BaseMergeProcess
+from toolkit.config_modules import MergeModelConfig
+from toolkit.merging import CheckpointMerger
+from toolkit.metadata import get_meta_for_safetensors
+
+
+class MergeModelsProcess(BaseMergeProcess):
+    def __init__(self, process_id: int, job, config: OrderedDict):
+        super().__init__(process_id, job, config)
+        self.method = self.get_conf('method', 'weighted_sum')
+        self.normalize = self.get_conf('normalize', True, as_type=bool)
+        self.difference_base = self.get_conf('difference_base', None)
+        self.num_threads = self.get_conf('num_threads', 1, as_type=int)
+        self.models = [MergeModelConfig(**model) for model in self.get_conf('models', required=True, as_type=list)]
+        # optional loras merged into the result
+        self.loras = [MergeModelConfig(**lora) for lora in self.get_conf('loras', [], as_type=list)]
+
+    def run(self):
+        super().run()
+        print(f"Merging {len(self.models)} models with {self.method}")
+        merger = CheckpointMerger(
+            self.models,
+            method=self.method,
+            difference_base=self.difference_base,
+            loras=self.loras,
+            normalize=self.normalize,
+            num_threads=self.num_threads,
+            device=self.job.device,
+        )
+        save_meta = get_meta_for_safetensors(self.meta, self.job.name)
+        merger.save(self.output_path, dtype=self.torch_dtype, metadata=save_meta)
+        print(f"Saved to {self.output_path}")
@@ -1,17 +1,100 @@
 import gc
 import os
+import math
 from collections import OrderedDict
-from typing import ForwardRef
+from concurrent.futures import ThreadPoolExecutor
+from typing import ForwardRef, List, Tuple
 
 import torch
-from safetensors.torch import save_file, load_file
+from safetensors import safe_open
+from tqdm import tqdm
 
 from jobs.process.BaseProcess import BaseProcess
-from toolkit.metadata import get_meta_for_safetensors, load_metadata_from_safetensors, add_model_hash_to_meta, \
-    add_base_model_info_to_meta
+from toolkit.metadata import get_meta_for_safetensors, parse_metadata_from_safetensors, add_base_model_info_to_meta
+from toolkit.saving import save_file_streaming
 from toolkit.train_tools import get_torch_dtype
 
 
+class LoraRescaler:
+    """
+    Rescales lora files so they give the same result at target_weight as they did at current_weight.
+    The scales are worked out once, then each file is streamed from the input to the output with the
+    model hashes computed in the same pass.
+    """
+
+    def __init__(
+            self,
+            current_weight: float,
+            target_weight: float,
+            scale_target: str = 'up_down',
+            save_dtype: torch.dtype = torch.float16,
+            name: str = None,
+    ):
+        if scale_target not in ['alpha', 'up_down']:
+            raise ValueError(f"Unknown scale_target {scale_target}")
+        self.scale_target = scale_target
+        self.save_dtype = save_dtype
+        # replaces [name] in the meta of the input files
+        self.name = name
+
+        # all loras have an alpha, up weight and down weight
+        #  - "lora_te_text_model_encoder_layers_0_mlp_fc1.alpha",
+        #  - "lora_te_text_model_encoder_layers_0_mlp_fc1.lora_down.weight",
+        #  - "lora_te_text_model_encoder_layers_0_mlp_fc1.lora_up.weight",
+        # we can rescale by adjusting the alpha or the up and down weights, which nets the same output
+        # some locons also have mid weights, we will leave those alone, it works without them
+
+        # when adjusting alpha, it is used to calculate the multiplier in a lora module
+        #  - scale = alpha / lora_dim
+        #  - output = layer_out + lora_up_out * multiplier * scale
+        total_module_scale = current_weight / target_weight
+        # split between up and down, doing both should reduce the chance of NaN in fp16.
+        # the sign goes on up so negative weights flip the lora
+        up_down_scale = math.sqrt(abs(total_module_scale))
+        if scale_target == 'alpha':
+            self.suffix_scales = {'.alpha': total_module_scale}
+        else:
+            self.suffix_scales = {
+                '.lora_up.weight': math.copysign(up_down_scale, total_module_scale),
+                '.lora_down.weight': up_down_scale,
+            }
+
+    def get_scale(self, key: str) -> float:
+        for suffix, scale in self.suffix_scales.items():
+            if key.endswith(suffix):
+                return scale
+        return 1.0
+
+    @torch.no_grad()
+    def rescale_file(self, input_path: str, output_path: str, save_meta: OrderedDict = None) -> str:
+        # save_meta None keeps the meta of the input file
+        with safe_open(input_path, framework="pt", device="cpu") as f:
+            if save_meta is None:
+                save_meta = get_meta_for_safetensors(
+                    parse_metadata_from_safetensors(f.metadata() or {}),
+                    self.name,
+                    add_software_info=False
+                )
+            tensor_shapes = OrderedDict([(key, f.get_slice(key).get_shape()) for key in f.keys()])
+
+            def get_tensor(key: str) -> torch.Tensor:
+                tensor = f.get_tensor(key)
+                scale = self.get_scale(key)
+                if scale == 1.0:
+                    return tensor
+                return tensor.float() * scale
+
+            save_file_streaming(
+                tensor_shapes,
+                get_tensor,
+                output_path,
+                self.save_dtype,
+                save_meta,
+                add_model_hash=True
+            )
+        return output_path
+
+
 class ModRescaleLoraProcess(BaseProcess):
     process_id: int
     config: OrderedDict
@@ -27,6 +110,7 @@ class ModRescaleLoraProcess(BaseProcess):
         self.process_id: int
         self.config: OrderedDict
         self.progress_bar: ForwardRef('tqdm') = None
+        # a lora file, or a folder of them. output_path is a folder too when it is a folder
         self.input_path = self.get_conf('input_path', required=True)
         self.output_path = self.get_conf('output_path', required=True)
         self.replace_meta = self.get_conf('replace_meta', default=False)
@@ -36,14 +120,28 @@ class ModRescaleLoraProcess(BaseProcess):
         self.scale_target = self.get_conf('scale_target', default='up_down')  # alpha or up_down
         self.is_xl = self.get_conf('is_xl', default=False, as_type=bool)
         self.is_v2 = self.get_conf('is_v2', default=False, as_type=bool)
+        # files rescaled at once in folder mode
+        self.num_workers = self.get_conf('num_workers', default=min(8, os.cpu_count() or 1), as_type=int)
 
         self.progress_bar = None
 
+    def get_file_pairs(self) -> List[Tuple[str, str]]:
+        if not os.path.isdir(self.input_path):
+            return [(self.input_path, self.output_path)]
+        file_names = sorted([name for name in os.listdir(self.input_path) if name.endswith('.safetensors')])
+        return [(os.path.join(self.input_path, name), os.path.join(self.output_path, name)) for name in file_names]
+
     def run(self):
         super().run()
-        source_state_dict = load_file(self.input_path)
-        source_meta = load_metadata_from_safetensors(self.input_path)
-
+        rescaler = LoraRescaler(
+            self.current_weight,
+            self.target_weight,
+            scale_target=self.scale_target,
+            save_dtype=self.save_dtype,
+            name=self.job.name,
+        )
+
+        save_meta = None
         if self.replace_meta:
             self.meta.update(
                 add_base_model_info_to_meta(
@@ -53,52 +151,22 @@ class ModRescaleLoraProcess(BaseProcess):
                 )
             )
             save_meta = get_meta_for_safetensors(self.meta, self.job.name)
+
+        file_pairs = self.get_file_pairs()
+        if len(file_pairs) == 1:
+            rescaler.rescale_file(file_pairs[0][0], file_pairs[0][1], save_meta)
+            print(f"Saved to {file_pairs[0][1]}")
         else:
-            save_meta = get_meta_for_safetensors(source_meta, self.job.name, add_software_info=False)
-
-        # save
-        os.makedirs(os.path.dirname(self.output_path), exist_ok=True)
-
-        new_state_dict = OrderedDict()
-
-        for key in list(source_state_dict.keys()):
-            v = source_state_dict[key]
-            v = v.detach().clone().to("cpu").to(get_torch_dtype('fp32'))
-
-            # all loras have an alpha, up weight and down weight
-            #  - "lora_te_text_model_encoder_layers_0_mlp_fc1.alpha",
-            #  - "lora_te_text_model_encoder_layers_0_mlp_fc1.lora_down.weight",
-            #  - "lora_te_text_model_encoder_layers_0_mlp_fc1.lora_up.weight",
-            # we can rescale by adjusting the alpha or the up weights, or the up and down weights
-            # I assume doing both up and down would be best all around, but I'm not sure
-            # some locons also have mid weights, we will leave those alone for now, will work without them
-
-            # when adjusting alpha, it is used to calculate the multiplier in a lora module
-            #  - scale = alpha / lora_dim
-            #  - output = layer_out + lora_up_out * multiplier * scale
-            total_module_scale = torch.tensor(self.current_weight / self.target_weight) \
-                .to("cpu", dtype=get_torch_dtype('fp32'))
-            num_modules_layers = 2  # up and down
-            up_down_scale = torch.pow(total_module_scale, 1.0 / num_modules_layers) \
-                .to("cpu", dtype=get_torch_dtype('fp32'))
-            # only update alpha
-            if self.scale_target == 'alpha' and key.endswith('.alpha'):
-                v = v * total_module_scale
-            if self.scale_target == 'up_down' and key.endswith('.lora_up.weight') or key.endswith('.lora_down.weight'):
-                # would it be better to adjust the up weights for fp16 precision? Doing both should reduce chance of NaN
-                v = v * up_down_scale
-            v = v.detach().clone().to("cpu").to(self.save_dtype)
-            new_state_dict[key] = v
-
-        save_meta = add_model_hash_to_meta(new_state_dict, save_meta)
-        save_file(new_state_dict, self.output_path, save_meta)
+            print(f"Rescaling {len(file_pairs)} loras from {self.input_path}")
+            with ThreadPoolExecutor(max_workers=max(1, self.num_workers)) as executor:
+                futures = [
+                    executor.submit(rescaler.rescale_file, input_path, output_path, save_meta)
+                    for input_path, output_path in file_pairs
+                ]
+                for future in tqdm(futures, desc="Rescaling"):
+                    future.result()
+            print(f"Saved {len(file_pairs)} loras to {self.output_path}")
 
         # cleanup incase there are other jobs
-        del new_state_dict
-        del source_state_dict
-        del source_meta
-
         torch.cuda.empty_cache()
         gc.collect()
-
-        print(f"Saved to {self.output_path}")
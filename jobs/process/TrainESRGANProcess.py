@@ -15,7 +15,8 @@ from torch import nn
 from torchvision.transforms import transforms
 
 from jobs.process import BaseTrainProcess
-from toolkit.data_loader import AugmentedImageDataset
+from toolkit.config_modules import DataLoaderConfig
+from toolkit.data_loader import AugmentedImageDataset, get_dataloader
 from toolkit.esrgan_utils import convert_state_dict_to_basicsr, convert_basicsr_state_dict_to_save_format
 from toolkit.losses import ComparativeTotalVariation, get_gradient_penalty, PatternLoss
 from toolkit.metadata import get_meta_for_safetensors
@@ -56,6 +57,7 @@ class TrainESRGANProcess(BaseTrainProcess):
         self.dtype = self.get_conf('dtype', 'float32')
         self.sample_sources = self.get_conf('sample_sources', None)
         self.log_every = self.get_conf('log_every', 100, as_type=int)
+        self.dataloader_config = DataLoaderConfig(**self.get_conf('dataloader', {}))
         self.style_weight = self.get_conf('style_weight', 0, as_type=float)
         self.content_weight = self.get_conf('content_weight', 0, as_type=float)
         self.mse_weight = self.get_conf('mse_weight', 1e0, as_type=float)
@@ -154,11 +156,11 @@ class TrainESRGANProcess(BaseTrainProcess):
                 datasets.append(image_dataset)
 
             concatenated_dataset = ConcatDataset(datasets)
-            self.data_loader = DataLoader(
+            self.data_loader = get_dataloader(
                 concatenated_dataset,
+                self.dataloader_config,
                 batch_size=self.batch_size,
                 shuffle=True,
-                num_workers=6
             )
 
     def setup_vgg19(self):
@@ -1,12 +1,11 @@
-import glob
 import os
 from collections import OrderedDict
-import random
 from typing import Optional, List
 
-from safetensors.torch import save_file, load_file
 from tqdm import tqdm
 
+from toolkit.latent_shards import LatentShardReader, LatentShardWriter, PrefetchingSampler, \
+    pack_single_sample_files
 from toolkit.layers import ReductionKernel
 from toolkit.stable_diffusion_model import PromptEmbeds
 from toolkit.train_tools import get_torch_dtype, apply_noise_offset
@@ -34,19 +33,14 @@ class RescaleConfig:
         self.num_latent_tensors = kwargs.get('num_latent_tensors', 1000)
         self.to_resolution = kwargs.get('to_resolution', int(self.from_resolution * self.scale))
         self.prompt_dropout = kwargs.get('prompt_dropout', 0.1)
-
-
-class PromptEmbedsCache:
-    prompts: dict[str, PromptEmbeds] = {}
-
-    def __setitem__(self, __name: str, __value: PromptEmbeds) -> None:
-        self.prompts[__name] = __value
-
-    def __getitem__(self, __name: str) -> Optional[PromptEmbeds]:
-        if __name in self.prompts:
-            return self.prompts[__name]
-        else:
-            return None
+        # from resolutions to generate targets at, they all rescale by scale
+        self.resolutions = kwargs.get('resolutions', [self.from_resolution])
+        # samples generated per unet pass
+        self.generate_batch_size = kwargs.get('generate_batch_size', 8)
+        # samples per file in latent_tensor_dir
+        self.shard_size = kwargs.get('shard_size', 256)
+        # samples read ahead while training
+        self.prefetch = kwargs.get('prefetch', 4)
 
 
 class TrainSDRescaleProcess(BaseSDTrainProcess):
@@ -65,7 +59,7 @@ class TrainSDRescaleProcess(BaseSDTrainProcess):
             device=self.device_torch,
         )
 
-        self.latent_paths: List[str] = []
+        self.latent_sampler: Optional[PrefetchingSampler] = None
         self.empty_embedding: PromptEmbeds = None
 
     def before_model_load(self):
@@ -73,17 +67,13 @@ class TrainSDRescaleProcess(BaseSDTrainProcess):
 
     def get_latent_tensors(self):
         dtype = get_torch_dtype(self.train_config.dtype)
+        latent_tensor_dir = self.rescale_config.latent_tensor_dir
 
-        num_to_generate = 0
-        # check if dir exists
-        if not os.path.exists(self.rescale_config.latent_tensor_dir):
-            os.makedirs(self.rescale_config.latent_tensor_dir)
-            num_to_generate = self.rescale_config.num_latent_tensors
-        else:
-            # find existing
-            current_tensor_list = glob.glob(os.path.join(self.rescale_config.latent_tensor_dir, "*.safetensors"))
-            num_to_generate = self.rescale_config.num_latent_tensors - len(current_tensor_list)
-            self.latent_paths = current_tensor_list
+        os.makedirs(latent_tensor_dir, exist_ok=True)
+        # older runs wrote a file per sample
+        pack_single_sample_files(latent_tensor_dir, self.rescale_config.shard_size)
+        reader = LatentShardReader(latent_tensor_dir)
+        num_to_generate = self.rescale_config.num_latent_tensors - len(reader)
 
         if num_to_generate > 0:
             print(f"Generating {num_to_generate}/{self.rescale_config.num_latent_tensors} latent tensors")
@@ -107,83 +97,86 @@ class TrainSDRescaleProcess(BaseSDTrainProcess):
             self.sd_parent.unet.eval()
             self.sd_parent.unet.requires_grad_(False)
 
-            # save current seed state for training
-            rng_state = torch.get_rng_state()
-            cuda_rng_state = torch.cuda.get_rng_state() if torch.cuda.is_available() else None
+            writer = LatentShardWriter(latent_tensor_dir, self.rescale_config.shard_size)
+            batch_size = self.train_config.batch_size
+            timesteps_to = self.train_config.max_denoising_steps
+            # do a timestep of 1
+            timestep = 1
+            resolutions = self.rescale_config.resolutions
 
-            text_embeddings = train_tools.concat_prompt_embeddings(
-                self.empty_embedding,  # unconditional (negative prompt)
-                self.empty_embedding,  # conditional (positive prompt)
-                self.train_config.batch_size,
+            # set the scheduler to the number of steps
+            self.sd.noise_scheduler.set_timesteps(
+                timesteps_to, device=self.device_torch
             )
-            torch.set_default_device(self.device_torch)
-
-            for i in tqdm(range(num_to_generate)):
-                dtype = get_torch_dtype(self.train_config.dtype)
-                # get a random seed
-                seed = torch.randint(0, 2 ** 32, (1,)).item()
-                # zero pad seed string to max length
-                seed_string = str(seed).zfill(10)
-                # set seed
-                torch.manual_seed(seed)
-                if torch.cuda.is_available():
-                    torch.cuda.manual_seed(seed)
-
-                # # ger a random number of steps
-                timesteps_to = self.train_config.max_denoising_steps
-
-                # set the scheduler to the number of steps
-                self.sd.noise_scheduler.set_timesteps(
-                    timesteps_to, device=self.device_torch
-                )
-
-                noise = self.sd.get_latent_noise(
-                    pixel_height=self.rescale_config.from_resolution,
-                    pixel_width=self.rescale_config.from_resolution,
-                    batch_size=self.train_config.batch_size,
-                    noise_offset=self.train_config.noise_offset,
-                ).to(self.device_torch, dtype=dtype)
-
-                # get latents
-                latents = noise * self.sd.noise_scheduler.init_noise_sigma
-                latents = latents.to(self.device_torch, dtype=dtype)
-
-                # get random guidance scale from 1.0 to 10.0 (CFG)
-                guidance_scale = torch.rand(1).item() * 9.0 + 1.0
-
-                # do a timestep of 1
-                timestep = 1
-
-                noise_pred_target = self.sd_parent.predict_noise(
-                    latents,
-                    text_embeddings=text_embeddings,
-                    timestep=timestep,
-                    guidance_scale=guidance_scale
-                )
-
-                # build state dict
-                state_dict = OrderedDict()
-                state_dict['noise_pred_target'] = noise_pred_target.to('cpu', dtype=torch.float16)
-                state_dict['latents'] = latents.to('cpu', dtype=torch.float16)
-                state_dict['guidance_scale'] = torch.tensor(guidance_scale).to('cpu', dtype=torch.float16)
-                state_dict['timestep'] = torch.tensor(timestep).to('cpu', dtype=torch.float16)
-                state_dict['timesteps_to'] = torch.tensor(timesteps_to).to('cpu', dtype=torch.float16)
-                state_dict['seed'] = torch.tensor(seed).to('cpu', dtype=torch.float32) # must be float 32 to prevent overflow
-
-                file_name = f"{seed_string}_{i}.safetensors"
-                file_path = os.path.join(self.rescale_config.latent_tensor_dir, file_name)
-                save_file(state_dict, file_path)
-                self.latent_paths.append(file_path)
+
+            # keep the training rng untouched
+            with torch.random.fork_rng():
+                progress_bar = tqdm(total=num_to_generate)
+                for res_idx, resolution in enumerate(resolutions):
+                    # split the samples evenly over the resolutions
+                    num_for_resolution = num_to_generate // len(resolutions)
+                    if res_idx < num_to_generate % len(resolutions):
+                        num_for_resolution += 1
+                    for i in range(0, num_for_resolution, self.rescale_config.generate_batch_size):
+                        num_samples = min(self.rescale_config.generate_batch_size, num_for_resolution - i)
+                        # get a random seed for each sample
+                        seeds = torch.randint(0, 2 ** 32, (num_samples,)).tolist()
+
+                        # noise for each sample comes from its own seed so it can be reproduced
+                        noise_list = []
+                        for seed in seeds:
+                            torch.manual_seed(seed)
+                            noise_list.append(self.sd.get_latent_noise(
+                                pixel_height=resolution,
+                                pixel_width=resolution,
+                                batch_size=batch_size,
+                                noise_offset=self.train_config.noise_offset,
+                            ))
+                        noise = torch.cat(noise_list, dim=0).to(self.device_torch, dtype=dtype)
+
+                        # get latents
+                        latents = noise * self.sd.noise_scheduler.init_noise_sigma
+                        latents = latents.to(self.device_torch, dtype=dtype)
+
+                        # get random guidance scale from 1.0 to 10.0 (CFG) for each sample
+                        guidance_scales = torch.rand(num_samples) * 9.0 + 1.0
+
+                        # all the samples in one pass
+                        noise_pred_target = self.sd_parent.predict_noise(
+                            latents,
+                            text_embeddings=train_tools.concat_prompt_embeddings(
+                                self.empty_embedding,  # unconditional (negative prompt)
+                                self.empty_embedding,  # conditional (positive prompt)
+                                num_samples * batch_size,
+                            ),
+                            timestep=timestep,
+                            guidance_scale=guidance_scales.repeat_interleave(batch_size).view(-1, 1, 1, 1).to(
+                                self.device_torch, dtype=dtype)
+                        )
+
+                        sample_shape = (num_samples, batch_size) + tuple(latents.shape[1:])
+                        writer.add(OrderedDict([
+                            ('noise_pred_target', noise_pred_target.view(sample_shape).to('cpu', dtype=torch.float16)),
+                            ('latents', latents.view(sample_shape).to('cpu', dtype=torch.float16)),
+                            ('guidance_scale', guidance_scales.to(dtype=torch.float16)),
+                            ('timestep', torch.full((num_samples,), timestep, dtype=torch.float16)),
+                            ('timesteps_to', torch.full((num_samples,), timesteps_to, dtype=torch.float16)),
+                            ('seed', torch.tensor(seeds, dtype=torch.int64)),
+                        ]))
+                        progress_bar.update(num_samples)
+                    # shards hold a single resolution
+                    writer.flush()
+                progress_bar.close()
 
             print("Removing parent model")
             # delete parent
             del self.sd_parent
             flush()
 
-            torch.set_rng_state(rng_state)
-            if cuda_rng_state is not None:
-                torch.cuda.set_rng_state(cuda_rng_state)
             self.sd.unet.to(self.device_torch, dtype=dtype)
+            reader.refresh()
+
+        self.latent_sampler = PrefetchingSampler(reader, prefetch=self.rescale_config.prefetch)
 
     def hook_before_train_loop(self):
         # encode our empty prompt
@@ -224,9 +217,8 @@ class TrainSDRescaleProcess(BaseSDTrainProcess):
         with torch.no_grad():
             self.optimizer.zero_grad()
 
-            # pick random latent tensor
-            latent_path = random.choice(self.latent_paths)
-            latent_tensor = load_file(latent_path)
+            # pick random latent tensor, read ahead from the memory mapped shards
+            latent_tensor = self.latent_sampler.next()
 
             noise_pred_target = (latent_tensor['noise_pred_target']).to(self.device_torch, dtype=dtype)
             latents = (latent_tensor['latents']).to(self.device_torch, dtype=dtype)
@@ -261,6 +253,8 @@ class TrainSDRescaleProcess(BaseSDTrainProcess):
         )
         denoised_pred = self.sd.noise_scheduler.step(noise_pred_train, timestep, reduced_latents).prev_sample
         loss = loss_function(denoised_pred, denoised_target)
+        # min snr gamma or other timestep weighting
+        loss = self.loss_weighting(loss, timestep, self.sd.noise_scheduler)
         loss_float = loss.item()
         loss.backward()
         self.optimizer.step()
@@ -1,16 +1,15 @@
 import random
 from collections import OrderedDict
-from tqdm import tqdm
+from typing import Optional, List
 
 from toolkit.config_modules import SliderConfig
-from toolkit.train_tools import get_torch_dtype, apply_snr_weight
+from toolkit.trajectory_bank import DenoisingTrajectoryBank
+from toolkit.train_tools import get_torch_dtype
 import gc
 from toolkit import train_tools
 from toolkit.prompt_utils import \
-    EncodedPromptPair, ACTION_TYPES_SLIDER, \
-    EncodedAnchor, concat_prompt_pairs, \
-    concat_anchors, PromptEmbedsCache, encode_prompts_to_cache, build_prompt_pair_batch_from_cache, split_anchors, \
-    split_prompt_pairs
+    EncodedAnchor, PackedPromptPair, PromptPairBank, \
+    concat_anchors, PromptEmbedsCache, encode_prompts_to_cache, build_prompt_pair_bank_from_cache, split_anchors
 
 import torch
 from .BaseSDTrainProcess import BaseSDTrainProcess
@@ -31,10 +30,11 @@ class TrainSliderProcess(BaseSDTrainProcess):
         self.device_torch = torch.device(self.device)
         self.slider_config = SliderConfig(**self.get_conf('slider', {}))
         self.prompt_cache = PromptEmbedsCache()
-        self.prompt_pairs: list[EncodedPromptPair] = []
+        self.prompt_pairs: Optional[PromptPairBank] = None
         self.anchor_pairs: list[EncodedAnchor] = []
         # keep track of prompt chunk size
         self.prompt_chunk_size = 1
+        self.trajectory_bank: Optional[DenoisingTrajectoryBank] = None
 
         # check if we have more targets than steps
         # this can happen because of permutation son shuffling
@@ -104,26 +104,19 @@ class TrainSliderProcess(BaseSDTrainProcess):
                 prompt_tensor_file=self.slider_config.prompt_tensors
             )
 
-            prompt_pairs = []
-            prompt_batches = []
-            for neutral in tqdm(neutral_list, desc="Building Prompt Pairs", leave=False):
-                for target in self.slider_config.targets:
-                    prompt_pair_batch = build_prompt_pair_batch_from_cache(
-                        cache=cache,
-                        target=target,
-                        neutral=neutral,
-
-                    )
-                    if self.slider_config.batch_full_slide:
-                        # concat the prompt pairs
-                        # this allows us to run the entire 4 part process in one shot (for slider)
-                        self.prompt_chunk_size = 4
-                        concat_prompt_pair_batch = concat_prompt_pairs(prompt_pair_batch).to('cpu')
-                        prompt_pairs += [concat_prompt_pair_batch]
-                    else:
-                        self.prompt_chunk_size = 1
-                        # do them one at a time (probably not necessary after new optimizations)
-                        prompt_pairs += [x.to('cpu') for x in prompt_pair_batch]
+            # batch_full_slide runs the entire 4 part process in one shot (for slider)
+            self.prompt_chunk_size = 4 if self.slider_config.batch_full_slide else 1
+            # pack every pair into one table on the device, steps just index into it
+            prompt_pairs = build_prompt_pair_bank_from_cache(
+                cache=cache,
+                targets=self.slider_config.targets,
+                neutral_list=neutral_list,
+                batch_full_slide=self.slider_config.batch_full_slide,
+                num_images=self.train_config.batch_size,
+                device=self.device_torch,
+                dtype=get_torch_dtype(self.train_config.dtype),
+                keep_on_device=self.slider_config.keep_prompts_on_device,
+            )
 
             # setup anchors
             anchor_pairs = []
@@ -169,22 +162,67 @@ class TrainSliderProcess(BaseSDTrainProcess):
         self.prompt_pairs = prompt_pairs
         # self.anchor_pairs = anchor_pairs
         flush()
-        if self.data_loader is not None:
+        if self.data_loader is not None and not self.is_latents_cached:
             # we will have images, prep the vae
             self.sd.vae.eval()
             self.sd.vae.to(self.device_torch)
+
+        if self.slider_config.trajectory_bank is not None and self.data_loader is None:
+            self.trajectory_bank = DenoisingTrajectoryBank(
+                self.slider_config.trajectory_bank,
+                generate_fn=self.generate_trajectory,
+                num_pairs=len(self.prompt_pairs),
+                max_denoising_steps=self.train_config.max_denoising_steps,
+            )
+            self.trajectory_bank.fill(self.step_num)
         # end hook_before_train_loop
 
+    @torch.no_grad()
+    def generate_trajectory(self, pair_idx: int, seed: int, timesteps_to_list: List[int]) -> List[torch.Tensor]:
+        # denoises seeded noise for a prompt pair like a normal step does, keeping the latents at each step
+        dtype = get_torch_dtype(self.train_config.dtype)
+        prompt_pair: PackedPromptPair = self.prompt_pairs[pair_idx]
+        height, width = self.slider_config.resolutions[
+            torch.randint(0, len(self.slider_config.resolutions), (1,)).item()
+        ]
+        # seed the noise without touching the training rng
+        with torch.random.fork_rng(devices=[]):
+            torch.manual_seed(seed)
+            noise = self.sd.get_latent_noise(
+                pixel_height=height,
+                pixel_width=width,
+                batch_size=len(prompt_pair) * self.train_config.batch_size,
+                noise_offset=self.train_config.noise_offset,
+            )
+        latents = noise.to(self.device_torch, dtype=dtype) * self.sd.noise_scheduler.init_noise_sigma
+
+        self.sd.noise_scheduler.set_timesteps(self.train_config.max_denoising_steps, device=self.device_torch)
+        latents_list = []
+        start_timesteps = 0
+        with self.network:
+            assert self.network.is_active
+            self.network.multiplier = prompt_pair.multiplier_list
+            for timesteps_to in timesteps_to_list:
+                latents = self.sd.diffuse_some_steps(
+                    latents,
+                    # unconditional, target
+                    prompt_pair.get_cfg_embeds('positive_target', 'target_class'),
+                    start_timesteps=start_timesteps,
+                    total_timesteps=timesteps_to,
+                    guidance_scale=3,
+                )
+                latents_list.append(latents)
+                start_timesteps = timesteps_to
+        self.sd.noise_scheduler.set_timesteps(1000)
+        self.network.multiplier = 1.0
+        return latents_list
+
     def hook_train_loop(self, batch):
         dtype = get_torch_dtype(self.train_config.dtype)
 
 
-        # get a random pair
-        prompt_pair: EncodedPromptPair = self.prompt_pairs[
-            torch.randint(0, len(self.prompt_pairs), (1,)).item()
-        ]
-        # move to device and dtype
-        prompt_pair.to(self.device_torch, dtype=dtype)
+        # get a random pair, its embeddings are already on the device
+        prompt_pair: PackedPromptPair = self.prompt_pairs.sample()
 
         # get a random resolution
         height, width = self.slider_config.resolutions[
@@ -211,9 +249,17 @@ class TrainSliderProcess(BaseSDTrainProcess):
                 guidance_scale=gs,
             )
 
+        def get_pair_noise_pred(pair: PackedPromptPair, neg_role, pos_role, gs, cts, dn):
+            return self.sd.predict_noise(
+                latents=dn,
+                text_embeddings=pair.get_cfg_embeds(neg_role, pos_role),
+                timestep=cts,
+                guidance_scale=gs,
+            )
+
         with torch.no_grad():
             # for a complete slider, the batch size is 4 to begin with now
-            true_batch_size = prompt_pair.target_class.text_embeds.shape[0] * self.train_config.batch_size
+            true_batch_size = len(prompt_pair) * self.train_config.batch_size
             from_batch = False
             if batch is not None:
                 # traing from a batch of images, not generating ourselves
@@ -223,6 +269,22 @@ class TrainSliderProcess(BaseSDTrainProcess):
                 denoised_latent_chunks = [noisy_latents] * self.prompt_chunk_size
                 denoised_latents = torch.cat(denoised_latent_chunks, dim=0)
                 current_timestep = timesteps
+            elif self.trajectory_bank is not None:
+                self.optimizer.zero_grad()
+
+                # start from latents denoised on an earlier step, regenerating old ones when due
+                self.trajectory_bank.refresh(self.step_num)
+                trajectory_entry = self.trajectory_bank.sample()
+                prompt_pair = self.prompt_pairs[trajectory_entry.pair_idx]
+                timesteps_to = trajectory_entry.timesteps_to
+                denoised_latents = trajectory_entry.latents.to(self.device_torch, dtype=dtype, non_blocking=True)
+
+                noise_scheduler.set_timesteps(1000)
+
+                denoised_latent_chunks = torch.chunk(denoised_latents, self.prompt_chunk_size, dim=0)
+
+                current_timestep_index = int(timesteps_to * 1000 / self.train_config.max_denoising_steps)
+                current_timestep = noise_scheduler.timesteps[current_timestep_index]
             else:
 
                 self.sd.noise_scheduler.set_timesteps(
@@ -255,11 +317,8 @@ class TrainSliderProcess(BaseSDTrainProcess):
                     self.network.multiplier = prompt_pair.multiplier_list
                     denoised_latents = self.sd.diffuse_some_steps(
                         latents,  # pass simple noise latents
-                        train_tools.concat_prompt_embeddings(
-                            prompt_pair.positive_target,  # unconditional
-                            prompt_pair.target_class,  # target
-                            self.train_config.batch_size,
-                        ),
+                        # unconditional, target
+                        prompt_pair.get_cfg_embeds('positive_target', 'target_class'),
                         start_timesteps=0,
                         total_timesteps=timesteps_to,
                         guidance_scale=3,
@@ -277,9 +336,10 @@ class TrainSliderProcess(BaseSDTrainProcess):
             # flush()  # 4.2GB to 3GB on 512x512
 
             # 4.20 GB RAM for 512x512
-            positive_latents = get_noise_pred(
-                prompt_pair.positive_target,  # negative prompt
-                prompt_pair.negative_target,  # positive prompt
+            positive_latents = get_pair_noise_pred(
+                prompt_pair,
+                'positive_target',  # negative prompt
+                'negative_target',  # positive prompt
                 1,
                 current_timestep,
                 denoised_latents
@@ -288,9 +348,10 @@ class TrainSliderProcess(BaseSDTrainProcess):
             positive_latents.requires_grad = False
             positive_latents_chunks = torch.chunk(positive_latents, self.prompt_chunk_size, dim=0)
 
-            neutral_latents = get_noise_pred(
-                prompt_pair.positive_target,  # negative prompt
-                prompt_pair.empty_prompt,  # positive prompt (normally neutral
+            neutral_latents = get_pair_noise_pred(
+                prompt_pair,
+                'positive_target',  # negative prompt
+                'empty_prompt',  # positive prompt (normally neutral
                 1,
                 current_timestep,
                 denoised_latents
@@ -299,9 +360,10 @@ class TrainSliderProcess(BaseSDTrainProcess):
             neutral_latents.requires_grad = False
             neutral_latents_chunks = torch.chunk(neutral_latents, self.prompt_chunk_size, dim=0)
 
-            unconditional_latents = get_noise_pred(
-                prompt_pair.positive_target,  # negative prompt
-                prompt_pair.positive_target,  # positive prompt
+            unconditional_latents = get_pair_noise_pred(
+                prompt_pair,
+                'positive_target',  # negative prompt
+                'positive_target',  # positive prompt
                 1,
                 current_timestep,
                 denoised_latents
@@ -371,7 +433,7 @@ class TrainSliderProcess(BaseSDTrainProcess):
             anchor.to("cpu")
             flush()
 
-        prompt_pair_chunks = split_prompt_pairs(prompt_pair, self.prompt_chunk_size)
+        prompt_pair_chunks = prompt_pair.split(self.prompt_chunk_size)
         assert len(prompt_pair_chunks) == len(denoised_latent_chunks)
         # 3.28 GB RAM for 512x512
         with self.network:
@@ -390,9 +452,10 @@ class TrainSliderProcess(BaseSDTrainProcess):
                 unconditional_latents_chunks,
             ):
                 self.network.multiplier = prompt_pair_chunk.multiplier_list
-                target_latents = get_noise_pred(
-                    prompt_pair_chunk.positive_target,
-                    prompt_pair_chunk.target_class,
+                target_latents = get_pair_noise_pred(
+                    prompt_pair_chunk,
+                    'positive_target',
+                    'target_class',
                     1,
                     current_timestep,
                     denoised_latent_chunk
@@ -402,18 +465,8 @@ class TrainSliderProcess(BaseSDTrainProcess):
 
                 offset = guidance_scale * (positive_latents_chunk - unconditional_latents_chunk)
 
-                # make offset multiplier based on actions
-                offset_multiplier_list = []
-                for action in prompt_pair_chunk.action_list:
-                    if action == ACTION_TYPES_SLIDER.ERASE_NEGATIVE:
-                        offset_multiplier_list += [-1.0]
-                    elif action == ACTION_TYPES_SLIDER.ENHANCE_NEGATIVE:
-                        offset_multiplier_list += [1.0]
-
-                offset_multiplier = torch.tensor(offset_multiplier_list).to(offset.device, dtype=offset.dtype)
-                # make offset multiplier match rank of offset
-                offset_multiplier = offset_multiplier.view(offset.shape[0], 1, 1, 1)
-                offset *= offset_multiplier
+                # offset multiplier based on actions, already shaped to match offset
+                offset *= prompt_pair_chunk.offset_multiplier.to(offset.dtype)
 
                 offset_neutral = neutral_latents_chunk
                 # offsets are already adjusted on a per-batch basis
@@ -423,15 +476,15 @@ class TrainSliderProcess(BaseSDTrainProcess):
                 loss = torch.nn.functional.mse_loss(target_latents.float(), offset_neutral.float(), reduction="none")
                 loss = loss.mean([1, 2, 3])
 
-                if self.train_config.min_snr_gamma is not None and self.train_config.min_snr_gamma > 0.000001:
+                if self.loss_weighting.is_active:
                     if from_batch:
                         # match batch size
-                        loss = apply_snr_weight(loss, timesteps, self.sd.noise_scheduler, self.train_config.min_snr_gamma)
+                        loss = self.loss_weighting(loss, timesteps, self.sd.noise_scheduler)
                     else:
                         # match batch size
                         timesteps_index_list = [current_timestep_index for _ in range(target_latents.shape[0])]
                         # add min_snr_gamma
-                        loss = apply_snr_weight(loss, timesteps_index_list, noise_scheduler, self.train_config.min_snr_gamma)
+                        loss = self.loss_weighting(loss, timesteps_index_list, noise_scheduler)
 
                 loss = loss.mean() * prompt_pair_chunk.weight
 
@@ -455,8 +508,6 @@ class TrainSliderProcess(BaseSDTrainProcess):
             unconditional_latents,
             # latents
         )
-        # move back to cpu
-        prompt_pair.to("cpu")
         flush()
 
         # reset network
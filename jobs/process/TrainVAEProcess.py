@@ -14,7 +14,8 @@ from torchvision.transforms import transforms
 
 from jobs.process import BaseTrainProcess
 from toolkit.kohya_model_util import load_vae, convert_diffusers_back_to_ldm
-from toolkit.data_loader import ImageDataset
+from toolkit.config_modules import DataLoaderConfig
+from toolkit.data_loader import ImageDataset, get_dataloader
 from toolkit.losses import ComparativeTotalVariation, get_gradient_penalty, PatternLoss
 from toolkit.metadata import get_meta_for_safetensors
 from toolkit.optimizer import get_optimizer
@@ -57,6 +58,7 @@ class TrainVAEProcess(BaseTrainProcess):
         self.dtype = self.get_conf('dtype', 'float32')
         self.sample_sources = self.get_conf('sample_sources', None)
         self.log_every = self.get_conf('log_every', 100, as_type=int)
+        self.dataloader_config = DataLoaderConfig(**self.get_conf('dataloader', {}))
         self.style_weight = self.get_conf('style_weight', 0, as_type=float)
         self.content_weight = self.get_conf('content_weight', 0, as_type=float)
         self.kld_weight = self.get_conf('kld_weight', 0, as_type=float)
@@ -130,11 +132,11 @@ class TrainVAEProcess(BaseTrainProcess):
                 datasets.append(image_dataset)
 
             concatenated_dataset = ConcatDataset(datasets)
-            self.data_loader = DataLoader(
+            self.data_loader = get_dataloader(
                 concatenated_dataset,
+                self.dataloader_config,
                 batch_size=self.batch_size,
                 shuffle=True,
-                num_workers=6
             )
 
     def setup_vgg19(self):
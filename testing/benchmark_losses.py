@@ -0,0 +1,127 @@
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from toolkit.llvae import LosslessLatentEncoder
+from toolkit.losses import PatternLoss
+from toolkit.style import ContentLoss, tensor_size
+
+
+# compares the pattern and content losses against the looped versions they replaced,
+# for matching values and speed on cpu
+
+
+class LoopedPatternLoss(torch.nn.Module):
+    def __init__(self, pattern_size=4, dtype=torch.float32):
+        super().__init__()
+        self.pattern_size = pattern_size
+        self.llvae_encoder = LosslessLatentEncoder(3, pattern_size, dtype=dtype)
+        self.llvae_encoder.kernel = self.llvae_encoder.kernel.to('cpu')
+
+    def forward(self, pred, target):
+        pred_latents = self.llvae_encoder(pred)
+        target_latents = self.llvae_encoder(target)
+
+        matrix_pixels = self.pattern_size * self.pattern_size
+
+        color_chans = pred_latents.shape[1] // 3
+        r_chans, g_chans, b_chans = torch.split(pred_latents, [color_chans, color_chans, color_chans], 1)
+        r_chans_target, g_chans_target, b_chans_target = torch.split(
+            target_latents, [color_chans, color_chans, color_chans], 1
+        )
+
+        def separated_chan_loss(latent_chan):
+            chan_mean = torch.mean(latent_chan, dim=[1, 2, 3])
+            chan_splits = torch.split(latent_chan, [1 for i in range(matrix_pixels)], 1)
+            chan_loss = None
+            for chan in chan_splits:
+                this_mean = torch.mean(chan, dim=[1, 2, 3])
+                this_chan_loss = torch.abs(this_mean - chan_mean)
+                if chan_loss is None:
+                    chan_loss = this_chan_loss
+                else:
+                    chan_loss = chan_loss + this_chan_loss
+            chan_loss = chan_loss * (1 / matrix_pixels)
+            return chan_loss
+
+        r_chan_loss = torch.abs(separated_chan_loss(r_chans) - separated_chan_loss(r_chans_target))
+        g_chan_loss = torch.abs(separated_chan_loss(g_chans) - separated_chan_loss(g_chans_target))
+        b_chan_loss = torch.abs(separated_chan_loss(b_chans) - separated_chan_loss(b_chans_target))
+        return (r_chan_loss + g_chan_loss + b_chan_loss) * 0.3333
+
+
+def looped_content_loss(stacked_input):
+    split_size = stacked_input.size()[0] // 2
+    pred_layer, target_layer = torch.split(stacked_input, split_size, dim=0)
+    content_size = tensor_size(pred_layer)
+    diff = torch.abs(pred_layer - target_layer)
+    l2 = torch.sum(diff ** 2, dim=[1, 2, 3], keepdim=True) / 2.0
+    return torch.mean(2. * l2 / content_size, dim=(1, 2, 3), keepdim=True)
+
+
+def benchmark(name, fn, *args, iterations=20):
+    # warm up
+    fn(*args)
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn(*args)
+    elapsed = (time.perf_counter() - start) / iterations
+    print(f" - {name}: {elapsed * 1000:.2f} ms")
+    return elapsed
+
+
+def compare(name, expected, actual):
+    max_diff = torch.max(torch.abs(expected.float() - actual.float())).item()
+    matches = torch.allclose(expected.float(), actual.float(), rtol=1e-4, atol=1e-6)
+    print(f"{name}: max diff {max_diff:.3e} {'OK' if matches else 'MISMATCH'}")
+    return matches
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_size', type=int, default=4)
+    parser.add_argument('--resolution', type=int, default=256)
+    parser.add_argument('--pattern_size', type=int, default=8)
+    parser.add_argument('--iterations', type=int, default=20)
+    args = parser.parse_args()
+
+    torch.manual_seed(42)
+    all_match = True
+
+    pred = torch.rand(args.batch_size, 3, args.resolution, args.resolution)
+    target = torch.rand(args.batch_size, 3, args.resolution, args.resolution)
+    looped_pattern = LoopedPatternLoss(args.pattern_size)
+    pattern = PatternLoss(args.pattern_size)
+    all_match &= compare("PatternLoss", looped_pattern(pred, target), pattern(pred, target))
+    looped_time = benchmark("looped", looped_pattern, pred, target, iterations=args.iterations)
+    new_time = benchmark("vectorized", pattern, pred, target, iterations=args.iterations)
+    print(f" - speedup: {looped_time / new_time:.2f}x")
+
+    # vgg19 feature shapes of the hooked layers at this resolution
+    layer_shapes = [
+        ('conv2_1', 128, args.resolution // 2),
+        ('conv3_1', 256, args.resolution // 4),
+        ('conv4_1', 512, args.resolution // 8),
+    ]
+    content_loss = ContentLoss(single_target=True, device='cpu')
+    for layer_name, channels, size in layer_shapes:
+        stacked = torch.rand(args.batch_size * 2, channels, size, size)
+
+        content_loss(stacked)
+        all_match &= compare(f"ContentLoss {layer_name}", looped_content_loss(stacked), content_loss.loss)
+        looped_time = benchmark("looped", looped_content_loss, stacked, iterations=args.iterations)
+        new_time = benchmark("vectorized", content_loss, stacked, iterations=args.iterations)
+        print(f" - speedup: {looped_time / new_time:.2f}x")
+
+    print("All losses match" if all_match else "Some losses do not match")
+    if not all_match:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,180 @@
+import argparse
+import hashlib
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import torch
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from safetensors.torch import load_file, save_file
+
+from toolkit.meta_init import init_empty_weights, load_model_state_dict
+
+
+# compares building models and loading their weights the normal way against building them on the meta
+# device and assigning the weights, for startup time and peak rss. Uses tiny random models so it runs on cpu.
+# every load runs in its own process so the peak rss of one does not hide the other
+
+
+def get_unet(scale):
+    from diffusers import UNet2DConditionModel
+    return UNet2DConditionModel(
+        sample_size=32,
+        block_out_channels=(32 * scale, 64 * scale),
+        layers_per_block=2,
+        down_block_types=("CrossAttnDownBlock2D", "DownBlock2D"),
+        up_block_types=("UpBlock2D", "CrossAttnUpBlock2D"),
+        cross_attention_dim=32 * scale,
+        attention_head_dim=8,
+    )
+
+
+def get_vae(scale):
+    from diffusers import AutoencoderKL
+    return AutoencoderKL(
+        block_out_channels=(32 * scale, 64 * scale),
+        down_block_types=("DownEncoderBlock2D", "DownEncoderBlock2D"),
+        up_block_types=("UpDecoderBlock2D", "UpDecoderBlock2D"),
+        latent_channels=4,
+    )
+
+
+def get_text_encoder(scale):
+    from transformers import CLIPTextConfig, CLIPTextModel
+    return CLIPTextModel._from_config(CLIPTextConfig(
+        hidden_size=32 * scale,
+        intermediate_size=128 * scale,
+        num_hidden_layers=4,
+        num_attention_heads=4,
+        vocab_size=1000,
+        max_position_embeddings=77,
+    ))
+
+
+def get_lora(scale, text_encoder, unet):
+    from toolkit.lora_special import LoRASpecialNetwork
+    return LoRASpecialNetwork(text_encoder=text_encoder, unet=unet, lora_dim=4 * scale, alpha=1.0)
+
+
+MODELS = {
+    'unet': get_unet,
+    'vae': get_vae,
+    'text_encoder': get_text_encoder,
+}
+
+
+def state_dict_hash(state_dict):
+    hasher = hashlib.sha256()
+    for key in sorted(state_dict.keys()):
+        hasher.update(key.encode('utf-8'))
+        hasher.update(state_dict[key].detach().to('cpu', torch.float32).contiguous().numpy().tobytes())
+    return hasher.hexdigest()
+
+
+def get_rss_mb():
+    # linux reports kilobytes, macos bytes
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss / 1024 / 1024 if sys.platform == 'darwin' else max_rss / 1024
+
+
+def run_load(name, path, scale, on_meta):
+    torch.manual_seed(0)
+    # imports are not part of the load
+    from diffusers import AutoencoderKL, UNet2DConditionModel
+    from transformers import CLIPTextModel
+    with init_empty_weights(on_meta):
+        torch.nn.Linear(1, 1)
+    base_rss = get_rss_mb()
+    start = time.perf_counter()
+    if name == 'lora':
+        # the network needs real modules to attach to, built before timing
+        text_encoder = get_text_encoder(scale)
+        unet = get_unet(scale)
+        base_rss = get_rss_mb()
+        start = time.perf_counter()
+        with init_empty_weights(on_meta):
+            model = get_lora(scale, text_encoder, unet)
+        if on_meta:
+            model.materialize_weights(path)
+            model.apply_to(text_encoder, unet, True, True)
+        else:
+            # the loras are only registered on the network by apply_to
+            model.apply_to(text_encoder, unet, True, True)
+            model.load_weights(path)
+    else:
+        with init_empty_weights(on_meta):
+            model = MODELS[name](scale)
+        load_model_state_dict(model, load_file(path))
+    elapsed = time.perf_counter() - start
+    return {
+        'time': elapsed,
+        'peak_rss': get_rss_mb() - base_rss,
+        'hash': state_dict_hash(model.state_dict()),
+    }
+
+
+def save_model(name, path, scale):
+    torch.manual_seed(42)
+    if name == 'lora':
+        text_encoder = get_text_encoder(scale)
+        unet = get_unet(scale)
+        network = get_lora(scale, text_encoder, unet)
+        network.apply_to(text_encoder, unet, True, True)
+        # the up weights start at zero, give them something to compare
+        for lora in network.get_all_modules():
+            torch.nn.init.normal_(lora.lora_up.weight)
+        network.save_weights(path, torch.float32, None)
+    else:
+        save_file({key: value.contiguous() for key, value in MODELS[name](scale).state_dict().items()}, path)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scale', type=int, default=4, help='multiplies the width of the tiny models')
+    parser.add_argument('--models', type=str, default='unet,vae,text_encoder,lora')
+    # used by the child processes
+    parser.add_argument('--child', type=str, default=None)
+    parser.add_argument('--path', type=str, default=None)
+    parser.add_argument('--on_meta', action='store_true')
+    args = parser.parse_args()
+
+    if args.child is not None:
+        print(json.dumps(run_load(args.child, args.path, args.scale, args.on_meta)))
+        return
+
+    all_match = True
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name in args.models.split(','):
+            path = os.path.join(tmp_dir, f"{name}.safetensors")
+            try:
+                save_model(name, path, args.scale)
+            except ImportError as e:
+                print(f"{name}: skipped, {e}")
+                continue
+            results = {}
+            for on_meta in [False, True]:
+                command = [sys.executable, __file__, '--child', name, '--path', path, '--scale', str(args.scale)]
+                if on_meta:
+                    command.append('--on_meta')
+                output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+                results[on_meta] = json.loads(output.strip().splitlines()[-1])
+            before, after = results[False], results[True]
+            matches = before['hash'] == after['hash']
+            all_match &= matches
+            print(f"{name} ({os.path.getsize(path) / 1024 / 1024:.1f} MB): weights {'match' if matches else 'MISMATCH'}")
+            print(f" - normal: {before['time'] * 1000:.1f} ms, peak rss +{before['peak_rss']:.1f} MB")
+            print(f" - meta:   {after['time'] * 1000:.1f} ms, peak rss +{after['peak_rss']:.1f} MB")
+            print(f" - speedup: {before['time'] / after['time']:.2f}x")
+
+    if not all_match:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
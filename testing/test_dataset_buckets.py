@@ -0,0 +1,60 @@
+import os
+import sys
+import tempfile
+
+import numpy as np
+from PIL import Image
+
+# make sure we can import from the toolkit
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from toolkit.config_modules import DatasetConfig
+from toolkit.data_loader import AiToolkitDataset, get_dataloader_from_datasets
+
+# builds a bucketed dataset from a folder of random images with mixed aspect ratios and indexes every
+# item, then runs an epoch through the bucket sampler. Runs on cpu, with pytest or as a script
+
+IMAGE_SIZES = [(512, 512), (768, 512), (512, 768), (640, 512), (512, 512), (768, 512)]
+
+
+def make_dataset_folder(folder):
+    for idx, (width, height) in enumerate(IMAGE_SIZES):
+        pixels = (np.random.rand(height, width, 3) * 255).astype(np.uint8)
+        Image.fromarray(pixels).save(os.path.join(folder, f"{idx}.png"))
+        with open(os.path.join(folder, f"{idx}.txt"), 'w') as f:
+            f.write(f"caption {idx}")
+
+
+def test_dataset_buckets():
+    with tempfile.TemporaryDirectory() as folder:
+        make_dataset_folder(folder)
+        dataset_config = DatasetConfig(
+            folder_path=folder,
+            resolution=512,
+            caption_type='txt',
+            buckets=True,
+            bucket_tolerance=64,
+        )
+        dataset = AiToolkitDataset(dataset_config, batch_size=2)
+        assert len(dataset) == len(IMAGE_SIZES)
+        assert len(dataset.buckets) == 4
+        assert not dataset.is_caching_latents
+
+        for bucket in dataset.buckets.values():
+            for idx in bucket.file_list_idx:
+                img, prompt, dataset_config_dict = dataset[idx]
+                assert list(img.shape) == [3, bucket.height, bucket.width]
+                assert prompt == f"caption {idx}"
+                assert dataset_config_dict['is_latents'] == 0
+
+        dataloader = get_dataloader_from_datasets([dataset_config], batch_size=2)
+        num_images = 0
+        for imgs, prompts, dataset_config_dicts in dataloader:
+            # every batch is from a single bucket
+            assert imgs.shape[0] == len(prompts) == len(dataset_config_dicts)
+            num_images += imgs.shape[0]
+        assert num_images >= len(IMAGE_SIZES)
+
+
+if __name__ == '__main__':
+    test_dataset_buckets()
+    print('done')
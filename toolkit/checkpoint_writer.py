@@ -0,0 +1,93 @@
+import os
+import queue
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional, Callable
+
+import torch
+
+
+def atomic_save_state_dict(state_dict: 'OrderedDict', file_path: str, metadata: Optional[Dict[str, str]] = None):
+    # write next to the target and rename so a crash never leaves a truncated checkpoint behind
+    if metadata is not None and len(metadata) == 0:
+        metadata = None
+    os.makedirs(os.path.dirname(file_path) or '.', exist_ok=True)
+    tmp_path = file_path + '.tmp'
+    try:
+        if os.path.splitext(file_path)[1] == ".safetensors":
+            from safetensors.torch import save_file
+            save_file(state_dict, tmp_path, metadata)
+        else:
+            torch.save(state_dict, tmp_path)
+        os.replace(tmp_path, file_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+class AsyncCheckpointWriter:
+    """
+    Writes checkpoints on a background thread. The training loop only pays for copying the weights
+    into cpu buffers (pinned when cuda is available), which are reused between saves. Only one save
+    is in flight at a time, a new snapshot waits for the previous write to finish.
+    """
+
+    def __init__(self):
+        self.buffers: Dict[str, torch.Tensor] = {}
+        self.error: Optional[Exception] = None
+        self.queue = queue.Queue(maxsize=1)
+        self.thread = threading.Thread(target=self._run, name='checkpoint_writer', daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None:
+                    return
+                fn, args, kwargs = job
+                fn(*args, **kwargs)
+            except Exception as e:
+                print(f"Error writing checkpoint: {e}")
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _raise_error(self):
+        if self.error is not None:
+            error = self.error
+            self.error = None
+            raise error
+
+    def wait(self):
+        # block until everything submitted has been written
+        self.queue.join()
+        self._raise_error()
+
+    def snapshot(self, state_dict: 'OrderedDict', dtype: Optional[torch.dtype] = None) -> 'OrderedDict':
+        # the buffers are reused, so the last save has to be on disk before we overwrite them
+        self.wait()
+        pin_memory = torch.cuda.is_available()
+        snapshot = OrderedDict()
+        for key, value in state_dict.items():
+            target_dtype = dtype if dtype is not None else value.dtype
+            buffer = self.buffers.get(key, None)
+            if buffer is None or buffer.shape != value.shape or buffer.dtype != target_dtype:
+                buffer = torch.empty(value.shape, dtype=target_dtype, device='cpu', pin_memory=pin_memory)
+                self.buffers[key] = buffer
+            buffer.copy_(value.detach(), non_blocking=pin_memory)
+            snapshot[key] = buffer
+        if pin_memory:
+            # the copies are async, make sure they landed before the writer reads them
+            torch.cuda.synchronize()
+        return snapshot
+
+    def submit(self, fn: Callable, *args, **kwargs):
+        self._raise_error()
+        self.queue.put((fn, args, kwargs))
+
+    def close(self):
+        self.wait()
+        self.queue.put(None)
+        self.thread.join()
+        self.buffers = {}
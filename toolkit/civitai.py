@@ -1,87 +1,108 @@
+from toolkit.downloader import DirectorySource, DownloadSource, HttpSource, download_file
+from toolkit.file_lock import FileLock
 from toolkit.paths import MODELS_PATH
-import requests
 import os
 import json
-import tqdm
+
+
+CIVITAI_URL = 'https://civitai.com'
+
+
+def get_model_source() -> DownloadSource:
+    # CIVITAI_MIRROR can point at a server or directory that stands in for civitai.com
+    mirror = os.environ.get('CIVITAI_MIRROR', None)
+    if mirror is None:
+        return HttpSource()
+    if mirror.startswith('http://') or mirror.startswith('https://'):
+        return HttpSource(base_url=mirror)
+    return DirectorySource(mirror)
 
 
 class ModelCache:
     def __init__(self):
         self.raw_cache = {}
         self.cache_path = os.path.join(MODELS_PATH, '.ai_toolkit_cache.json')
+        self.lock_path = self.cache_path + '.lock'
+        self.raw_cache = self._load()['models']
+
+    def _load(self) -> dict:
+        all_cache = {'models': {}}
         if os.path.exists(self.cache_path):
             with open(self.cache_path, 'r') as f:
                 all_cache = json.load(f)
-                if 'models' in all_cache:
-                    self.raw_cache = all_cache['models']
-                else:
-                    self.raw_cache = all_cache
+            if 'models' not in all_cache:
+                all_cache = {'models': all_cache}
+        return all_cache
+
+    def _update(self, update_fn):
+        # other jobs may have changed the cache since we read it, so reload, apply our change and
+        # write it back while holding the lock
+        with FileLock(self.lock_path):
+            all_cache = self._load()
+            update_fn(all_cache['models'])
+            tmp_path = self.cache_path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(all_cache, f, indent=2)
+            os.replace(tmp_path, self.cache_path)
+            self.raw_cache = all_cache['models']
+
+    def _remove_version(self, model_id: int, model_version_id: int):
+        def remove(models: dict):
+            if str(model_version_id) in models.get(str(model_id), {}):
+                del models[str(model_id)][str(model_version_id)]
+
+        self._update(remove)
 
     def get_model_path(self, model_id: int, model_version_id: int = None):
-        if str(model_id) not in self.raw_cache:
+        if str(model_id) not in self.raw_cache or len(self.raw_cache[str(model_id)]) == 0:
             return None
         if model_version_id is None:
             # get latest version
             model_version_id = max([int(x) for x in self.raw_cache[str(model_id)].keys()])
-            if model_version_id is None:
-                return None
-            model_path = self.raw_cache[str(model_id)][str(model_version_id)]['model_path']
-            # check if model path exists
-            if not os.path.exists(model_path):
-                # remove version from cache
-                del self.raw_cache[str(model_id)][str(model_version_id)]
-                self.save()
-                return None
-            return model_path
-        else:
-            if str(model_version_id) not in self.raw_cache[str(model_id)]:
-                return None
-            model_path = self.raw_cache[str(model_id)][str(model_version_id)]['model_path']
-            # check if model path exists
-            if not os.path.exists(model_path):
-                # remove version from cache
-                del self.raw_cache[str(model_id)][str(model_version_id)]
-                self.save()
-                return None
-            return model_path
-
-    def update_cache(self, model_id: int, model_version_id: int, model_path: str):
-        if str(model_id) not in self.raw_cache:
-            self.raw_cache[str(model_id)] = {}
         if str(model_version_id) not in self.raw_cache[str(model_id)]:
-            self.raw_cache[str(model_id)][str(model_version_id)] = {}
-        self.raw_cache[str(model_id)][str(model_version_id)] = {
-            'model_path': model_path
-        }
-        self.save()
+            return None
+        model_path = self.raw_cache[str(model_id)][str(model_version_id)]['model_path']
+        # check if model path exists
+        if not os.path.exists(model_path):
+            # remove version from cache
+            self._remove_version(model_id, model_version_id)
+            return None
+        return model_path
+
+    def update_cache(self, model_id: int, model_version_id: int, model_path: str, sha256: str = None):
+        def update(models: dict):
+            if str(model_id) not in models:
+                models[str(model_id)] = {}
+            models[str(model_id)][str(model_version_id)] = {
+                'model_path': model_path,
+                'sha256': sha256,
+            }
+
+        self._update(update)
 
     def save(self):
-        if not os.path.exists(os.path.dirname(self.cache_path)):
-            os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
-        all_cache = {'models': {}}
-        if os.path.exists(self.cache_path):
-            # load it first
-            with open(self.cache_path, 'r') as f:
-                all_cache = json.load(f)
+        # writes our entries over the ones on disk, keeping entries other jobs added
+        raw_cache = self.raw_cache
 
-        all_cache['models'] = self.raw_cache
+        def merge(models: dict):
+            for model_id, versions in raw_cache.items():
+                models.setdefault(model_id, {}).update(versions)
 
-        with open(self.cache_path, 'w') as f:
-            json.dump(all_cache, f, indent=2)
+        self._update(merge)
 
 
-def get_model_download_info(model_id: int, model_version_id: int = None):
+def get_model_download_info(model_id: int, model_version_id: int = None, source: DownloadSource = None):
     # curl https://civitai.com/api/v1/models?limit=3&types=TextualInversion \
     # -H "Content-Type: application/json" \
     # -X GET
     print(
         f"Getting model info for model id: {model_id}{f' and version id: {model_version_id}' if model_version_id is not None else ''}")
-    endpoint = f"https://civitai.com/api/v1/models/{model_id}"
+    endpoint = f"{CIVITAI_URL}/api/v1/models/{model_id}"
+    if source is None:
+        source = get_model_source()
 
     # get the json
-    response = requests.get(endpoint)
-    response.raise_for_status()
-    model_data = response.json()
+    model_data = source.get_json(endpoint)
 
     model_version = None
 
@@ -170,45 +191,21 @@ def get_model_path_from_url(url: str):
     if model_path is not None:
         return model_path
     else:
-        # download model
-        file_info, model_version_id = get_model_download_info(model_id, query_params.get('modelVersionId', None))
+        source = get_model_source()
+        file_info, model_version_id = get_model_download_info(
+            model_id, query_params.get('modelVersionId', None), source=source
+        )
 
-        download_url = file_info['downloadUrl']  # url does not work directly
-        size_kb = file_info['sizeKB']
+        download_url = file_info['downloadUrl']
         filename = file_info['name']
+        sha256 = file_info.get('hashes', {}).get('SHA256', None)
         model_path = os.path.join(MODELS_PATH, filename)
 
         # download model
         print(f"Did not find model locally, downloading from model from: {download_url}")
-
-        # use tqdm to show status of downlod
-        response = requests.get(download_url, stream=True)
-        response.raise_for_status()
-        total_size_in_bytes = int(response.headers.get('content-length', 0))
-        block_size = 1024  # 1 Kibibyte
-        progress_bar = tqdm.tqdm(total=total_size_in_bytes, unit='iB', unit_scale=True)
-        tmp_path = os.path.join(MODELS_PATH, f".download_tmp_{filename}")
-        os.makedirs(os.path.dirname(model_path), exist_ok=True)
-        # remove tmp file if it exists
-        if os.path.exists(tmp_path):
-            os.remove(tmp_path)
-
-        try:
-
-            with open(tmp_path, 'wb') as f:
-                for data in response.iter_content(block_size):
-                    progress_bar.update(len(data))
-                    f.write(data)
-                progress_bar.close()
-                # move to final path
-                os.rename(tmp_path, model_path)
-                model_cache.update_cache(model_id, model_version_id, model_path)
-
-                return model_path
-        except Exception as e:
-            # remove tmp file
-            os.remove(tmp_path)
-            raise e
+        download_file(download_url, model_path, source=source, sha256=sha256)
+        model_cache.update_cache(model_id, model_version_id, model_path, sha256=sha256)
+        return model_path
 
 
 # if is main
@@ -1,6 +1,6 @@
 import os
 import time
-from typing import List, Optional, Literal
+from typing import List, Optional, Literal, Dict
 import random
 
 
@@ -9,6 +9,8 @@ class SaveConfig:
         self.save_every: int = kwargs.get('save_every', 1000)
         self.dtype: str = kwargs.get('save_dtype', 'float16')
         self.max_step_saves_to_keep: int = kwargs.get('max_step_saves_to_keep', 5)
+        # copy the weights to cpu and write them on a background thread so training keeps going
+        self.async_save: bool = kwargs.get('async_save', False)
 
 
 class LogingConfig:
@@ -31,6 +33,8 @@ class SampleConfig:
         self.sample_steps = kwargs.get('sample_steps', 20)
         self.network_multiplier = kwargs.get('network_multiplier', 1)
         self.guidance_rescale = kwargs.get('guidance_rescale', 0.0)
+        # images with the same size and settings are generated together, lower this if sampling runs out of vram
+        self.batch_size: int = kwargs.get('batch_size', 4)
 
 
 class NetworkConfig:
@@ -73,6 +77,13 @@ class TrainConfig:
         self.train_unet = kwargs.get('train_unet', True)
         self.train_text_encoder = kwargs.get('train_text_encoder', True)
         self.min_snr_gamma = kwargs.get('min_snr_gamma', None)
+        # none, min_snr, min_snr_v, debiased or custom. defaults to min_snr when min_snr_gamma is set
+        default_loss_weighting = 'none'
+        if self.min_snr_gamma is not None and self.min_snr_gamma > 0.000001:
+            default_loss_weighting = 'min_snr'
+        self.loss_weighting: str = kwargs.get('loss_weighting', default_loss_weighting)
+        # weights for the custom loss weighting, spread evenly from the first to the last timestep
+        self.loss_weight_curve: Optional[List[float]] = kwargs.get('loss_weight_curve', None)
         self.noise_offset = kwargs.get('noise_offset', 0.0)
         self.optimizer_params = kwargs.get('optimizer_params', {})
         self.skip_first_sample = kwargs.get('skip_first_sample', False)
@@ -94,6 +105,21 @@ class ModelConfig:
         self.use_text_encoder_1: bool = kwargs.get('use_text_encoder_1', True)
         self.use_text_encoder_2: bool = kwargs.get('use_text_encoder_2', True)
 
+        # number of prompt embeddings to keep on device / offloaded to cpu when the text encoder is frozen
+        # set text_embedding_cache_size to 0 to disable
+        self.text_embedding_cache_size: int = kwargs.get('text_embedding_cache_size', 256)
+        self.text_embedding_cpu_cache_size: int = kwargs.get('text_embedding_cpu_cache_size', 2048)
+        # folder to keep prompt embeddings in between runs, keyed by the text encoder weights and prompt
+        self.prompt_embeds_store: Optional[str] = kwargs.get('prompt_embeds_store', None)
+        # folder to keep single file checkpoints and vaes in, converted to diffusers in this dtype, so
+        # later loads skip the conversion. Keyed by the checkpoint sha256, dtype and diffusers version. Each
+        # checkpoint is hashed once, again only when its size or mtime changes
+        self.converted_model_cache: Optional[str] = kwargs.get('converted_model_cache', None)
+        # build the models converted from single file checkpoints, and the network when resuming, on the meta
+        # device and load the weights straight into them instead of allocating and randomly initializing
+        # weights that get overwritten. Diffusers folders use the diffusers loading either way
+        self.low_cpu_mem_usage: bool = kwargs.get('low_cpu_mem_usage', False)
+
         if self.name_or_path is None:
             raise ValueError('name_or_path must be specified')
 
@@ -133,6 +159,21 @@ class SliderConfigAnchors:
         self.multiplier = kwargs.get('multiplier', 1.0)
 
 
+class TrajectoryBankConfig:
+    def __init__(self, **kwargs):
+        # number of denoising trajectories kept
+        self.size: int = kwargs.get('size', 16)
+        # latents saved along each trajectory, at random denoising steps
+        self.timesteps_per_trajectory: int = kwargs.get('timesteps_per_trajectory', 4)
+        # trajectories older than this many steps are regenerated, 0 never regenerates them
+        self.max_age: int = kwargs.get('max_age', 100)
+        # regenerate up to refresh_count stale trajectories every refresh_every steps
+        self.refresh_every: int = kwargs.get('refresh_every', 10)
+        self.refresh_count: int = kwargs.get('refresh_count', 1)
+        # folder to keep the latents in, they are kept in pinned cpu memory if not set
+        self.cache_dir: Optional[str] = kwargs.get('cache_dir', None)
+
+
 class SliderConfig:
     def __init__(self, **kwargs):
         targets = kwargs.get('targets', [])
@@ -143,6 +184,12 @@ class SliderConfig:
         self.prompt_file: str = kwargs.get('prompt_file', None)
         self.prompt_tensors: str = kwargs.get('prompt_tensors', None)
         self.batch_full_slide: bool = kwargs.get('batch_full_slide', True)
+        # keep the packed prompt pair embeddings on the training device, else in pinned cpu memory
+        self.keep_prompts_on_device: bool = kwargs.get('keep_prompts_on_device', True)
+        # reuse denoised latents across steps instead of denoising from noise every step
+        trajectory_bank = kwargs.get('trajectory_bank', None)
+        self.trajectory_bank: Optional[TrajectoryBankConfig] = TrajectoryBankConfig(
+            **trajectory_bank) if trajectory_bank is not None else None
 
         # expand targets if shuffling
         from toolkit.prompt_utils import get_slider_target_permutations
@@ -171,7 +218,57 @@ class DatasetConfig:
         self.scale: float = kwargs.get('scale', 1.0)
         self.buckets: bool = kwargs.get('buckets', False)
         self.bucket_tolerance: int = kwargs.get('bucket_tolerance', 64)
+        # what to do with the ragged end of a bucket. fill: top it up with other images from the bucket,
+        # drop: skip it, keep: train on the partial batch
+        self.bucket_remainder: Literal['fill', 'drop', 'keep'] = kwargs.get('bucket_remainder', 'fill')
+        # spread each bucket's batches evenly over the epoch based on how common its aspect ratio is
+        self.bucket_balance: bool = kwargs.get('bucket_balance', False)
         self.is_reg: bool = kwargs.get('is_reg', False)
+        # encode each image once and keep the latent mean / std on disk next to the dataset
+        self.cache_latents: bool = kwargs.get('cache_latents', False)
+        self.latent_cache_shard_size: int = kwargs.get('latent_cache_shard_size', 512)
+
+
+class DataLoaderConfig:
+    def __init__(self, **kwargs):
+        # None picks a worker count from the number of cpus
+        self.num_workers: Optional[int] = kwargs.get('num_workers', None)
+        # None pins memory when training on cuda
+        self.pin_memory: Optional[bool] = kwargs.get('pin_memory', None)
+        self.prefetch_factor: int = kwargs.get('prefetch_factor', 2)
+        # keep the workers alive between epochs instead of forking new ones
+        self.persistent_workers: bool = kwargs.get('persistent_workers', True)
+        self.max_auto_workers: int = kwargs.get('max_auto_workers', 8)
+
+    def get_num_workers(self) -> int:
+        if self.num_workers is not None:
+            return self.num_workers
+        # leave a core for the training loop
+        return max(0, min(self.max_auto_workers, (os.cpu_count() or 1) - 1))
+
+    def get_pin_memory(self) -> bool:
+        if self.pin_memory is not None:
+            return self.pin_memory
+        import torch
+        return torch.cuda.is_available()
+
+
+class MergeModelConfig:
+    def __init__(self, **kwargs):
+        # a safetensors checkpoint or lora
+        self.path: str = kwargs.get('path', kwargs.get('name_or_path', None))
+        self.weight: float = kwargs.get('weight', 1.0)
+        # overrides the weight per block. IN00-IN11, M00, OUT00-OUT11, UNET for the rest of the unet
+        # and BASE for the text encoders
+        self.block_weights: Dict[str, float] = kwargs.get('block_weights', {})
+
+        if self.path is None:
+            raise ValueError('path is required for a merge model')
+
+    def get_weight(self, block_name: Optional[str] = None) -> float:
+        if block_name is not None and block_name in self.block_weights:
+            return self.block_weights[block_name]
+        return self.weight
 
 
 class GenerateImageConfig:
@@ -0,0 +1,123 @@
+import hashlib
+import json
+import os
+import shutil
+import uuid
+from collections import OrderedDict
+from typing import Callable, Optional, TypeVar
+
+import torch
+
+from toolkit.file_lock import FileLock
+
+CONVERTED_INFO_FILE = 'ai_toolkit_converted.json'
+CONVERTED_CACHE_VERSION = 1
+# sha256 of every checkpoint seen, so each one is only hashed once
+CHECKPOINT_HASH_INDEX_FILE = 'checkpoint_hashes.json'
+
+ModelT = TypeVar('ModelT')
+
+
+def get_checkpoint_hash(cache_root: str, path: str) -> str:
+    # the whole file is hashed, any changed weight gives a new cache entry. Hashing takes a while
+    # so the result is kept in an index in cache_root until the file size or mtime changes
+    index_path = os.path.join(cache_root, CHECKPOINT_HASH_INDEX_FILE)
+    abs_path = os.path.abspath(path)
+    stat = os.stat(path)
+    index_key = f"{abs_path}|{stat.st_size}|{stat.st_mtime_ns}"
+
+    def load_index() -> dict:
+        if not os.path.exists(index_path):
+            return {}
+        try:
+            with open(index_path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    checkpoint_hash = load_index().get(index_key, None)
+    if checkpoint_hash is not None:
+        return checkpoint_hash
+
+    print(f"Hashing {path}")
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for data in iter(lambda: f.read(8 * 1024 * 1024), b''):
+            hasher.update(data)
+    checkpoint_hash = hasher.hexdigest()
+    with FileLock(index_path + '.lock'):
+        # other jobs may have added entries since it was read. Older entries for this path are stale
+        index = {key: value for key, value in load_index().items() if key.rsplit('|', 2)[0] != abs_path}
+        index[index_key] = checkpoint_hash
+        tmp_path = f"{index_path}.tmp_{uuid.uuid4().hex}"
+        with open(tmp_path, 'w') as f:
+            json.dump(index, f, indent=2)
+        os.replace(tmp_path, index_path)
+    return checkpoint_hash
+
+
+def get_converted_model_dir(cache_root: str, checkpoint_path: str, dtype: torch.dtype, **options) -> str:
+    import diffusers
+    key_dict = OrderedDict({
+        'version': CONVERTED_CACHE_VERSION,
+        'checkpoint_hash': get_checkpoint_hash(cache_root, checkpoint_path),
+        'dtype': str(dtype),
+        # the conversion changes between diffusers versions
+        'diffusers': diffusers.__version__,
+        **options,
+    })
+    key = hashlib.sha256(json.dumps(key_dict, sort_keys=True).encode('utf-8')).hexdigest()
+    name = os.path.splitext(os.path.basename(checkpoint_path))[0]
+    return os.path.join(cache_root, f"{name}_{key[:16]}")
+
+
+def is_converted(model_dir: str) -> bool:
+    return os.path.exists(os.path.join(model_dir, CONVERTED_INFO_FILE))
+
+
+def save_converted(model, model_dir: str, checkpoint_path: str, dtype: torch.dtype):
+    """
+    Saves a converted diffusers model or pipeline, with save_pretrained, into model_dir. Written to a
+    temp folder first and moved in place, so a cache folder is always complete. Does nothing if another
+    job saved it first.
+    """
+    with FileLock(model_dir + '.lock'):
+        if is_converted(model_dir):
+            return
+        print(f"Caching converted model to {model_dir}")
+        tmp_dir = f"{model_dir}.tmp_{uuid.uuid4().hex}"
+        try:
+            model.save_pretrained(tmp_dir, safe_serialization=True)
+            with open(os.path.join(tmp_dir, CONVERTED_INFO_FILE), 'w') as f:
+                json.dump({'checkpoint_path': os.path.abspath(checkpoint_path), 'dtype': str(dtype)}, f, indent=2)
+            if os.path.exists(model_dir):
+                # left over from an interrupted save
+                shutil.rmtree(model_dir)
+            os.replace(tmp_dir, model_dir)
+        finally:
+            if os.path.exists(tmp_dir):
+                shutil.rmtree(tmp_dir)
+
+
+def load_converted_or_convert(
+        cache_root: Optional[str],
+        checkpoint_path: str,
+        dtype: torch.dtype,
+        convert_fn: Callable[[], ModelT],
+        load_fn: Callable[[str], ModelT],
+        **options,
+) -> ModelT:
+    """
+    Loads a single file checkpoint through the converted model cache. load_fn loads the cached diffusers
+    folder, convert_fn does the slow conversion from the checkpoint, its result is cached for next time.
+    options are anything else the conversion depends on.
+    """
+    if cache_root is None or not os.path.isfile(checkpoint_path):
+        return convert_fn()
+    model_dir = get_converted_model_dir(cache_root, checkpoint_path, dtype, **options)
+    if is_converted(model_dir):
+        print(f"Loading converted model from {model_dir}")
+        return load_fn(model_dir)
+    model = convert_fn()
+    save_converted(model, model_dir, checkpoint_path, dtype)
+    return model
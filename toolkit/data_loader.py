@@ -1,6 +1,9 @@
+import hashlib
+import json
 import os
 import random
-from typing import List
+from collections import OrderedDict
+from typing import List, Dict, Iterator, Union, TYPE_CHECKING
 
 import cv2
 import numpy as np
@@ -8,13 +11,18 @@ import torch
 from PIL import Image
 from PIL.ImageOps import exif_transpose
 from torchvision import transforms
-from torch.utils.data import Dataset, DataLoader, ConcatDataset
-from tqdm import tqdm
+from torch.utils.data import Dataset, DataLoader, ConcatDataset, Sampler
 import albumentations as A
+from safetensors import safe_open
+from tqdm import tqdm
+
+from toolkit.config_modules import DatasetConfig, DataLoaderConfig
+from toolkit.dataset_manifest import get_dataset_manifest
+from toolkit.dataloader_mixins import CaptionMixin, BucketsMixin, LatentCachingMixin, LATENT_CACHE_FOLDER, \
+    get_vae_hash
 
-from toolkit import image_utils
-from toolkit.config_modules import DatasetConfig
-from toolkit.dataloader_mixins import CaptionMixin, BucketsMixin
+if TYPE_CHECKING:
+    from toolkit.stable_diffusion_model import StableDiffusion
 
 
 class ImageDataset(Dataset, CaptionMixin):
@@ -34,17 +42,17 @@ class ImageDataset(Dataset, CaptionMixin):
         self.random_crop = self.random_scale if self.random_scale else self.get_config('random_crop', False)
 
         self.resolution = self.get_config('resolution', 256)
-        self.file_list = [os.path.join(self.path, file) for file in os.listdir(self.path) if
-                          file.lower().endswith(('.jpg', '.jpeg', '.png', '.webp'))]
 
-        # this might take a while
+        # dimensions come from the manifest, only new or changed images are read
         print(f"  -  Preprocessing image dimensions")
+        manifest_items = get_dataset_manifest(self.path)
+        self.file_list = [item.path for item in manifest_items]
+
         new_file_list = []
         bad_count = 0
-        for file in tqdm(self.file_list):
-            img = Image.open(file)
-            if int(min(img.size) * self.scale) >= self.resolution:
-                new_file_list.append(file)
+        for item in manifest_items:
+            if int(min(item.width, item.height) * self.scale) >= self.resolution:
+                new_file_list.append(item.path)
             else:
                 bad_count += 1
 
@@ -158,7 +166,7 @@ class AugmentedImageDataset(ImageDataset):
         return transforms.ToTensor()(pil_image), transforms.ToTensor()(augmented)
 
 
-class PairedImageDataset(Dataset):
+class PairedImageDataset(Dataset, LatentCachingMixin):
     def __init__(self, config):
         super().__init__()
         self.config = config
@@ -205,6 +213,10 @@ class PairedImageDataset(Dataset):
             transforms.Normalize([0.5], [0.5]),  # normalize to [-1, 1]
         ])
 
+        # set by cache_latents_all_latents
+        self.latent_cache_keys: List[str] = []
+        self.latent_cache_files: List[str] = []
+
     def get_all_prompts(self):
         prompts = []
         for index in range(len(self.file_list)):
@@ -257,7 +269,7 @@ class PairedImageDataset(Dataset):
             prompt = self.default_prompt
         return prompt
 
-    def __getitem__(self, index):
+    def load_image_tensor(self, index):
         img_path_or_tuple = self.file_list[index]
         if isinstance(img_path_or_tuple, tuple):
             # load both images
@@ -273,8 +285,6 @@ class PairedImageDataset(Dataset):
             img_path = img_path_or_tuple
             img = exif_transpose(Image.open(img_path)).convert('RGB')
 
-        prompt = self.get_prompt_item(index)
-
         height = self.size
         # determine width to keep aspect ratio
         width = int(img.size[0] * height / img.size[1])
@@ -282,6 +292,78 @@ class PairedImageDataset(Dataset):
         # Downscale the source image first
         img = img.resize((width, height), Image.BICUBIC)
         img = self.transform(img)
+        return img
+
+    def get_latent_cache_dir(self) -> str:
+        folder = self.path if self.path is not None else self.pos_folder
+        return os.path.join(folder, LATENT_CACHE_FOLDER)
+
+    def get_pair_latent_cache_key(self, index, vae_hash: str, dtype: torch.dtype) -> str:
+        img_path_or_tuple = self.file_list[index]
+        paths = img_path_or_tuple if isinstance(img_path_or_tuple, tuple) else (img_path_or_tuple,)
+        key_dict = OrderedDict({
+            'paths': [os.path.abspath(path) for path in paths],
+            'mtimes': [os.path.getmtime(path) for path in paths],
+            'size': self.size,
+            'vae_hash': vae_hash,
+            'dtype': str(dtype),
+        })
+        return hashlib.sha256(json.dumps(key_dict).encode('utf-8')).hexdigest()
+
+    @torch.no_grad()
+    def cache_latents_all_latents(self, sd: 'StableDiffusion', shard_size: int = 256) -> bool:
+        # the pairs never change, so each one is encoded once. The mean and std of the
+        # negative and positive halves are stored stacked, negative first
+        cache_dir = self.get_latent_cache_dir()
+        os.makedirs(cache_dir, exist_ok=True)
+        index = self._load_latent_cache_index()
+
+        vae_hash = get_vae_hash(sd.vae)
+        dtype = sd.torch_dtype
+
+        self.latent_cache_keys = [self.get_pair_latent_cache_key(i, vae_hash, dtype) for i in range(len(self))]
+        to_encode = [
+            i for i, key in enumerate(self.latent_cache_keys)
+            if key not in index['latents'] or not os.path.exists(os.path.join(cache_dir, index['latents'][key]))
+        ]
+        print(f"  -  Found {len(self) - len(to_encode)} cached pair latents, encoding {len(to_encode)}")
+
+        if len(to_encode) > 0:
+            shard_state_dict = OrderedDict()
+            for i in tqdm(to_encode, desc="Caching pair latents", leave=False):
+                negative_image, positive_image = torch.chunk(self.load_image_tensor(i), 2, dim=2)
+                # both halves in one vae call
+                mean, std = sd.encode_images_to_latent_dist([negative_image, positive_image], device='cpu', dtype=dtype)
+                shard_state_dict[f"{self.latent_cache_keys[i]}.mean"] = mean.clone().contiguous()
+                shard_state_dict[f"{self.latent_cache_keys[i]}.std"] = std.clone().contiguous()
+                if len(shard_state_dict) // 2 >= shard_size:
+                    self._write_latent_shard(index, shard_state_dict)
+                    shard_state_dict = OrderedDict()
+            if len(shard_state_dict) > 0:
+                self._write_latent_shard(index, shard_state_dict)
+
+        self.latent_cache_files = [os.path.join(cache_dir, index['latents'][key]) for key in self.latent_cache_keys]
+        self.latent_scaling_factor = sd.vae.config['scaling_factor']
+        self.is_caching_latents = True
+        return True
+
+    def get_cached_pair_latents(self, index) -> torch.Tensor:
+        cache_file = self.latent_cache_files[index]
+        if cache_file not in self.latent_shard_handles:
+            self.latent_shard_handles[cache_file] = safe_open(cache_file, framework='pt', device='cpu')
+        handle = self.latent_shard_handles[cache_file]
+        mean = handle.get_tensor(f"{self.latent_cache_keys[index]}.mean").float()
+        std = handle.get_tensor(f"{self.latent_cache_keys[index]}.std").float()
+        latents = mean + std * torch.randn_like(mean)
+        return latents * self.latent_scaling_factor
+
+    def __getitem__(self, index):
+        prompt = self.get_prompt_item(index)
+        if self.is_caching_latents:
+            # negative and positive latents, stacked on the first dim
+            img = self.get_cached_pair_latents(index)
+        else:
+            img = self.load_image_tensor(index)
 
         return img, prompt, (self.neg_weight, self.pos_weight)
 
@@ -309,9 +391,13 @@ class FileItem:
         self.crop_y = kwargs.get('crop_y', 0)
         self.crop_width = kwargs.get('crop_width', self.scale_to_width)
         self.crop_height = kwargs.get('crop_height', self.scale_to_height)
+        self.caption_hash = kwargs.get('caption_hash', None)
+        # set when latents are cached
+        self.latent_cache_key = None
+        self.latent_cache_file = None
 
 
-class AiToolkitDataset(Dataset, CaptionMixin, BucketsMixin):
+class AiToolkitDataset(Dataset, CaptionMixin, BucketsMixin, LatentCachingMixin):
 
     def __init__(self, dataset_config: 'DatasetConfig', batch_size=1):
         super().__init__()
@@ -327,31 +413,20 @@ class AiToolkitDataset(Dataset, CaptionMixin, BucketsMixin):
         self.resolution = dataset_config.resolution
         self.file_list: List['FileItem'] = []
 
-        # get the file list
-        file_list = [
-            os.path.join(self.folder_path, file) for file in os.listdir(self.folder_path) if
-            file.lower().endswith(('.jpg', '.jpeg', '.png', '.webp'))
-        ]
-
-        # this might take a while
+        # dimensions come from the manifest, only new or changed images are read
         print(f"  -  Preprocessing image dimensions")
         bad_count = 0
-        for file in tqdm(file_list):
-            try:
-                w, h = image_utils.get_image_size(file)
-            except image_utils.UnknownImageFormat:
-                print_once(f'Warning: Some images in the dataset cannot be fast read. ' + \
-                           f'This process is faster for png, jpeg')
-                img = Image.open(file)
-                h, w = img.size
+        for item in get_dataset_manifest(self.folder_path):
+            w, h = item.width, item.height
             if int(min(h, w) * self.scale) >= self.resolution:
                 self.file_list.append(
                     FileItem(
-                        path=file,
+                        path=item.path,
                         width=w,
                         height=h,
                         scale_to_width=int(w * self.scale),
                         scale_to_height=int(h * self.scale),
+                        caption_hash=item.caption_hash,
                     )
                 )
             else:
@@ -371,11 +446,9 @@ class AiToolkitDataset(Dataset, CaptionMixin, BucketsMixin):
         ])
 
     def __len__(self):
-        if self.dataset_config.buckets:
-            return len(self.batch_indices)
         return len(self.file_list)
 
-    def _get_single_item(self, index):
+    def load_image_tensor(self, index):
         file_item = self.file_list[index]
         # todo make sure this matches
         img = exif_transpose(Image.open(file_item.path)).convert('RGB')
@@ -414,10 +487,19 @@ class AiToolkitDataset(Dataset, CaptionMixin, BucketsMixin):
                 img = img.resize((self.resolution, self.resolution), Image.BICUBIC)
 
         img = self.transform(img)
+        return img
+
+    def _get_single_item(self, index):
+        file_item = self.file_list[index]
+        if self.is_caching_latents:
+            img = self.get_cached_latent(file_item)
+        else:
+            img = self.load_image_tensor(index)
 
         # todo convert it all
         dataset_config_dict = {
             "is_reg": 1 if self.dataset_config.is_reg else 0,
+            "is_latents": 1 if self.is_caching_latents else 0,
         }
 
         if self.caption_type is not None:
@@ -427,33 +509,124 @@ class AiToolkitDataset(Dataset, CaptionMixin, BucketsMixin):
             return img, dataset_config_dict
 
     def __getitem__(self, item):
-        if self.dataset_config.buckets:
-            # we collate ourselves
-            idx_list = self.batch_indices[item]
-            tensor_list = []
-            prompt_list = []
-            dataset_config_dict_list = []
-            for idx in idx_list:
-                if self.caption_type is not None:
-                    img, prompt, dataset_config_dict = self._get_single_item(idx)
-                    prompt_list.append(prompt)
-                    dataset_config_dict_list.append(dataset_config_dict)
-                else:
-                    img, dataset_config_dict = self._get_single_item(idx)
-                    dataset_config_dict_list.append(dataset_config_dict)
-                tensor_list.append(img.unsqueeze(0))
+        # batches are built by the dataloader, or the BucketBatchSampler when using buckets
+        return self._get_single_item(item)
+
+
+class BucketBatchSampler(Sampler):
+    """
+    Yields batches of indices into a ConcatDataset of AiToolkitDatasets where every batch comes from a
+    single bucket. Buckets with the same resolution are merged across datasets and reshuffled every epoch.
+    """
+
+    def __init__(
+            self,
+            concatenated_dataset: ConcatDataset,
+            batch_size: int = 1,
+            remainder: str = 'fill',
+            balance: bool = False,
+    ):
+        if remainder not in ['fill', 'drop', 'keep']:
+            raise ValueError(f"invalid bucket_remainder: {remainder}")
+        self.batch_size = batch_size
+        self.remainder = remainder
+        self.balance = balance
+
+        # global indices for each resolution
+        self.buckets: Dict[str, List[int]] = OrderedDict()
+        for dataset_idx, dataset in enumerate(concatenated_dataset.datasets):
+            offset = concatenated_dataset.cumulative_sizes[dataset_idx - 1] if dataset_idx > 0 else 0
+            for key, bucket in dataset.buckets.items():
+                if key not in self.buckets:
+                    self.buckets[key] = []
+                self.buckets[key] += [offset + idx for idx in bucket.file_list_idx]
 
-            if self.caption_type is not None:
-                return torch.cat(tensor_list, dim=0), prompt_list, dataset_config_dict_list
-            else:
-                return torch.cat(tensor_list, dim=0), dataset_config_dict_list
+    def __len__(self):
+        num_batches = 0
+        for indices in self.buckets.values():
+            num_batches += len(indices) // self.batch_size
+            if len(indices) % self.batch_size != 0 and self.remainder != 'drop':
+                num_batches += 1
+        return num_batches
+
+    def _get_bucket_batches(self, indices: List[int], generator: torch.Generator) -> List[List[int]]:
+        shuffled = [indices[i] for i in torch.randperm(len(indices), generator=generator).tolist()]
+        num_full = len(shuffled) // self.batch_size * self.batch_size
+        batches = [shuffled[i:i + self.batch_size] for i in range(0, num_full, self.batch_size)]
+        if num_full < len(shuffled):
+            tail = shuffled[num_full:]
+            if self.remainder == 'keep':
+                batches.append(tail)
+            elif self.remainder == 'fill':
+                # top up with random images from the same bucket, they just get seen twice this epoch
+                num_missing = self.batch_size - len(tail)
+                fill_idx = torch.randint(0, len(indices), (num_missing,), generator=generator).tolist()
+                batches.append(tail + [indices[i] for i in fill_idx])
+        return batches
+
+    def __iter__(self) -> Iterator[List[int]]:
+        # seed from the global rng so a new order is drawn every epoch but runs are still reproducible
+        generator = torch.Generator()
+        generator.manual_seed(int(torch.empty((), dtype=torch.int64).random_().item()))
+
+        bucket_batches = [self._get_bucket_batches(indices, generator) for indices in self.buckets.values()]
+
+        if self.balance:
+            # place each bucket's batches evenly across the epoch, with jitter, so every part of the
+            # epoch sees aspect ratios in proportion to how common they are
+            positioned = []
+            for batches in bucket_batches:
+                num_batches = len(batches)
+                offsets = torch.rand(num_batches, generator=generator).tolist()
+                for i, batch in enumerate(batches):
+                    positioned.append(((i + offsets[i]) / num_batches, batch))
+            positioned.sort(key=lambda x: x[0])
+            all_batches = [batch for _, batch in positioned]
         else:
-            # Dataloader is batching
-            return self._get_single_item(item)
+            all_batches = [batch for batches in bucket_batches for batch in batches]
+            all_batches = [all_batches[i] for i in torch.randperm(len(all_batches), generator=generator).tolist()]
+
+        for batch in all_batches:
+            yield batch
 
 
-def get_dataloader_from_datasets(dataset_options, batch_size=1):
-    # TODO do bucketing
+def bucket_collate_fn(batch):
+    # every item in the batch is from the same bucket so they can be stacked
+    if len(batch[0]) == 3:
+        imgs, prompts, dataset_config_dicts = zip(*batch)
+        return torch.stack(imgs, dim=0), list(prompts), list(dataset_config_dicts)
+    else:
+        imgs, dataset_config_dicts = zip(*batch)
+        return torch.stack(imgs, dim=0), list(dataset_config_dicts)
+
+
+def get_dataloader(
+        dataset: Dataset,
+        dataloader_config: DataLoaderConfig = None,
+        batch_size: Union[int, None] = 1,
+        shuffle: bool = False,
+        **kwargs
+) -> DataLoader:
+    # every trainer builds its loader here so the worker settings come from one place
+    if dataloader_config is None:
+        dataloader_config = DataLoaderConfig()
+    num_workers = dataloader_config.get_num_workers()
+    loader_kwargs = {
+        'num_workers': num_workers,
+        'pin_memory': dataloader_config.get_pin_memory(),
+    }
+    # these are only valid with worker processes
+    if num_workers > 0:
+        loader_kwargs['prefetch_factor'] = dataloader_config.prefetch_factor
+        loader_kwargs['persistent_workers'] = dataloader_config.persistent_workers
+    if 'batch_sampler' not in kwargs:
+        loader_kwargs['batch_size'] = batch_size
+        loader_kwargs['shuffle'] = shuffle
+    loader_kwargs.update(kwargs)
+    return DataLoader(dataset, **loader_kwargs)
+
+
+def get_dataloader_from_datasets(dataset_options, batch_size=1, dataloader_config: DataLoaderConfig = None):
     if dataset_options is None or len(dataset_options) == 0:
         return None
 
@@ -475,26 +648,41 @@ def get_dataloader_from_datasets(dataset_options, batch_size=1):
     concatenated_dataset = ConcatDataset(datasets)
     if has_buckets:
         # make sure they all have buckets
+        first_config = datasets[0].dataset_config
         for dataset in datasets:
             assert dataset.dataset_config.buckets, f"buckets not found on dataset {dataset.dataset_config.folder_path}, you either need all buckets or none"
+            assert dataset.dataset_config.bucket_remainder == first_config.bucket_remainder and \
+                   dataset.dataset_config.bucket_balance == first_config.bucket_balance, \
+                f"bucket_remainder and bucket_balance must match on all datasets, check {dataset.dataset_config.folder_path}"
 
-        def custom_collate_fn(batch):
-            # just return as is
-            return batch
+        batch_sampler = BucketBatchSampler(
+            concatenated_dataset,
+            batch_size=batch_size,
+            remainder=first_config.bucket_remainder,
+            balance=first_config.bucket_balance,
+        )
 
-        data_loader = DataLoader(
+        data_loader = get_dataloader(
             concatenated_dataset,
-            batch_size=None,  # we batch in the dataloader
-            drop_last=False,
-            shuffle=True,
-            collate_fn=custom_collate_fn,  # Use the custom collate function
-            num_workers=2
+            dataloader_config,
+            batch_sampler=batch_sampler,
+            collate_fn=bucket_collate_fn,
         )
     else:
-        data_loader = DataLoader(
+        data_loader = get_dataloader(
             concatenated_dataset,
+            dataloader_config,
             batch_size=batch_size,
             shuffle=True,
-            num_workers=2
         )
     return data_loader
+
+
+def cache_latents_for_dataloader(data_loader: DataLoader, sd) -> bool:
+    # must be called before iterating so the workers are forked with the cache in place
+    # returns True if every dataset now serves latents
+    datasets: List['AiToolkitDataset'] = data_loader.dataset.datasets
+    is_cached_list = [dataset.cache_latents_all_latents(sd) for dataset in datasets]
+    if any(is_cached_list) and not all(is_cached_list):
+        raise ValueError("cache_latents must be enabled on all datasets or none of them, pixels and latents cannot be batched together")
+    return all(is_cached_list)
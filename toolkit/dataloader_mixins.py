@@ -1,6 +1,18 @@
+import hashlib
+import json
 import os
+import uuid
+import weakref
+from collections import OrderedDict
 from typing import TYPE_CHECKING, List, Dict
 
+import torch
+from safetensors import safe_open
+from safetensors.torch import save_file
+from tqdm import tqdm
+
+from toolkit.file_lock import FileLock
+
 
 class CaptionMixin:
     def get_caption_item(self, index):
@@ -49,6 +61,7 @@ class CaptionMixin:
 if TYPE_CHECKING:
     from toolkit.config_modules import DatasetConfig
     from toolkit.data_loader import FileItem
+    from toolkit.stable_diffusion_model import StableDiffusion
 
 
 class Bucket:
@@ -60,15 +73,8 @@ class Bucket:
 
 class BucketsMixin:
     def __init__(self):
+        super().__init__()
         self.buckets: Dict[str, Bucket] = {}
-        self.batch_indices: List[List[int]] = []
-
-    def build_batch_indices(self):
-        for key, bucket in self.buckets.items():
-            for start_idx in range(0, len(bucket.file_list_idx), self.batch_size):
-                end_idx = min(start_idx + self.batch_size, len(bucket.file_list_idx))
-                batch = bucket.file_list_idx[start_idx:end_idx]
-                self.batch_indices.append(batch)
 
     def setup_buckets(self):
         if not hasattr(self, 'file_list'):
@@ -86,7 +92,7 @@ class BucketsMixin:
             # reduce it to the nearest divisible number
             resolution = resolution - (resolution % bucket_tolerance)
 
-        # for file_item in enumerate(file_list):
+        # file item sizes come from the dataset manifest, no images are opened here
         for idx, file_item in enumerate(file_list):
             width = file_item.crop_width
             height = file_item.crop_height
@@ -138,11 +144,196 @@ class BucketsMixin:
                 self.buckets[bucket_key] = Bucket(new_width, new_height)
             self.buckets[bucket_key].file_list_idx.append(idx)
 
-        # print the buckets
-        self.build_batch_indices()
+        # print the buckets. Batches are built each epoch by the BucketBatchSampler
         print(f'Bucket sizes for {self.__class__.__name__}:')
         for key, bucket in self.buckets.items():
             print(f'{key}: {len(bucket.file_list_idx)} files')
         print(f'{len(self.buckets)} buckets made')
 
         # file buckets made
+
+
+LATENT_CACHE_FOLDER = '_latent_cache'
+LATENT_CACHE_INDEX_FILE = 'index.json'
+LATENT_CACHE_VERSION = 1
+
+# hashing the vae weights takes a second, only do it once per vae. Weak keys so a new vae that reuses
+# the memory of a freed one is never given its hash
+vae_hash_cache: 'weakref.WeakKeyDictionary[torch.nn.Module, str]' = weakref.WeakKeyDictionary()
+
+
+def get_vae_hash(vae) -> str:
+    # hash the weights so a swapped or fine-tuned vae never reuses stale latents
+    if vae in vae_hash_cache:
+        return vae_hash_cache[vae]
+    hasher = hashlib.sha256()
+    for key, value in vae.state_dict().items():
+        hasher.update(key.encode('utf-8'))
+        hasher.update(value.detach().to('cpu', dtype=torch.float32).numpy().tobytes())
+    vae_hash = hasher.hexdigest()
+    vae_hash_cache[vae] = vae_hash
+    return vae_hash
+
+
+class LatentCachingMixin:
+    def __init__(self):
+        super().__init__()
+        self.is_caching_latents: bool = False
+        self.latent_scaling_factor: float = 1.0
+        self.latent_shard_handles: Dict[str, object] = {}
+
+    def get_latent_cache_dir(self) -> str:
+        return os.path.join(self.dataset_config.folder_path, LATENT_CACHE_FOLDER)
+
+    def get_latent_cache_key(self, file_item: 'FileItem', vae_hash: str, dtype: torch.dtype) -> str:
+        config: 'DatasetConfig' = self.dataset_config
+        key_dict = OrderedDict({
+            'path': os.path.abspath(file_item.path),
+            'mtime': os.path.getmtime(file_item.path),
+            'scale_to_width': file_item.scale_to_width,
+            'scale_to_height': file_item.scale_to_height,
+            'crop_x': file_item.crop_x,
+            'crop_y': file_item.crop_y,
+            'crop_width': file_item.crop_width,
+            'crop_height': file_item.crop_height,
+            'resolution': config.resolution,
+            'scale': config.scale,
+            'buckets': config.buckets,
+            'vae_hash': vae_hash,
+            'dtype': str(dtype),
+        })
+        return hashlib.sha256(json.dumps(key_dict).encode('utf-8')).hexdigest()
+
+    def _load_latent_cache_index(self) -> OrderedDict:
+        index_path = os.path.join(self.get_latent_cache_dir(), LATENT_CACHE_INDEX_FILE)
+        if os.path.exists(index_path):
+            with open(index_path, 'r') as f:
+                index = json.load(f, object_pairs_hook=OrderedDict)
+            if index.get('version', None) == LATENT_CACHE_VERSION:
+                return index
+            print(f"  -  Latent cache version mismatch, rebuilding {index_path}")
+        return OrderedDict({
+            'version': LATENT_CACHE_VERSION,
+            'shards': [],
+            'latents': OrderedDict(),
+        })
+
+    def _save_latent_cache_index(self, index: OrderedDict):
+        index_path = os.path.join(self.get_latent_cache_dir(), LATENT_CACHE_INDEX_FILE)
+        tmp_path = index_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp_path, index_path)
+
+    def _write_latent_shard(self, index: OrderedDict, state_dict: Dict[str, torch.Tensor]):
+        cache_dir = self.get_latent_cache_dir()
+        # unique name so runs caching the same folder never write the same shard
+        shard_name = f"latents_{uuid.uuid4().hex}.safetensors"
+        shard_path = os.path.join(cache_dir, shard_name)
+        tmp_path = shard_path + '.tmp'
+        save_file(state_dict, tmp_path)
+        os.replace(tmp_path, shard_path)
+
+        # pick up shards other runs added since we loaded the index. Locked so two runs writing at
+        # once can not drop each other's shards from the index
+        with FileLock(os.path.join(cache_dir, LATENT_CACHE_INDEX_FILE + '.lock')):
+            saved_index = self._load_latent_cache_index()
+            for key, value in index['latents'].items():
+                saved_index['latents'].setdefault(key, value)
+            saved_index['shards'] = list(dict.fromkeys(saved_index['shards'] + index['shards'] + [shard_name]))
+            for key in state_dict.keys():
+                if key.endswith('.mean'):
+                    saved_index['latents'][key[:-len('.mean')]] = shard_name
+            # updated in place, the caller keeps using it
+            index.clear()
+            index.update(saved_index)
+            # save after every shard so an interrupted run keeps its progress
+            self._save_latent_cache_index(index)
+
+    @torch.no_grad()
+    def cache_latents_all_latents(self, sd: 'StableDiffusion') -> bool:
+        if not hasattr(self, 'file_list'):
+            raise Exception(f'file_list not found on class instance {self.__class__.__name__}')
+        if not hasattr(self, 'dataset_config'):
+            raise Exception(f'dataset_config not found on class instance {self.__class__.__name__}')
+
+        config: 'DatasetConfig' = self.dataset_config
+        file_list: List['FileItem'] = self.file_list
+        self.is_caching_latents = False
+        self.latent_shard_handles = {}
+
+        if not config.cache_latents:
+            return False
+        if not config.buckets and (config.random_crop or config.random_scale):
+            print(f"  -  Cannot cache latents for {config.folder_path} with random crop or random scale, skipping")
+            return False
+
+        cache_dir = self.get_latent_cache_dir()
+        os.makedirs(cache_dir, exist_ok=True)
+        index = self._load_latent_cache_index()
+
+        vae_hash = get_vae_hash(sd.vae)
+        dtype = sd.torch_dtype
+
+        # group uncached items by output size so they can be encoded in batches
+        to_encode: Dict[str, List[int]] = OrderedDict()
+        for idx, file_item in enumerate(file_list):
+            file_item.latent_cache_key = self.get_latent_cache_key(file_item, vae_hash, dtype)
+            shard_name = index['latents'].get(file_item.latent_cache_key, None)
+            if shard_name is not None and os.path.exists(os.path.join(cache_dir, shard_name)):
+                file_item.latent_cache_file = os.path.join(cache_dir, shard_name)
+            else:
+                file_item.latent_cache_file = None
+                size_key = f"{file_item.crop_width}x{file_item.crop_height}"
+                if size_key not in to_encode:
+                    to_encode[size_key] = []
+                to_encode[size_key].append(idx)
+
+        num_to_encode = sum([len(idx_list) for idx_list in to_encode.values()])
+        print(f"  -  Found {len(file_list) - num_to_encode} cached latents, encoding {num_to_encode}")
+
+        if num_to_encode > 0:
+            original_vae_device = sd.vae.device
+            sd.vae.to(sd.device_torch)
+            shard_state_dict = OrderedDict()
+            shard_size = max(1, config.latent_cache_shard_size)
+            batch_size = max(1, getattr(self, 'batch_size', 1))
+            progress_bar = tqdm(total=num_to_encode, desc="Caching latents", leave=False)
+            for idx_list in to_encode.values():
+                for start_idx in range(0, len(idx_list), batch_size):
+                    batch_idx_list = idx_list[start_idx:start_idx + batch_size]
+                    images = [self.load_image_tensor(idx) for idx in batch_idx_list]
+                    mean, std = sd.encode_images_to_latent_dist(images, device='cpu', dtype=dtype)
+                    for i, idx in enumerate(batch_idx_list):
+                        cache_key = file_list[idx].latent_cache_key
+                        shard_state_dict[f"{cache_key}.mean"] = mean[i].clone().contiguous()
+                        shard_state_dict[f"{cache_key}.std"] = std[i].clone().contiguous()
+                    progress_bar.update(len(batch_idx_list))
+                    if len(shard_state_dict) // 2 >= shard_size:
+                        self._write_latent_shard(index, shard_state_dict)
+                        shard_state_dict = OrderedDict()
+            if len(shard_state_dict) > 0:
+                self._write_latent_shard(index, shard_state_dict)
+            progress_bar.close()
+            sd.vae.to(original_vae_device)
+
+            for file_item in file_list:
+                shard_name = index['latents'][file_item.latent_cache_key]
+                file_item.latent_cache_file = os.path.join(cache_dir, shard_name)
+
+        self.latent_scaling_factor = sd.vae.config['scaling_factor']
+        self.is_caching_latents = True
+        return True
+
+    def get_cached_latent(self, file_item: 'FileItem') -> torch.Tensor:
+        # shards are memory mapped and opened lazily so each dataloader worker gets its own handles
+        if file_item.latent_cache_file not in self.latent_shard_handles:
+            self.latent_shard_handles[file_item.latent_cache_file] = safe_open(
+                file_item.latent_cache_file, framework='pt', device='cpu'
+            )
+        handle = self.latent_shard_handles[file_item.latent_cache_file]
+        mean = handle.get_tensor(f"{file_item.latent_cache_key}.mean").float()
+        std = handle.get_tensor(f"{file_item.latent_cache_key}.std").float()
+        # sample the distribution like the vae would
+        latent = mean + std * torch.randn_like(mean)
+        return latent * self.latent_scaling_factor
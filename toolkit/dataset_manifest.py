@@ -0,0 +1,166 @@
+import hashlib
+import json
+import os
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Dict, Optional
+
+from PIL import Image
+from tqdm import tqdm
+
+from toolkit import image_utils
+
+MANIFEST_FILE = '_dataset_manifest.json'
+MANIFEST_VERSION = 1
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+# spinning up a process pool is slower than just reading a few files
+MIN_FILES_FOR_POOL = 256
+
+
+class ManifestItem:
+    def __init__(self, **kwargs):
+        self.path: str = kwargs.get('path', None)
+        self.size: int = kwargs.get('size', None)
+        self.mtime: float = kwargs.get('mtime', None)
+        self.width: int = kwargs.get('width', None)
+        self.height: int = kwargs.get('height', None)
+        self.caption_hash: Optional[str] = kwargs.get('caption_hash', None)
+        self.caption_mtime: Optional[float] = kwargs.get('caption_mtime', None)
+
+    def to_dict(self):
+        return OrderedDict({
+            'path': self.path,
+            'size': self.size,
+            'mtime': self.mtime,
+            'width': self.width,
+            'height': self.height,
+            'caption_hash': self.caption_hash,
+            'caption_mtime': self.caption_mtime,
+        })
+
+
+def get_caption_path(path: str) -> str:
+    return os.path.splitext(path)[0] + '.txt'
+
+
+def get_caption_mtime(path: str) -> Optional[float]:
+    caption_path = get_caption_path(path)
+    if os.path.exists(caption_path):
+        return os.path.getmtime(caption_path)
+    return None
+
+
+def read_manifest_item(path: str) -> Dict:
+    # module level so it can be sent to the process pool
+    stat = os.stat(path)
+    try:
+        width, height = image_utils.get_image_size(path)
+    except image_utils.UnknownImageFormat:
+        # slow path, only reads the header but goes through PIL
+        with Image.open(path) as img:
+            width, height = img.size
+
+    caption_hash = None
+    caption_mtime = None
+    caption_path = get_caption_path(path)
+    if os.path.exists(caption_path):
+        with open(caption_path, 'rb') as f:
+            caption_hash = hashlib.sha256(f.read()).hexdigest()
+        caption_mtime = os.path.getmtime(caption_path)
+
+    return ManifestItem(
+        path=path,
+        size=stat.st_size,
+        mtime=stat.st_mtime,
+        width=width,
+        height=height,
+        caption_hash=caption_hash,
+        caption_mtime=caption_mtime,
+    ).to_dict()
+
+
+class DatasetManifest:
+    """
+    Index of the images in a dataset folder with their dimensions, so we do not have to open every
+    image on every run. It is stored next to the images and only files that changed since the last
+    run are read again.
+    """
+
+    def __init__(self, folder_path: str, extensions=IMAGE_EXTENSIONS, num_workers: Optional[int] = None):
+        self.folder_path = folder_path
+        self.extensions = extensions
+        self.num_workers = num_workers if num_workers is not None else min(os.cpu_count() or 1, 16)
+        self.manifest_path = os.path.join(folder_path, MANIFEST_FILE)
+        self.items: List[ManifestItem] = []
+
+    def _load(self) -> Dict[str, ManifestItem]:
+        if not os.path.exists(self.manifest_path):
+            return {}
+        try:
+            with open(self.manifest_path, 'r') as f:
+                data = json.load(f)
+        except json.decoder.JSONDecodeError:
+            print(f"  -  Dataset manifest is corrupt, rebuilding {self.manifest_path}")
+            return {}
+        if data.get('version', None) != MANIFEST_VERSION:
+            return {}
+        return {item['path']: ManifestItem(**item) for item in data['items']}
+
+    def _save(self):
+        data = OrderedDict({
+            'version': MANIFEST_VERSION,
+            'items': [item.to_dict() for item in self.items],
+        })
+        tmp_path = self.manifest_path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(data, f)
+            os.replace(tmp_path, self.manifest_path)
+        except OSError as e:
+            # read only dataset, we will just rebuild it next time
+            print(f"  -  Could not save dataset manifest to {self.manifest_path}: {e}")
+
+    def update(self) -> List[ManifestItem]:
+        cached_items = self._load()
+
+        items_by_path: Dict[str, ManifestItem] = {}
+        to_read = []
+        with os.scandir(self.folder_path) as it:
+            for entry in it:
+                if not entry.is_file() or not entry.name.lower().endswith(self.extensions):
+                    continue
+                path = os.path.join(self.folder_path, entry.name)
+                stat = entry.stat()
+                cached = cached_items.get(path, None)
+                if cached is not None and cached.size == stat.st_size and cached.mtime == stat.st_mtime \
+                        and cached.caption_mtime == get_caption_mtime(path):
+                    items_by_path[path] = cached
+                else:
+                    to_read.append(path)
+
+        if len(to_read) > 0:
+            print(f"  -  Reading dimensions for {len(to_read)} new or changed images")
+            if len(to_read) >= MIN_FILES_FOR_POOL and self.num_workers > 1:
+                with ProcessPoolExecutor(max_workers=self.num_workers) as executor:
+                    results = list(tqdm(
+                        executor.map(read_manifest_item, to_read, chunksize=64),
+                        total=len(to_read),
+                        leave=False
+                    ))
+            else:
+                results = [read_manifest_item(path) for path in tqdm(to_read, leave=False)]
+            for result in results:
+                items_by_path[result['path']] = ManifestItem(**result)
+
+        self.items = [items_by_path[path] for path in sorted(items_by_path.keys())]
+
+        # only write if something changed, including removed files
+        if len(to_read) > 0 or len(cached_items) != len(self.items):
+            self._save()
+
+        return self.items
+
+
+def get_dataset_manifest(folder_path: str, num_workers: Optional[int] = None) -> List[ManifestItem]:
+    manifest = DatasetManifest(folder_path, num_workers=num_workers)
+    return manifest.update()
@@ -0,0 +1,262 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, List, Optional, Tuple
+from urllib.parse import urlparse
+
+import requests
+import tqdm
+
+from toolkit.file_lock import FileLock
+
+BLOCK_SIZE = 1024 * 1024  # 1 MiB
+DEFAULT_CHUNK_SIZE = 64 * 1024 * 1024  # 64 MiB per range request
+DEFAULT_NUM_WORKERS = 8
+DEFAULT_MAX_RETRIES = 5
+
+
+class DownloadSource:
+    """
+    Where api json and files are fetched from. Urls are always the real ones, a source can map them
+    somewhere else, so a local server or a directory can stand in for the real site.
+    """
+
+    def get_json(self, url: str) -> dict:
+        raise NotImplementedError
+
+    def get_size(self, url: str) -> Tuple[Optional[int], bool]:
+        # (size in bytes if known, supports range requests)
+        raise NotImplementedError
+
+    def iter_range(self, url: str, start: int = 0, end: Optional[int] = None) -> Iterator[bytes]:
+        # bytes start to end, end is inclusive. None reads to the end of the file
+        raise NotImplementedError
+
+
+class HttpSource(DownloadSource):
+    def __init__(self, base_url: Optional[str] = None, headers: Optional[dict] = None, timeout: float = 60):
+        # base_url replaces the scheme and host of every url, to point at a mirror
+        self.base_url = base_url.rstrip('/') if base_url is not None else None
+        self.headers = headers if headers is not None else {}
+        self.timeout = timeout
+
+    def resolve(self, url: str) -> str:
+        if self.base_url is None:
+            return url
+        parsed = urlparse(url)
+        return self.base_url + parsed.path + (f"?{parsed.query}" if parsed.query else '')
+
+    def get_json(self, url: str) -> dict:
+        response = requests.get(self.resolve(url), headers=self.headers, timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def get_size(self, url: str) -> Tuple[Optional[int], bool]:
+        headers = {**self.headers, 'Range': 'bytes=0-0'}
+        with requests.get(self.resolve(url), headers=headers, stream=True, timeout=self.timeout) as response:
+            response.raise_for_status()
+            content_range = response.headers.get('content-range', None)
+            if response.status_code == 206 and content_range is not None and '/' in content_range:
+                total = content_range.split('/')[-1]
+                if total.isdigit():
+                    return int(total), True
+            content_length = response.headers.get('content-length', None)
+            return (int(content_length) if content_length is not None else None), False
+
+    def iter_range(self, url: str, start: int = 0, end: Optional[int] = None) -> Iterator[bytes]:
+        headers = dict(self.headers)
+        if start > 0 or end is not None:
+            headers['Range'] = f"bytes={start}-{end if end is not None else ''}"
+        with requests.get(self.resolve(url), headers=headers, stream=True, timeout=self.timeout) as response:
+            response.raise_for_status()
+            if 'Range' in headers and response.status_code != 206:
+                raise IOError(f"Server ignored the range request for {url}")
+            for data in response.iter_content(BLOCK_SIZE):
+                yield data
+
+
+class DirectorySource(DownloadSource):
+    """
+    A directory laid out like the site, url paths map to files under root. So
+    https://civitai.com/api/v1/models/25694 is read from root/api/v1/models/25694 (or 25694.json).
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def resolve(self, url: str) -> str:
+        path = urlparse(url).path.lstrip('/')
+        return os.path.join(self.root, *path.split('/'))
+
+    def get_json(self, url: str) -> dict:
+        path = self.resolve(url)
+        if not os.path.exists(path) and os.path.exists(path + '.json'):
+            path = path + '.json'
+        with open(path, 'r') as f:
+            return json.load(f)
+
+    def get_size(self, url: str) -> Tuple[Optional[int], bool]:
+        return os.path.getsize(self.resolve(url)), True
+
+    def iter_range(self, url: str, start: int = 0, end: Optional[int] = None) -> Iterator[bytes]:
+        with open(self.resolve(url), 'rb') as f:
+            f.seek(start)
+            remaining = None if end is None else end - start + 1
+            while remaining is None or remaining > 0:
+                data = f.read(BLOCK_SIZE if remaining is None else min(BLOCK_SIZE, remaining))
+                if not data:
+                    break
+                if remaining is not None:
+                    remaining -= len(data)
+                yield data
+
+
+def get_file_sha256(path: str) -> str:
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for data in iter(lambda: f.read(8 * BLOCK_SIZE), b''):
+            hasher.update(data)
+    return hasher.hexdigest()
+
+
+class _DownloadState:
+    # the chunks of a partial download that are complete, saved next to it so a later run can resume
+    def __init__(self, path: str, url: str, size: int, chunk_size: int):
+        self.path = path
+        self.info = {'url': url, 'size': size, 'chunk_size': chunk_size}
+        self.done: List[int] = []
+        self.lock = threading.Lock()
+
+    def load(self) -> bool:
+        if not os.path.exists(self.path):
+            return False
+        try:
+            with open(self.path, 'r') as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if any([state.get(key, None) != value for key, value in self.info.items()]):
+            return False
+        self.done = state.get('done', [])
+        return True
+
+    def mark_done(self, chunk_idx: int):
+        with self.lock:
+            self.done.append(chunk_idx)
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump({**self.info, 'done': self.done}, f)
+            os.replace(tmp_path, self.path)
+
+
+def _download_chunk(
+        source: DownloadSource,
+        url: str,
+        tmp_path: str,
+        start: int,
+        end: int,
+        max_retries: int,
+        progress_bar: tqdm.tqdm,
+):
+    written = 0
+    attempt = 0
+    while True:
+        try:
+            with open(tmp_path, 'r+b') as f:
+                f.seek(start + written)
+                # retries pick up where the last attempt stopped
+                for data in source.iter_range(url, start + written, end):
+                    f.write(data)
+                    written += len(data)
+                    progress_bar.update(len(data))
+            if written != end - start + 1:
+                raise IOError(f"Expected {end - start + 1} bytes for range {start}-{end}, got {written}")
+            return
+        except (IOError, requests.RequestException) as e:
+            attempt += 1
+            if attempt > max_retries:
+                raise e
+            time.sleep(min(2 ** attempt, 30))
+
+
+def download_file(
+        url: str,
+        path: str,
+        source: Optional[DownloadSource] = None,
+        sha256: Optional[str] = None,
+        num_workers: int = DEFAULT_NUM_WORKERS,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        max_retries: int = DEFAULT_MAX_RETRIES,
+) -> str:
+    """
+    Downloads url to path. When the source supports range requests the file is fetched in chunks on
+    num_workers threads, and a failed or killed download resumes from the chunks already on disk.
+    When sha256 is given the file is verified before it is moved into place.
+    """
+    if source is None:
+        source = HttpSource()
+    folder = os.path.dirname(os.path.abspath(path))
+    filename = os.path.basename(path)
+    os.makedirs(folder, exist_ok=True)
+    tmp_path = os.path.join(folder, f".download_tmp_{filename}")
+    state_path = tmp_path + '.json'
+
+    # only one job downloads a file at a time, the others wait for it and reuse the result
+    with FileLock(tmp_path + '.lock'):
+        if os.path.exists(path):
+            if sha256 is None or get_file_sha256(path).lower() == sha256.lower():
+                return path
+            print(f"{path} does not match the expected hash, downloading it again")
+
+        size, supports_range = source.get_size(url)
+        progress_bar = tqdm.tqdm(total=size, unit='iB', unit_scale=True)
+
+        if supports_range and size is not None and size > 0:
+            state = _DownloadState(state_path, url, size, chunk_size)
+            resuming = state.load() and os.path.exists(tmp_path) and os.path.getsize(tmp_path) == size
+            if not resuming:
+                state.done = []
+                with open(tmp_path, 'wb') as f:
+                    f.truncate(size)
+
+            chunks = [(start, min(start + chunk_size, size) - 1) for start in range(0, size, chunk_size)]
+            pending = [i for i in range(len(chunks)) if i not in state.done]
+            if resuming:
+                done_bytes = sum([chunks[i][1] - chunks[i][0] + 1 for i in state.done])
+                print(f"Resuming download, {done_bytes / size * 100:.1f}% already done")
+                progress_bar.update(done_bytes)
+
+            def download(chunk_idx: int):
+                start, end = chunks[chunk_idx]
+                _download_chunk(source, url, tmp_path, start, end, max_retries, progress_bar)
+                state.mark_done(chunk_idx)
+
+            with ThreadPoolExecutor(max_workers=max(1, num_workers)) as executor:
+                # leaves the partial file and state for a resume if any chunk fails
+                for future in [executor.submit(download, chunk_idx) for chunk_idx in pending]:
+                    future.result()
+        else:
+            # no range support, single stream from the start
+            with open(tmp_path, 'wb') as f:
+                for data in source.iter_range(url):
+                    progress_bar.update(len(data))
+                    f.write(data)
+        progress_bar.close()
+
+        if sha256 is not None:
+            print(f"Verifying {filename}")
+            file_hash = get_file_sha256(tmp_path)
+            if file_hash.lower() != sha256.lower():
+                # a bad file can not be resumed, start over next time
+                os.remove(tmp_path)
+                if os.path.exists(state_path):
+                    os.remove(state_path)
+                raise ValueError(f"Hash mismatch for {url}, expected {sha256.lower()} but got {file_hash}")
+
+        os.replace(tmp_path, path)
+        if os.path.exists(state_path):
+            os.remove(state_path)
+    return path
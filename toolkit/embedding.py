@@ -4,7 +4,7 @@ from collections import OrderedDict
 
 import safetensors
 import torch
-from typing import TYPE_CHECKING
+from typing import TYPE_CHECKING, List
 
 from safetensors.torch import save_file
 
@@ -15,6 +15,46 @@ if TYPE_CHECKING:
     from toolkit.config_modules import EmbeddingConfig
 
 
+class SparseTokenEmbedding(torch.nn.Module):
+    """
+    Wraps a text encoder's token embedding so the vectors of tokens added for an embedding live in
+    their own small parameter. The original table is left frozen and untouched, and only the new
+    vectors get gradients and optimizer state.
+    """
+
+    def __init__(self, base_embedding: torch.nn.Embedding, first_token_id: int, init_vectors: torch.Tensor):
+        super().__init__()
+        if first_token_id > base_embedding.num_embeddings:
+            raise ValueError(
+                f"Token id {first_token_id} leaves a gap after the {base_embedding.num_embeddings} token embeddings"
+            )
+        self.base_embedding = base_embedding
+        self.base_embedding.requires_grad_(False)
+        self.first_token_id = first_token_id
+        self.trainable_vectors = torch.nn.Parameter(
+            init_vectors.detach().clone().to(base_embedding.weight.device, dtype=torch.float32)
+        )
+
+    @property
+    def num_embeddings(self):
+        return max(self.base_embedding.num_embeddings, self.first_token_id + self.trainable_vectors.shape[0])
+
+    @property
+    def weight(self):
+        # full table, only built for code that reads it
+        weight = self.base_embedding.weight
+        vectors = self.trainable_vectors.to(weight.dtype)
+        return torch.cat([weight[:self.first_token_id], vectors, weight[self.first_token_id + vectors.shape[0]:]])
+
+    def forward(self, input_ids: torch.Tensor) -> torch.Tensor:
+        num_vectors = self.trainable_vectors.shape[0]
+        embeds = self.base_embedding(input_ids.clamp(max=self.base_embedding.num_embeddings - 1))
+        vector_ids = input_ids - self.first_token_id
+        is_new_token = (vector_ids >= 0) & (vector_ids < num_vectors)
+        new_embeds = torch.nn.functional.embedding(vector_ids.clamp(0, num_vectors - 1), self.trainable_vectors)
+        return torch.where(is_new_token.unsqueeze(-1), new_embeds.to(embeds.dtype), embeds)
+
+
 # this is a frankenstein mix of automatic1111 and my own code
 
 class Embedding:
@@ -28,6 +68,9 @@ class Embedding:
         self.trigger = embed_config.trigger
         self.embed_config = embed_config
         self.step = 0
+        # sdxl has 2 text encoders, each gets its own vectors
+        self.tokenizers = sd.tokenizer if isinstance(sd.tokenizer, list) else [sd.tokenizer]
+        self.text_encoders = sd.text_encoder if isinstance(sd.text_encoder, list) else [sd.text_encoder]
         # setup our embedding
         # Add the placeholder token in tokenizer
         placeholder_tokens = [self.embed_config.trigger]
@@ -38,66 +81,79 @@ class Embedding:
             additional_tokens.append(f"{self.embed_config.trigger}_{i}")
         placeholder_tokens += additional_tokens
 
-        num_added_tokens = self.sd.tokenizer.add_tokens(placeholder_tokens)
-        if num_added_tokens != self.embed_config.tokens:
-            raise ValueError(
-                f"The tokenizer already contains the token {self.embed_config.trigger}. Please pass a different"
-                " `placeholder_token` that is not already in the tokenizer."
-            )
-
-        # Convert the initializer_token, placeholder_token to ids
-        init_token_ids = self.sd.tokenizer.encode(self.embed_config.init_words, add_special_tokens=False)
-        # if length of token ids is more than number of orm embedding tokens fill with *
-        if len(init_token_ids) > self.embed_config.tokens:
-            init_token_ids = init_token_ids[:self.embed_config.tokens]
-        elif len(init_token_ids) < self.embed_config.tokens:
-            pad_token_id = self.sd.tokenizer.encode(["*"], add_special_tokens=False)
-            init_token_ids += pad_token_id * (self.embed_config.tokens - len(init_token_ids))
-
-        self.placeholder_token_ids = self.sd.tokenizer.convert_tokens_to_ids(placeholder_tokens)
-
-        # Resize the token embeddings as we are adding new special tokens to the tokenizer
-        # todo SDXL has 2 text encoders, need to do both for all of this
-        self.sd.text_encoder.resize_token_embeddings(len(self.sd.tokenizer))
-
-        # Initialise the newly added placeholder token with the embeddings of the initializer token
-        token_embeds = self.sd.text_encoder.get_input_embeddings().weight.data
-        with torch.no_grad():
-            for initializer_token_id, token_id in zip(init_token_ids, self.placeholder_token_ids):
-                token_embeds[token_id] = token_embeds[initializer_token_id].clone()
+        self.token_embeddings: List[SparseTokenEmbedding] = []
+        placeholder_token_ids_list = []
+        for tokenizer, text_encoder in zip(self.tokenizers, self.text_encoders):
+            num_added_tokens = tokenizer.add_tokens(placeholder_tokens)
+            if num_added_tokens != self.embed_config.tokens:
+                raise ValueError(
+                    f"The tokenizer already contains the token {self.embed_config.trigger}. Please pass a different"
+                    " `placeholder_token` that is not already in the tokenizer."
+                )
+
+            # Convert the initializer_token, placeholder_token to ids
+            init_token_ids = tokenizer.encode(self.embed_config.init_words, add_special_tokens=False)
+            # if length of token ids is more than number of orm embedding tokens fill with *
+            if len(init_token_ids) > self.embed_config.tokens:
+                init_token_ids = init_token_ids[:self.embed_config.tokens]
+            elif len(init_token_ids) < self.embed_config.tokens:
+                pad_token_id = tokenizer.encode(["*"], add_special_tokens=False)
+                init_token_ids += pad_token_id * (self.embed_config.tokens - len(init_token_ids))
+
+            placeholder_token_ids = tokenizer.convert_tokens_to_ids(placeholder_tokens)
+            if placeholder_token_ids != list(range(placeholder_token_ids[0], placeholder_token_ids[0] + len(
+                    placeholder_token_ids))):
+                raise ValueError(f"Tokens for {self.embed_config.trigger} were not added in order")
+            placeholder_token_ids_list.append(placeholder_token_ids)
+
+            # Initialise the placeholder tokens with the embeddings of the initializer tokens.
+            # The table is not resized, the new vectors are looked up by the wrapper
+            base_embedding = text_encoder.get_input_embeddings()
+            with torch.no_grad():
+                init_vectors = base_embedding.weight[torch.tensor(init_token_ids, device=base_embedding.weight.device)]
+            token_embedding = SparseTokenEmbedding(base_embedding, placeholder_token_ids[0], init_vectors)
+            text_encoder.set_input_embeddings(token_embedding)
+            self.token_embeddings.append(token_embedding)
+
+        self.placeholder_token_ids = placeholder_token_ids_list[0]
 
         # replace "[name] with this. on training. This is automatically generated in pipeline on inference
-        self.embedding_tokens = " ".join(self.sd.tokenizer.convert_ids_to_tokens(self.placeholder_token_ids))
+        self.embedding_tokens = " ".join(self.tokenizers[0].convert_ids_to_tokens(self.placeholder_token_ids))
 
     # returns the string to have in the prompt to trigger the embedding
     def get_embedding_string(self):
         return self.embedding_tokens
 
     def get_trainable_params(self):
-        # todo only get this one as we could have more than one
-        return self.sd.text_encoder.get_input_embeddings().parameters()
+        # just the new vectors, a few KB of optimizer state
+        return [token_embedding.trainable_vectors for token_embedding in self.token_embeddings]
+
+    @property
+    def is_xl(self):
+        return len(self.token_embeddings) > 1
 
     # make setter and getter for vec
     @property
     def vec(self):
-        # should we get params instead
-        # create vector from token embeds
-        token_embeds = self.sd.text_encoder.get_input_embeddings().weight.data
-        # stack the tokens along batch axis adding that axis
-        new_vector = torch.stack(
-            [token_embeds[token_id] for token_id in self.placeholder_token_ids],
-            dim=0
-        )
-        return new_vector
+        # shape is (tokens, 768) for SD 1.5
+        return self.token_embeddings[0].trainable_vectors.detach()
 
     @vec.setter
     def vec(self, new_vector):
-        # shape is (1, 768) for SD 1.5 for 1 token
-        token_embeds = self.sd.text_encoder.get_input_embeddings().weight.data
-        for i in range(new_vector.shape[0]):
-            # apply the weights to the placeholder tokens while preserving gradient
-            token_embeds[self.placeholder_token_ids[i]] = new_vector[i].clone()
-            x = 1
+        self.vecs = [new_vector]
+
+    # vectors for each text encoder
+    @property
+    def vecs(self) -> List[torch.Tensor]:
+        return [token_embedding.trainable_vectors.detach() for token_embedding in self.token_embeddings]
+
+    @vecs.setter
+    def vecs(self, new_vectors: List[torch.Tensor]):
+        if len(new_vectors) != len(self.token_embeddings):
+            raise ValueError(f"Expected {len(self.token_embeddings)} vectors, got {len(new_vectors)}")
+        with torch.no_grad():
+            for token_embedding, new_vector in zip(self.token_embeddings, new_vectors):
+                token_embedding.trainable_vectors.copy_(new_vector)
 
     # diffusers automatically expands the token meaning test123 becomes test123 test123_1 test123_2 etc
     # however, on training we don't use that pipeline, so we have to do it ourselves
@@ -133,7 +189,16 @@ class Embedding:
         return output_prompt
 
     def save(self, filename):
-        # todo check to see how to get the vector out of the embedding
+        if self.is_xl:
+            # sdxl format, a vector for each text encoder
+            clip_l, clip_g = self.vecs
+            if filename.endswith('.safetensors'):
+                metadata = OrderedDict({"name": json.dumps(self.name), "step": json.dumps(self.step)})
+                save_meta = get_meta_for_safetensors(metadata, name=self.name)
+                save_file({"clip_l": clip_l.contiguous(), "clip_g": clip_g.contiguous()}, filename, metadata=save_meta)
+            else:
+                torch.save({"clip_l": clip_l, "clip_g": clip_g, "name": self.name, "step": self.step}, filename)
+            return
 
         embedding_data = {
             "string_to_token": {"*": 265},
@@ -189,12 +254,23 @@ class Embedding:
 
                 data = {k: try_json(v) for k, v in metadata.items()}
                 data['string_to_param'] = {'*': tensors['emb_params']}
+            elif 'clip_l' in tensors and 'clip_g' in tensors:
+                data = dict(tensors)
+                if metadata and 'step' in metadata:
+                    data['step'] = json.loads(metadata['step'])
             else:
                 # old format
                 data = tensors
         else:
             return
 
+        if 'clip_l' in data and 'clip_g' in data:
+            # sdxl embeddings
+            if 'step' in data:
+                self.step = int(data['step'])
+            self.vecs = [data['clip_l'].detach().to(device), data['clip_g'].detach().to(device)]
+            return
+
         # textual inversion embeddings
         if 'string_to_param' in data:
             param_dict = data['string_to_param']
@@ -0,0 +1,60 @@
+import os
+
+
+class FileLock:
+    """
+    Exclusive lock on a file, held between processes. Used around read, modify, write cycles of
+    files that several jobs can touch at once. The lock file is deleted on release so they do not
+    pile up next to the files they guard.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.file = None
+
+    def __enter__(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        if os.name == 'nt':
+            import msvcrt
+            self.file = open(self.path, 'a+')
+            while True:
+                try:
+                    self.file.seek(0)
+                    msvcrt.locking(self.file.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    # LK_LOCK gives up after 10 seconds, keep waiting
+                    pass
+        else:
+            import fcntl
+            while True:
+                self.file = open(self.path, 'a+')
+                fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+                # the last holder may have deleted the file while we waited, then we hold a lock
+                # nobody else can see and have to lock the new file instead
+                try:
+                    if os.path.samestat(os.fstat(self.file.fileno()), os.stat(self.path)):
+                        break
+                except FileNotFoundError:
+                    pass
+                self.file.close()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if os.name == 'nt':
+            import msvcrt
+            self.file.seek(0)
+            msvcrt.locking(self.file.fileno(), msvcrt.LK_UNLCK, 1)
+            self.file.close()
+            try:
+                # fails while another process has it open, it deletes it when done
+                os.remove(self.path)
+            except OSError:
+                pass
+        else:
+            import fcntl
+            # deleted while still locked so waiters on this file know to start over
+            os.remove(self.path)
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+            self.file.close()
+        self.file = None
@@ -15,6 +15,8 @@ from diffusers import AutoencoderKL, DDIMScheduler, StableDiffusionPipeline, UNe
 from safetensors.torch import load_file, save_file
 from collections import OrderedDict
 
+from toolkit.meta_init import init_empty_weights, load_model_state_dict
+
 # DiffUsers版StableDiffusionのモデルパラメータ
 NUM_TRAIN_TIMESTEPS = 1000
 BETA_START = 0.00085
@@ -1208,23 +1210,28 @@ def load_checkpoint_with_text_encoder_conversion(ckpt_path, device="cpu"):
 
 # TODO dtype指定の動作が怪しいので確認する text_encoderを指定形式で作れるか未確認
 def load_models_from_stable_diffusion_checkpoint(v2, ckpt_path, device="cpu", dtype=None,
-                                                 unet_use_linear_projection_in_v2=False):
+                                                 unet_use_linear_projection_in_v2=False, low_cpu_mem_usage=False):
+    # low_cpu_mem_usage builds the models on the meta device and loads the checkpoint tensors into them
     _, state_dict = load_checkpoint_with_text_encoder_conversion(ckpt_path, device)
 
     # Convert the UNet2DConditionModel model.
     unet_config = create_unet_diffusers_config(v2, unet_use_linear_projection_in_v2)
     converted_unet_checkpoint = convert_ldm_unet_checkpoint(v2, state_dict, unet_config)
 
-    unet = UNet2DConditionModel(**unet_config).to(device)
-    info = unet.load_state_dict(converted_unet_checkpoint)
+    with init_empty_weights(low_cpu_mem_usage):
+        unet = UNet2DConditionModel(**unet_config)
+    info = load_model_state_dict(unet, converted_unet_checkpoint)
+    unet = unet.to(device)
     print("loading u-net:", info)
 
     # Convert the VAE model.
     vae_config = create_vae_diffusers_config()
     converted_vae_checkpoint = convert_ldm_vae_checkpoint(state_dict, vae_config)
 
-    vae = AutoencoderKL(**vae_config).to(device)
-    info = vae.load_state_dict(converted_vae_checkpoint)
+    with init_empty_weights(low_cpu_mem_usage):
+        vae = AutoencoderKL(**vae_config)
+    info = load_model_state_dict(vae, converted_vae_checkpoint)
+    vae = vae.to(device)
     print("loading vae:", info)
 
     # convert text_model
@@ -1251,20 +1258,27 @@ def load_models_from_stable_diffusion_checkpoint(v2, ckpt_path, device="cpu", dt
             torch_dtype="float32",
             transformers_version="4.25.0.dev0",
         )
-        text_model = CLIPTextModel._from_config(cfg)
-        info = text_model.load_state_dict(converted_text_encoder_checkpoint)
+        with init_empty_weights(low_cpu_mem_usage):
+            text_model = CLIPTextModel._from_config(cfg)
+        info = load_model_state_dict(text_model, converted_text_encoder_checkpoint)
     else:
         converted_text_encoder_checkpoint = convert_ldm_clip_checkpoint_v1(state_dict)
 
         logging.set_verbosity_error()  # don't show annoying warning
-        text_model = CLIPTextModel.from_pretrained("openai/clip-vit-large-patch14").to(device)
+        if low_cpu_mem_usage:
+            # only the config is needed, the weights come from the checkpoint
+            with init_empty_weights():
+                text_model = CLIPTextModel._from_config(CLIPTextConfig.from_pretrained("openai/clip-vit-large-patch14"))
+        else:
+            text_model = CLIPTextModel.from_pretrained("openai/clip-vit-large-patch14")
         logging.set_verbosity_warning()
 
         # latest transformers doesnt have position ids. Do we remove it?
         if "text_model.embeddings.position_ids" not in text_model.state_dict():
             del converted_text_encoder_checkpoint["text_model.embeddings.position_ids"]
 
-        info = text_model.load_state_dict(converted_text_encoder_checkpoint)
+        info = load_model_state_dict(text_model, converted_text_encoder_checkpoint)
+        text_model = text_model.to(device)
     print("loading text encoder:", info)
 
     return text_model, vae, unet
@@ -1441,7 +1455,7 @@ def save_diffusers_checkpoint(v2, output_dir, text_encoder, unet, pretrained_mod
 VAE_PREFIX = "first_stage_model."
 
 
-def load_vae(vae_id, dtype):
+def load_vae(vae_id, dtype, low_cpu_mem_usage=False):
     print(f"load VAE: {vae_id}")
     if os.path.isdir(vae_id) or not os.path.isfile(vae_id):
         # Diffusers local/remote
@@ -1480,8 +1494,9 @@ def load_vae(vae_id, dtype):
         # Convert the VAE model.
         converted_vae_checkpoint = convert_ldm_vae_checkpoint(vae_sd, vae_config)
 
-    vae = AutoencoderKL(**vae_config)
-    vae.load_state_dict(converted_vae_checkpoint)
+    with init_empty_weights(low_cpu_mem_usage):
+        vae = AutoencoderKL(**vae_config)
+    load_model_state_dict(vae, converted_vae_checkpoint)
     return vae
 
 
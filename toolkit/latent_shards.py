@@ -0,0 +1,160 @@
+import glob
+import os
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Dict, List, Tuple
+
+import torch
+from safetensors import safe_open
+from safetensors.torch import save_file
+from tqdm import tqdm
+
+SHARD_PREFIX = 'shard_'
+
+
+class LatentShardWriter:
+    """
+    Writes samples into safetensors shards of up to shard_size samples. Every key is stored as one tensor
+    stacked on a leading sample dim, so all samples in a shard must have the same shapes.
+    """
+
+    def __init__(self, shard_dir: str, shard_size: int = 256):
+        self.shard_dir = shard_dir
+        self.shard_size = shard_size
+        self.pending: Dict[str, List[torch.Tensor]] = OrderedDict()
+        self.num_pending = 0
+        os.makedirs(shard_dir, exist_ok=True)
+
+    def add(self, samples: Dict[str, torch.Tensor]):
+        # a batch of samples, sample dim first
+        num_samples = next(iter(samples.values())).shape[0]
+        for key, value in samples.items():
+            self.pending.setdefault(key, []).append(value.detach().to('cpu'))
+        self.num_pending += num_samples
+        if self.num_pending >= self.shard_size:
+            self.flush()
+
+    def flush(self):
+        if self.num_pending == 0:
+            return
+        state_dict = OrderedDict()
+        for key, values in self.pending.items():
+            state_dict[key] = torch.cat(values, dim=0).contiguous()
+        shard_path = os.path.join(self.shard_dir, f"{SHARD_PREFIX}{uuid.uuid4().hex}.safetensors")
+        tmp_path = shard_path + '.tmp'
+        save_file(state_dict, tmp_path, {'num_samples': str(self.num_pending)})
+        os.replace(tmp_path, shard_path)
+        self.pending = OrderedDict()
+        self.num_pending = 0
+
+
+def pack_single_sample_files(shard_dir: str, shard_size: int = 256) -> int:
+    """
+    Packs the old one sample per file format, tensors without a sample dim, into shards,
+    removing each file once it is in a shard. Returns the number of samples packed.
+    """
+    paths = sorted([
+        path for path in glob.glob(os.path.join(shard_dir, "*.safetensors"))
+        if not os.path.basename(path).startswith(SHARD_PREFIX)
+    ])
+    if len(paths) == 0:
+        return 0
+    print(f"Packing {len(paths)} latent files into shards")
+    writer = LatentShardWriter(shard_dir, shard_size)
+    # group by shape so every shard can be stacked
+    by_shape: Dict[Tuple, List[str]] = OrderedDict()
+    for path in paths:
+        with safe_open(path, framework="pt", device="cpu") as f:
+            shape = tuple([(key, tuple(f.get_slice(key).get_shape())) for key in sorted(f.keys())])
+        by_shape.setdefault(shape, []).append(path)
+    for group in by_shape.values():
+        for i in tqdm(range(0, len(group), shard_size), desc="Packing latents", leave=False):
+            batch_paths = group[i:i + shard_size]
+            samples: Dict[str, List[torch.Tensor]] = OrderedDict()
+            for path in batch_paths:
+                with safe_open(path, framework="pt", device="cpu") as f:
+                    for key in f.keys():
+                        samples.setdefault(key, []).append(f.get_tensor(key).unsqueeze(0))
+            writer.add(OrderedDict([(key, torch.cat(values, dim=0)) for key, values in samples.items()]))
+            writer.flush()
+            for path in batch_paths:
+                os.remove(path)
+    return len(paths)
+
+
+class LatentShardReader:
+    """
+    Memory mapped access to every sample in a folder of shards, one open handle per shard.
+    """
+
+    def __init__(self, shard_dir: str):
+        self.shard_dir = shard_dir
+        self.handles = []
+        self.keys: List[List[str]] = []
+        # (shard, index in shard) for every sample
+        self.index: List[Tuple[int, int]] = []
+        self.refresh()
+
+    def refresh(self):
+        # picks up shards written since the last refresh
+        known = set([handle_path for handle_path, _ in self.handles])
+        paths = sorted(glob.glob(os.path.join(self.shard_dir, f"{SHARD_PREFIX}*.safetensors")))
+        for path in paths:
+            if path in known:
+                continue
+            handle = safe_open(path, framework="pt", device="cpu")
+            keys = list(handle.keys())
+            num_samples = handle.get_slice(keys[0]).get_shape()[0]
+            shard_idx = len(self.handles)
+            self.handles.append((path, handle))
+            self.keys.append(keys)
+            self.index += [(shard_idx, i) for i in range(num_samples)]
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, idx: int) -> Dict[str, torch.Tensor]:
+        shard_idx, sample_idx = self.index[idx]
+        _, handle = self.handles[shard_idx]
+        sample = OrderedDict()
+        for key in self.keys[shard_idx]:
+            sample[key] = handle.get_slice(key)[sample_idx:sample_idx + 1][0]
+        return sample
+
+
+class PrefetchingSampler:
+    """
+    Random samples from a LatentShardReader, read a few ahead on a background thread
+    into pinned memory so a training step never waits on disk.
+    """
+
+    def __init__(self, reader: LatentShardReader, prefetch: int = 4):
+        if len(reader) == 0:
+            raise ValueError(f"No latent samples found in {reader.shard_dir}")
+        self.reader = reader
+        self.prefetch = max(1, prefetch)
+        self.pin_memory = torch.cuda.is_available()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.futures: deque = deque()
+
+    def _load(self, idx: int) -> Dict[str, torch.Tensor]:
+        sample = self.reader[idx]
+        if self.pin_memory:
+            sample = OrderedDict([(key, value.pin_memory()) for key, value in sample.items()])
+        return sample
+
+    def _fill(self):
+        while len(self.futures) < self.prefetch:
+            idx = torch.randint(0, len(self.reader), (1,)).item()
+            self.futures.append(self.executor.submit(self._load, idx))
+
+    def next(self) -> Dict[str, torch.Tensor]:
+        self._fill()
+        future: Future = self.futures.popleft()
+        sample = future.result()
+        self._fill()
+        return sample
+
+    def close(self):
+        self.executor.shutdown(wait=True)
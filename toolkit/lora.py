@@ -11,9 +11,8 @@ from collections import OrderedDict
 import torch
 import torch.nn as nn
 from diffusers import UNet2DConditionModel
-from safetensors.torch import save_file
 
-from toolkit.metadata import add_model_hash_to_meta
+from toolkit.saving import save_file_with_model_hash
 
 UNET_TARGET_REPLACE_MODULE_TRANSFORMER = [
     "Transformer2DModel",  # どうやらこっちの方らしい？ # attn1, 2
@@ -228,9 +227,9 @@ class LoRANetwork(nn.Module):
                 # remove any not lora
                 del state_dict[key]
 
-        metadata = add_model_hash_to_meta(state_dict, metadata)
         if os.path.splitext(file)[1] == ".safetensors":
-            save_file(state_dict, file, metadata)
+            # hashes are computed while the file is written
+            save_file_with_model_hash(state_dict, file, metadata)
         else:
             torch.save(state_dict, file)
 
@@ -7,6 +7,7 @@ from typing import List, Optional, Dict, Type, Union
 import torch
 from transformers import CLIPTextModel
 
+from .meta_init import get_meta_tensor_names, load_model_state_dict
 from .paths import SD_SCRIPTS_ROOT
 from .train_tools import get_torch_dtype
 
@@ -69,9 +70,9 @@ class LoRAModule(torch.nn.Module):
         self.scale = alpha / self.lora_dim
         self.register_buffer("alpha", torch.tensor(alpha))  # 定数として扱える
 
-        # same as microsoft's
-        torch.nn.init.kaiming_uniform_(self.lora_down.weight, a=math.sqrt(5))
-        torch.nn.init.zeros_(self.lora_up.weight)
+        # built under init_empty_weights the weights are loaded or initialized by materialize_weights
+        if not self.lora_down.weight.is_meta:
+            self.reset_parameters()
 
         self.multiplier: Union[float, List[float]] = multiplier
         self.org_module = org_module  # remove in applying
@@ -81,6 +82,18 @@ class LoRAModule(torch.nn.Module):
         self.is_checkpointing = False
         self.is_normalizing = False
         self.normalize_scaler = 1.0
+        # multiplier tensor for the last batch shape, rebuilt when the multiplier or shape changes
+        self._multiplier_cache_key = None
+        self._multiplier_cache = None
+        # when merged, the lora is folded into the original weights and the original is kept on the cpu
+        self.is_merged = False
+        self.merged_multiplier = None
+        self._org_weight_backup = None
+
+    def reset_parameters(self):
+        # same as microsoft's
+        torch.nn.init.kaiming_uniform_(self.lora_down.weight, a=math.sqrt(5))
+        torch.nn.init.zeros_(self.lora_up.weight)
 
     def apply_to(self):
         self.org_forward = self.org_module.forward
@@ -98,10 +111,15 @@ class LoRAModule(torch.nn.Module):
             # if there is more than our multiplier, it is likely a batch size increase, so we need to
             # interleave the multipliers
             if isinstance(self.multiplier, list):
-                if len(self.multiplier) == 0:
+                if len(self.multiplier) == 1:
                     # single item, just return it
                     return self.multiplier[0]
-                elif len(self.multiplier) == batch_size:
+
+                cache_key = (tuple(self.multiplier), batch_size, lora_up.dim(), lora_up.device, lora_up.dtype)
+                if cache_key == self._multiplier_cache_key:
+                    return self._multiplier_cache
+
+                if len(self.multiplier) == batch_size:
                     # not doing CFG
                     multiplier_tensor = torch.tensor(self.multiplier).to(lora_up.device, dtype=lora_up.dtype)
                 else:
@@ -119,7 +137,9 @@ class LoRAModule(torch.nn.Module):
                     multiplier_tensor = multiplier_tensor.view(-1, 1, 1)
                 elif len(lora_up.size()) == 4:
                     multiplier_tensor = multiplier_tensor.view(-1, 1, 1, 1)
-                return multiplier_tensor.detach()
+                self._multiplier_cache_key = cache_key
+                self._multiplier_cache = multiplier_tensor.detach()
+                return self._multiplier_cache
 
             else:
                 return self.multiplier
@@ -155,7 +175,16 @@ class LoRAModule(torch.nn.Module):
 
         return lx * scale
 
+    def is_multiplier_zero(self) -> bool:
+        if isinstance(self.multiplier, list):
+            return all([m == 0 for m in self.multiplier])
+        return self.multiplier == 0
+
     def forward(self, x):
+        # merged weights already include the lora, and a zero multiplier adds nothing
+        if self.is_merged or self.is_multiplier_zero():
+            return self.org_forward(x)
+
         org_forwarded = self.org_forward(x)
         lora_output = self._call_forward(x)
 
@@ -192,6 +221,53 @@ class LoRAModule(torch.nn.Module):
     def disable_gradient_checkpointing(self):
         self.is_checkpointing = False
 
+    def get_org_module(self) -> torch.nn.Module:
+        # the original module is removed in apply_to, but its forward is still bound to it
+        return self.org_forward.__self__
+
+    @torch.no_grad()
+    def get_merged_weight_delta(self, dtype=torch.float32) -> torch.Tensor:
+        up = self.lora_up.weight.to(dtype)
+        down = self.lora_down.weight.to(dtype)
+        if up.dim() == 2:
+            # linear
+            delta = up @ down
+        elif down.shape[2:] == (1, 1):
+            # conv 1x1
+            delta = (up.squeeze(3).squeeze(2) @ down.squeeze(3).squeeze(2)).unsqueeze(2).unsqueeze(3)
+        else:
+            # conv 3x3
+            delta = torch.nn.functional.conv2d(down.permute(1, 0, 2, 3), up).permute(1, 0, 2, 3)
+        return delta * self.scale
+
+    @torch.no_grad()
+    def merge_in(self):
+        # per batch multipliers cannot be folded into a single weight
+        if isinstance(self.multiplier, list):
+            self.unmerge()
+            return False
+        if self.is_merged:
+            if self.merged_multiplier == self.multiplier:
+                return True
+            self.unmerge()
+        org_weight = self.get_org_module().weight
+        self._org_weight_backup = org_weight.detach().to('cpu', copy=True)
+        delta = self.get_merged_weight_delta().to(org_weight.device) * self.multiplier
+        org_weight.copy_((org_weight.float() + delta).to(org_weight.dtype))
+        self.is_merged = True
+        self.merged_multiplier = self.multiplier
+        return True
+
+    @torch.no_grad()
+    def unmerge(self):
+        if not self.is_merged:
+            return
+        # restore from the backup so we get back exactly what we had, not something close after rounding
+        self.get_org_module().weight.copy_(self._org_weight_backup)
+        self._org_weight_backup = None
+        self.is_merged = False
+        self.merged_multiplier = None
+
     @torch.no_grad()
     def apply_stored_normalizer(self, target_normalize_scaler: float = 1.0):
         """
@@ -431,6 +507,35 @@ class LoRASpecialNetwork(LoRANetwork):
             assert lora.lora_name not in names, f"duplicated lora name: {lora.lora_name}"
             names.add(lora.lora_name)
 
+    def materialize_weights(self, file: Optional[str] = None, device: Union[str, torch.device] = 'cpu'):
+        """
+        Gives a network built under init_empty_weights real weights. Loras saved in file are loaded
+        straight from it, the rest are initialized like a new network. Call before apply_to.
+        """
+        weights_sd = {}
+        if file is not None:
+            if os.path.splitext(file)[1] == ".safetensors":
+                from safetensors.torch import load_file
+                weights_sd = load_file(file)
+            else:
+                weights_sd = torch.load(file, map_location="cpu")
+
+        num_loaded = 0
+        for lora in self.get_all_modules():
+            if len(get_meta_tensor_names(lora)) == 0:
+                continue
+            prefix = f"{lora.lora_name}."
+            lora_sd = {key[len(prefix):]: value for key, value in weights_sd.items() if key.startswith(prefix)}
+            if len(lora_sd) > 0:
+                load_model_state_dict(lora, lora_sd, strict=False)
+                num_loaded += 1
+            else:
+                lora.lora_down.to_empty(device=device)
+                lora.lora_up.to_empty(device=device)
+                lora.reset_parameters()
+        if file is not None:
+            print(f"loaded {num_loaded} of {len(self.get_all_modules())} LoRA modules from {file}")
+
     def save_weights(self, file, dtype, metadata):
         if metadata is not None and len(metadata) == 0:
             metadata = None
@@ -475,6 +580,11 @@ class LoRASpecialNetwork(LoRANetwork):
                 for lora in self.text_encoder_loras:
                     lora.multiplier = 0
 
+        # keep merged weights in sync with the multiplier
+        for lora in self.get_all_modules():
+            if getattr(lora, 'is_merged', False):
+                lora.merge_in()
+
     # called when the context manager is entered
     # ie: with network:
     def __enter__(self):
@@ -483,6 +593,7 @@ class LoRASpecialNetwork(LoRANetwork):
 
     def __exit__(self, exc_type, exc_value, tb):
         self.is_active = False
+        self.unmerge()
         self._update_lora_multiplier()
 
     def force_to(self, device, dtype):
@@ -533,3 +644,21 @@ class LoRASpecialNetwork(LoRANetwork):
     def apply_stored_normalizer(self, target_normalize_scaler: float = 1.0):
         for module in self.get_all_modules():
             module.apply_stored_normalizer(target_normalize_scaler)
+
+    @property
+    def is_merged(self) -> bool:
+        return any([getattr(module, 'is_merged', False) for module in self.get_all_modules()])
+
+    def merge_in(self):
+        """
+        Folds the loras into the weights they are attached to at the current multiplier, for inference only.
+        Call again after changing the multiplier, and unmerge before training or saving.
+        """
+        for module in self.get_all_modules():
+            if hasattr(module, 'merge_in'):
+                module.merge_in()
+
+    def unmerge(self):
+        for module in self.get_all_modules():
+            if hasattr(module, 'unmerge'):
+                module.unmerge()
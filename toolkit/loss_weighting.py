@@ -0,0 +1,112 @@
+from typing import Dict, List, Optional, Tuple, Union, Literal
+
+import torch
+
+LossWeightingType = Literal['none', 'min_snr', 'min_snr_v', 'debiased', 'custom']
+
+
+def get_snr_table(noise_scheduler, device) -> torch.Tensor:
+    # the table only depends on the scheduler's betas, so compute it once per device and keep it on the scheduler
+    if not hasattr(noise_scheduler, 'all_snr_by_device'):
+        noise_scheduler.all_snr_by_device = {}
+    device = torch.device(device)
+    if device not in noise_scheduler.all_snr_by_device:
+        if hasattr(noise_scheduler, 'all_snr'):
+            all_snr = noise_scheduler.all_snr
+        else:
+            with torch.no_grad():
+                alphas_cumprod = noise_scheduler.alphas_cumprod.float()
+                alpha = torch.sqrt(alphas_cumprod)
+                sigma = torch.sqrt(1.0 - alphas_cumprod)
+                all_snr = (alpha / sigma) ** 2
+        noise_scheduler.all_snr_by_device[device] = all_snr.detach().to(device)
+    return noise_scheduler.all_snr_by_device[device]
+
+
+def timesteps_to_index(timesteps, device) -> torch.Tensor:
+    if not isinstance(timesteps, torch.Tensor):
+        timesteps = torch.tensor(timesteps)
+    return timesteps.to(device).long().view(-1)
+
+
+class TimestepLossWeighting:
+    """
+    Per timestep loss weights. The full table of weights is built once per scheduler and device,
+    so weighting a batch is a single gather.
+
+    - min_snr: min(gamma / snr, 1) from https://arxiv.org/abs/2303.09556
+    - min_snr_v: the v-prediction form, min(snr, gamma) / (snr + 1)
+    - debiased: 1 / sqrt(snr), snr capped at 1000
+    - custom: a list of weights spread linearly over the training timesteps
+    """
+
+    def __init__(
+            self,
+            weighting: LossWeightingType = 'none',
+            gamma: Optional[float] = None,
+            curve: Optional[List[float]] = None,
+    ):
+        if weighting not in ['none', 'min_snr', 'min_snr_v', 'debiased', 'custom']:
+            raise ValueError(f"Unknown loss weighting {weighting}")
+        if weighting in ['min_snr', 'min_snr_v'] and gamma is None:
+            raise ValueError(f"{weighting} loss weighting needs min_snr_gamma")
+        if weighting == 'custom' and (curve is None or len(curve) == 0):
+            raise ValueError("custom loss weighting needs loss_weight_curve")
+        self.weighting = weighting
+        self.gamma = gamma
+        self.curve = curve
+        # (scheduler, table) by (id(scheduler), device). the scheduler is kept so the id stays unique
+        self.tables: Dict[Tuple[int, torch.device], Tuple[object, torch.Tensor]] = {}
+
+    @classmethod
+    def from_train_config(cls, train_config) -> 'TimestepLossWeighting':
+        return cls(
+            weighting=train_config.loss_weighting,
+            gamma=train_config.min_snr_gamma,
+            curve=train_config.loss_weight_curve,
+        )
+
+    @property
+    def is_active(self) -> bool:
+        return self.weighting != 'none'
+
+    def _build_table(self, noise_scheduler, device) -> torch.Tensor:
+        if self.weighting == 'custom':
+            num_timesteps = len(noise_scheduler.alphas_cumprod)
+            curve = torch.tensor(self.curve, dtype=torch.float32, device=device)
+            if len(curve) == 1:
+                return curve.expand(num_timesteps).clone()
+            # linear interpolation of the curve points over the timesteps
+            position = torch.linspace(0, len(curve) - 1, num_timesteps, device=device)
+            low = position.floor().long().clamp(max=len(curve) - 2)
+            frac = position - low
+            return curve[low] * (1 - frac) + curve[low + 1] * frac
+
+        snr = get_snr_table(noise_scheduler, device).float()
+        if self.weighting == 'min_snr':
+            return torch.clamp(self.gamma / snr, max=1.0)
+        elif self.weighting == 'min_snr_v':
+            return torch.minimum(snr, torch.full_like(snr, self.gamma)) / (snr + 1)
+        elif self.weighting == 'debiased':
+            return 1.0 / torch.sqrt(torch.clamp(snr, max=1000.0))
+        return torch.ones_like(snr)
+
+    def get_weight_table(self, noise_scheduler, device) -> torch.Tensor:
+        device = torch.device(device)
+        key = (id(noise_scheduler), device)
+        if key not in self.tables:
+            self.tables[key] = (noise_scheduler, self._build_table(noise_scheduler, device))
+        return self.tables[key][1]
+
+    def get_weights(self, timesteps, noise_scheduler, device) -> torch.Tensor:
+        table = self.get_weight_table(noise_scheduler, device)
+        return table[timesteps_to_index(timesteps, device)]
+
+    def __call__(self, loss: torch.Tensor, timesteps: Union[torch.Tensor, List[int], int], noise_scheduler):
+        # loss is per sample, or a scalar for a single timestep
+        if not self.is_active:
+            return loss
+        weights = self.get_weights(timesteps, noise_scheduler, loss.device)
+        if loss.dim() == 0:
+            return loss * weights.mean()
+        return loss * weights.view(-1)
@@ -1,5 +1,4 @@
 import torch
-from .llvae import LosslessLatentEncoder
 
 
 def total_variation(image):
@@ -47,41 +46,37 @@ def get_gradient_penalty(critic, real, fake, device):
         return gradient_penalty
 
 
+def get_pattern_cell_means(images: torch.Tensor, pattern_size: int) -> torch.Tensor:
+    # mean of each pixel position in the pattern_size grid, per color. (batch, colors, pattern_size, pattern_size)
+    # the same values the lossless latent encoder puts in its channels, without building them
+    batch, colors, height, width = images.shape
+    height = height // pattern_size
+    width = width // pattern_size
+    images = images[:, :, :height * pattern_size, :width * pattern_size]
+    cells = images.reshape(batch, colors, height, pattern_size, width, pattern_size)
+    return cells.mean(dim=(2, 4))
+
+
 class PatternLoss(torch.nn.Module):
+    """
+    Compares how far each pixel position of a pattern_size grid strays from the color mean,
+    between pred and target. Loss per image in the batch.
+    """
+
     def __init__(self, pattern_size=4, dtype=torch.float32):
         super().__init__()
         self.pattern_size = pattern_size
-        self.llvae_encoder = LosslessLatentEncoder(3, pattern_size, dtype=dtype)
-
-    def forward(self, pred, target):
-        pred_latents = self.llvae_encoder(pred)
-        target_latents = self.llvae_encoder(target)
-
-        matrix_pixels = self.pattern_size * self.pattern_size
-
-        color_chans = pred_latents.shape[1] // 3
-        # pytorch
-        r_chans, g_chans, b_chans = torch.split(pred_latents, [color_chans, color_chans, color_chans], 1)
-        r_chans_target, g_chans_target, b_chans_target = torch.split(target_latents, [color_chans, color_chans, color_chans], 1)
-
-        def separated_chan_loss(latent_chan):
-            nonlocal matrix_pixels
-            chan_mean = torch.mean(latent_chan, dim=[1, 2, 3])
-            chan_splits = torch.split(latent_chan, [1 for i in range(matrix_pixels)], 1)
-            chan_loss = None
-            for chan in chan_splits:
-                this_mean = torch.mean(chan, dim=[1, 2, 3])
-                this_chan_loss = torch.abs(this_mean - chan_mean)
-                if chan_loss is None:
-                    chan_loss = this_chan_loss
-                else:
-                    chan_loss = chan_loss + this_chan_loss
-            chan_loss = chan_loss * (1 / matrix_pixels)
-            return chan_loss
-
-        r_chan_loss = torch.abs(separated_chan_loss(r_chans) - separated_chan_loss(r_chans_target))
-        g_chan_loss = torch.abs(separated_chan_loss(g_chans) - separated_chan_loss(g_chans_target))
-        b_chan_loss = torch.abs(separated_chan_loss(b_chans) - separated_chan_loss(b_chans_target))
-        return (r_chan_loss + g_chan_loss + b_chan_loss) * 0.3333
+        self.dtype = dtype
 
+    def get_pattern_deviation(self, images: torch.Tensor) -> torch.Tensor:
+        cell_means = get_pattern_cell_means(images.float(), self.pattern_size).flatten(2)
+        color_means = cell_means.mean(dim=2, keepdim=True)
+        # mean distance of the cells from their color mean, (batch, colors)
+        return torch.abs(cell_means - color_means).mean(dim=2)
 
+    def forward(self, pred, target):
+        # pred and target in one pass
+        deviation = self.get_pattern_deviation(torch.cat([pred, target], dim=0))
+        pred_deviation, target_deviation = deviation.chunk(2, dim=0)
+        loss = torch.abs(pred_deviation - target_deviation).sum(dim=1) * 0.3333
+        return loss.to(pred.dtype)
@@ -1,5 +1,8 @@
 # heavily based on https://github.com/KohakuBlueleaf/LyCORIS/blob/main/lycoris/utils.py
 
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 from typing import *
 
 import numpy as np
@@ -22,18 +25,18 @@ def make_sparse(t: torch.Tensor, sparsity=0.95):
     return sparse_t
 
 
-def extract_conv(
-        weight: Union[torch.Tensor, nn.Parameter],
-        mode='fixed',
-        mode_param=0,
-        device='cpu',
-        is_cp=False,
-) -> Tuple[nn.Parameter, nn.Parameter]:
-    weight = weight.to(device)
-    out_ch, in_ch, kernel_size, _ = weight.shape
+# singular vectors past the rank for svd_lowrank, and its power iterations. more is slower but closer to a full svd
+SVD_LOWRANK_OVERSAMPLE = 8
+SVD_LOWRANK_NITER = 4
+# allclose defaults, used to skip layers that did not change
+UNCHANGED_RTOL = 1e-5
+UNCHANGED_ATOL = 1e-8
+
+LINEAR_LAYERS = {'Linear', 'LoRACompatibleLinear'}
+CONV_LAYERS = {'Conv2d', 'LoRACompatibleConv'}
 
-    U, S, Vh = linalg.svd(weight.reshape(out_ch, -1))
 
+def get_lora_rank(S: torch.Tensor, mode='fixed', mode_param=0):
     if mode == 'fixed':
         lora_rank = mode_param
     elif mode == 'threshold':
@@ -50,20 +53,70 @@ def extract_conv(
         lora_rank = torch.sum(s_cum < min_cum_sum)
     else:
         raise NotImplementedError('Extract mode should be "fixed", "threshold", "ratio" or "quantile"')
-    lora_rank = max(1, lora_rank)
-    lora_rank = min(out_ch, in_ch, lora_rank)
-    if lora_rank >= out_ch / 2 and not is_cp:
-        return weight, 'full'
+    return lora_rank
+
+
+def decompose(
+        matrix: torch.Tensor,
+        mode='fixed',
+        mode_param=0,
+        out_ch=None,
+        in_ch=None,
+        is_cp=False,
+):
+    """
+    Returns (U @ diag(S), Vh) truncated to the lora rank, or None when the rank is so high the layer
+    should be stored as a full diff. Fixed ranks only compute the top singular vectors with svd_lowrank,
+    the other modes need the whole spectrum to pick a rank so they use a full svd.
+    """
+    if mode not in ['fixed', 'threshold', 'ratio', 'quantile', 'percentile']:
+        raise NotImplementedError('Extract mode should be "fixed", "threshold", "ratio" or "quantile"')
+    min_dim = min(matrix.shape)
+    if mode == 'fixed':
+        lora_rank = min(out_ch, in_ch, max(1, mode_param))
+        if lora_rank >= out_ch / 2 and not is_cp:
+            return None
+        q = lora_rank + SVD_LOWRANK_OVERSAMPLE
+        if q < min_dim:
+            U, S, V = torch.svd_lowrank(matrix.float(), q=q, niter=SVD_LOWRANK_NITER)
+            Vh = V.T
+        else:
+            U, S, Vh = linalg.svd(matrix)
+    else:
+        U, S, Vh = linalg.svd(matrix)
+        lora_rank = get_lora_rank(S, mode, mode_param)
+        lora_rank = max(1, lora_rank)
+        lora_rank = min(out_ch, in_ch, lora_rank)
+        if lora_rank >= out_ch / 2 and not is_cp:
+            return None
 
     U = U[:, :lora_rank]
     S = S[:lora_rank]
-    U = U @ torch.diag(S)
-    Vh = Vh[:lora_rank, :]
+    U = (U @ torch.diag(S)).to(matrix.dtype)
+    Vh = Vh[:lora_rank, :].to(matrix.dtype)
+    return U, Vh
+
+
+def extract_conv(
+        weight: Union[torch.Tensor, nn.Parameter],
+        mode='fixed',
+        mode_param=0,
+        device='cpu',
+        is_cp=False,
+) -> Tuple[nn.Parameter, nn.Parameter]:
+    weight = weight.to(device)
+    out_ch, in_ch, kernel_size, _ = weight.shape
+
+    decomposed = decompose(weight.reshape(out_ch, -1), mode, mode_param, out_ch, in_ch, is_cp)
+    if decomposed is None:
+        return weight, 'full'
+    U, Vh = decomposed
+    lora_rank = U.shape[1]
 
     diff = (weight - (U @ Vh).reshape(out_ch, in_ch, kernel_size, kernel_size)).detach()
     extract_weight_A = Vh.reshape(lora_rank, in_ch, kernel_size, kernel_size).detach()
     extract_weight_B = U.reshape(out_ch, lora_rank, 1, 1).detach()
-    del U, S, Vh, weight
+    del U, Vh, weight
     return (extract_weight_A, extract_weight_B, diff), 'low rank'
 
 
@@ -76,41 +129,200 @@ def extract_linear(
     weight = weight.to(device)
     out_ch, in_ch = weight.shape
 
-    U, S, Vh = linalg.svd(weight)
-
-    if mode == 'fixed':
-        lora_rank = mode_param
-    elif mode == 'threshold':
-        assert mode_param >= 0
-        lora_rank = torch.sum(S > mode_param)
-    elif mode == 'ratio':
-        assert 1 >= mode_param >= 0
-        min_s = torch.max(S) * mode_param
-        lora_rank = torch.sum(S > min_s)
-    elif mode == 'quantile' or mode == 'percentile':
-        assert 1 >= mode_param >= 0
-        s_cum = torch.cumsum(S, dim=0)
-        min_cum_sum = mode_param * torch.sum(S)
-        lora_rank = torch.sum(s_cum < min_cum_sum)
-    else:
-        raise NotImplementedError('Extract mode should be "fixed", "threshold", "ratio" or "quantile"')
-    lora_rank = max(1, lora_rank)
-    lora_rank = min(out_ch, in_ch, lora_rank)
-    if lora_rank >= out_ch / 2:
+    decomposed = decompose(weight, mode, mode_param, out_ch, in_ch)
+    if decomposed is None:
         return weight, 'full'
-
-    U = U[:, :lora_rank]
-    S = S[:lora_rank]
-    U = U @ torch.diag(S)
-    Vh = Vh[:lora_rank, :]
+    U, Vh = decomposed
+    lora_rank = U.shape[1]
 
     diff = (weight - U @ Vh).detach()
     extract_weight_A = Vh.reshape(lora_rank, in_ch).detach()
     extract_weight_B = U.reshape(out_ch, lora_rank).detach()
-    del U, S, Vh, weight
+    del U, Vh, weight
     return (extract_weight_A, extract_weight_B, diff), 'low rank'
 
 
+class ExtractLayerTask:
+    def __init__(
+            self,
+            lora_name: str,
+            layer_type: str,
+            base_weight: torch.Tensor,
+            tuned_weight: torch.Tensor,
+    ):
+        self.lora_name = lora_name
+        # linear or conv
+        self.layer_type = layer_type
+        self.base_weight = base_weight
+        self.tuned_weight = tuned_weight
+
+    @property
+    def num_bytes(self) -> int:
+        # rough working set, both weights, the diff and the svd
+        weight = self.base_weight
+        return weight.numel() * weight.element_size() * 4
+
+    def load(self) -> Tuple[torch.Tensor, torch.Tensor]:
+        return self.base_weight, self.tuned_weight
+
+
+class ExtractLayerResult:
+    def __init__(self, lora_name: str, tensors: 'OrderedDict', seconds: float):
+        self.lora_name = lora_name
+        self.tensors = tensors
+        self.seconds = seconds
+
+
+def extract_layer(
+        task: ExtractLayerTask,
+        mode='fixed',
+        linear_mode_param=0,
+        conv_mode_param=0,
+        extract_device='cpu',
+        use_bias=False,
+        sparsity=0.98,
+        small_conv=True,
+) -> ExtractLayerResult:
+    # module level so it can run in the process pool
+    start_time = time.time()
+    loras = OrderedDict()
+    lora_name = task.lora_name
+    base_weight, tuned_weight = task.load()
+    base_weight = base_weight.to(extract_device)
+    tuned_weight = tuned_weight.to(extract_device)
+
+    # same as torch.allclose but we need the diff anyway
+    weight_diff = tuned_weight - base_weight
+    if torch.all(torch.abs(weight_diff) <= UNCHANGED_ATOL + UNCHANGED_RTOL * torch.abs(base_weight)):
+        return ExtractLayerResult(lora_name, loras, time.time() - start_time)
+    del base_weight
+
+    if task.layer_type == 'linear':
+        weight, decompose_mode = extract_linear(
+            weight_diff,
+            mode,
+            linear_mode_param,
+            device=extract_device,
+        )
+        if decompose_mode == 'low rank':
+            extract_a, extract_b, diff = weight
+    else:
+        is_linear = (tuned_weight.shape[2] == 1
+                     and tuned_weight.shape[3] == 1)
+        weight, decompose_mode = extract_conv(
+            weight_diff,
+            mode,
+            linear_mode_param if is_linear else conv_mode_param,
+            device=extract_device,
+        )
+        if decompose_mode == 'low rank':
+            extract_a, extract_b, diff = weight
+        if small_conv and not is_linear and decompose_mode == 'low rank':
+            dim = extract_a.size(0)
+            (extract_c, extract_a, _), _ = extract_conv(
+                extract_a.transpose(0, 1),
+                'fixed', dim,
+                extract_device, True
+            )
+            extract_a = extract_a.transpose(0, 1)
+            extract_c = extract_c.transpose(0, 1)
+            loras[f'{lora_name}.lora_mid.weight'] = extract_c.detach().cpu().contiguous().half()
+            diff = tuned_weight.cpu() - torch.einsum(
+                'i j k l, j r, p i -> p r k l',
+                extract_c, extract_a.flatten(1, -1), extract_b.flatten(1, -1)
+            ).detach().cpu().contiguous()
+            del extract_c
+
+    if decompose_mode == 'low rank':
+        loras[f'{lora_name}.lora_down.weight'] = extract_a.detach().cpu().contiguous().half()
+        loras[f'{lora_name}.lora_up.weight'] = extract_b.detach().cpu().contiguous().half()
+        loras[f'{lora_name}.alpha'] = torch.Tensor([extract_a.shape[0]]).half()
+        if use_bias:
+            diff = diff.detach().cpu().reshape(extract_b.size(0), -1)
+            sparse_diff = make_sparse(diff, sparsity).to_sparse().coalesce()
+
+            indices = sparse_diff.indices().to(torch.int16)
+            values = sparse_diff.values().half()
+            loras[f'{lora_name}.bias_indices'] = indices
+            loras[f'{lora_name}.bias_values'] = values
+            loras[f'{lora_name}.bias_size'] = torch.tensor(diff.shape).to(torch.int16)
+        del extract_a, extract_b, diff
+    elif decompose_mode == 'full':
+        loras[f'{lora_name}.diff'] = weight.detach().cpu().contiguous().half()
+    else:
+        raise NotImplementedError
+    return ExtractLayerResult(lora_name, loras, time.time() - start_time)
+
+
+def _init_extract_worker(num_threads: int):
+    # split the cores between the workers instead of every worker trying to use all of them
+    torch.set_num_threads(num_threads)
+
+
+def run_extract_tasks(
+        tasks: List[ExtractLayerTask],
+        on_result: Callable[[ExtractLayerResult], None],
+        num_workers: int = 1,
+        memory_budget_mb: int = 4096,
+        **extract_kwargs
+):
+    """
+    Runs the layer extractions, in a process pool when num_workers > 1. Layers are only submitted while
+    their estimated working set fits in the memory budget, and results are handed to on_result as soon
+    as they finish so they can be written out and dropped.
+    """
+    if num_workers <= 1:
+        for task in tqdm(tasks, desc="Extracting"):
+            on_result(extract_layer(task, **extract_kwargs))
+        return
+
+    memory_budget = memory_budget_mb * 1024 * 1024
+    num_threads = max(1, (os.cpu_count() or 1) // num_workers)
+    progress_bar = tqdm(total=len(tasks), desc="Extracting")
+    with ProcessPoolExecutor(
+            max_workers=num_workers,
+            initializer=_init_extract_worker,
+            initargs=(num_threads,)
+    ) as executor:
+        pending = {}
+        in_flight = 0
+        task_idx = 0
+        while task_idx < len(tasks) or len(pending) > 0:
+            # always allow one so a layer bigger than the budget still runs
+            while task_idx < len(tasks) and len(pending) < num_workers * 2 and \
+                    (len(pending) == 0 or in_flight + tasks[task_idx].num_bytes <= memory_budget):
+                task = tasks[task_idx]
+                future = executor.submit(extract_layer, task, **extract_kwargs)
+                pending[future] = task.num_bytes
+                in_flight += task.num_bytes
+                task_idx += 1
+            done, _ = wait(list(pending.keys()), return_when=FIRST_COMPLETED)
+            for future in done:
+                in_flight -= pending.pop(future)
+                on_result(future.result())
+                progress_bar.update(1)
+    progress_bar.close()
+
+
+def print_extract_timings(results: List[Tuple[str, float]], num_slowest: int = 10):
+    if len(results) == 0:
+        return
+    total = sum([seconds for _, seconds in results])
+    print(f"Extracted {len(results)} layers, {total:.1f}s of layer time")
+    print(f"Slowest layers:")
+    for lora_name, seconds in sorted(results, key=lambda x: x[1], reverse=True)[:num_slowest]:
+        print(f" - {lora_name}: {seconds:.2f}s")
+
+
+def get_extract_num_workers(num_workers: Optional[int], extract_device='cpu') -> int:
+    if num_workers is not None:
+        return max(1, num_workers)
+    if torch.device(extract_device).type != 'cpu':
+        # one process owns the gpu
+        return 1
+    return max(1, min(8, (os.cpu_count() or 1) // 2))
+
+
 def extract_diff(
         base_model,
         db_model,
@@ -124,7 +336,14 @@ def extract_diff(
         linear_only=False,
         extract_unet=True,
         extract_text_encoder=True,
+        num_workers: Optional[int] = None,
+        memory_budget_mb: int = 4096,
+        writer=None,
 ):
+    """
+    Extracts a lora / locon from the difference between two models. If a writer with an add(key, tensor)
+    method is passed, finished layers go straight to it and the returned state dict is empty.
+    """
     meta = OrderedDict()
 
     UNET_TARGET_REPLACE_MODULE = [
@@ -159,14 +378,26 @@ def extract_diff(
     LORA_PREFIX_UNET = 'lora_unet'
     LORA_PREFIX_TEXT_ENCODER = 'lora_te'
 
-    def make_state_dict(
+    def get_task(lora_name, module, base_weight) -> Optional[ExtractLayerTask]:
+        layer = module.__class__.__name__
+        if layer in LINEAR_LAYERS:
+            return ExtractLayerTask(lora_name, 'linear', base_weight.detach(), module.weight.detach())
+        elif layer in CONV_LAYERS:
+            is_linear = (module.weight.shape[2] == 1
+                         and module.weight.shape[3] == 1)
+            if not is_linear and linear_only:
+                return None
+            return ExtractLayerTask(lora_name, 'conv', base_weight.detach(), module.weight.detach())
+        return None
+
+    def collect_tasks(
             prefix,
             root_module: torch.nn.Module,
             target_module: torch.nn.Module,
             target_replace_modules,
             target_replace_names=[]
-    ):
-        loras = {}
+    ) -> List[ExtractLayerTask]:
+        tasks = []
         temp = {}
         temp_name = {}
 
@@ -174,168 +405,323 @@ def extract_diff(
             if module.__class__.__name__ in target_replace_modules:
                 temp[name] = {}
                 for child_name, child_module in module.named_modules():
-                    if child_module.__class__.__name__ not in {'Linear', 'LoRACompatibleLinear', 'Conv2d', 'LoRACompatibleConv'}:
+                    if child_module.__class__.__name__ not in LINEAR_LAYERS | CONV_LAYERS:
                         continue
                     temp[name][child_name] = child_module.weight
             elif name in target_replace_names:
                 temp_name[name] = module.weight
 
-        for name, module in tqdm(list(target_module.named_modules())):
+        for name, module in target_module.named_modules():
             if name in temp:
                 weights = temp[name]
                 for child_name, child_module in module.named_modules():
                     lora_name = prefix + '.' + name + '.' + child_name
                     lora_name = lora_name.replace('.', '_')
-                    layer = child_module.__class__.__name__
-                    if layer in {'Linear', 'LoRACompatibleLinear', 'Conv2d', 'LoRACompatibleConv'}:
-                        root_weight = child_module.weight
-                        if torch.allclose(root_weight, weights[child_name]):
-                            continue
-
-                    if layer == 'Linear' or layer == 'LoRACompatibleLinear':
-                        weight, decompose_mode = extract_linear(
-                            (child_module.weight - weights[child_name]),
-                            mode,
-                            linear_mode_param,
-                            device=extract_device,
-                        )
-                        if decompose_mode == 'low rank':
-                            extract_a, extract_b, diff = weight
-                    elif layer == 'Conv2d' or layer == 'LoRACompatibleConv':
-                        is_linear = (child_module.weight.shape[2] == 1
-                                     and child_module.weight.shape[3] == 1)
-                        if not is_linear and linear_only:
-                            continue
-                        weight, decompose_mode = extract_conv(
-                            (child_module.weight - weights[child_name]),
-                            mode,
-                            linear_mode_param if is_linear else conv_mode_param,
-                            device=extract_device,
-                        )
-                        if decompose_mode == 'low rank':
-                            extract_a, extract_b, diff = weight
-                        if small_conv and not is_linear and decompose_mode == 'low rank':
-                            dim = extract_a.size(0)
-                            (extract_c, extract_a, _), _ = extract_conv(
-                                extract_a.transpose(0, 1),
-                                'fixed', dim,
-                                extract_device, True
-                            )
-                            extract_a = extract_a.transpose(0, 1)
-                            extract_c = extract_c.transpose(0, 1)
-                            loras[f'{lora_name}.lora_mid.weight'] = extract_c.detach().cpu().contiguous().half()
-                            diff = child_module.weight - torch.einsum(
-                                'i j k l, j r, p i -> p r k l',
-                                extract_c, extract_a.flatten(1, -1), extract_b.flatten(1, -1)
-                            ).detach().cpu().contiguous()
-                            del extract_c
-                    else:
+                    if child_name not in weights:
                         continue
-                    if decompose_mode == 'low rank':
-                        loras[f'{lora_name}.lora_down.weight'] = extract_a.detach().cpu().contiguous().half()
-                        loras[f'{lora_name}.lora_up.weight'] = extract_b.detach().cpu().contiguous().half()
-                        loras[f'{lora_name}.alpha'] = torch.Tensor([extract_a.shape[0]]).half()
-                        if use_bias:
-                            diff = diff.detach().cpu().reshape(extract_b.size(0), -1)
-                            sparse_diff = make_sparse(diff, sparsity).to_sparse().coalesce()
-
-                            indices = sparse_diff.indices().to(torch.int16)
-                            values = sparse_diff.values().half()
-                            loras[f'{lora_name}.bias_indices'] = indices
-                            loras[f'{lora_name}.bias_values'] = values
-                            loras[f'{lora_name}.bias_size'] = torch.tensor(diff.shape).to(torch.int16)
-                        del extract_a, extract_b, diff
-                    elif decompose_mode == 'full':
-                        loras[f'{lora_name}.diff'] = weight.detach().cpu().contiguous().half()
-                    else:
-                        raise NotImplementedError
+                    task = get_task(lora_name, child_module, weights[child_name])
+                    if task is not None:
+                        tasks.append(task)
             elif name in temp_name:
-                weights = temp_name[name]
                 lora_name = prefix + '.' + name
                 lora_name = lora_name.replace('.', '_')
-                layer = module.__class__.__name__
-
-                if layer in {'Linear', 'LoRACompatibleLinear', 'Conv2d', 'LoRACompatibleConv'}:
-                    root_weight = module.weight
-                    if torch.allclose(root_weight, weights):
-                        continue
+                task = get_task(lora_name, module, temp_name[name])
+                if task is not None:
+                    tasks.append(task)
+        return tasks
 
-                if layer == 'Linear' or layer == 'LoRACompatibleLinear':
-                    weight, decompose_mode = extract_linear(
-                        (root_weight - weights),
-                        mode,
-                        linear_mode_param,
-                        device=extract_device,
-                    )
-                    if decompose_mode == 'low rank':
-                        extract_a, extract_b, diff = weight
-                elif layer == 'Conv2d' or layer == 'LoRACompatibleConv':
-                    is_linear = (
-                            root_weight.shape[2] == 1
-                            and root_weight.shape[3] == 1
-                    )
-                    if not is_linear and linear_only:
-                        continue
-                    weight, decompose_mode = extract_conv(
-                        (root_weight - weights),
-                        mode,
-                        linear_mode_param if is_linear else conv_mode_param,
-                        device=extract_device,
-                    )
-                    if decompose_mode == 'low rank':
-                        extract_a, extract_b, diff = weight
-                    if small_conv and not is_linear and decompose_mode == 'low rank':
-                        dim = extract_a.size(0)
-                        (extract_c, extract_a, _), _ = extract_conv(
-                            extract_a.transpose(0, 1),
-                            'fixed', dim,
-                            extract_device, True
-                        )
-                        extract_a = extract_a.transpose(0, 1)
-                        extract_c = extract_c.transpose(0, 1)
-                        loras[f'{lora_name}.lora_mid.weight'] = extract_c.detach().cpu().contiguous().half()
-                        diff = root_weight - torch.einsum(
-                            'i j k l, j r, p i -> p r k l',
-                            extract_c, extract_a.flatten(1, -1), extract_b.flatten(1, -1)
-                        ).detach().cpu().contiguous()
-                        del extract_c
-                else:
-                    continue
-                if decompose_mode == 'low rank':
-                    loras[f'{lora_name}.lora_down.weight'] = extract_a.detach().cpu().contiguous().half()
-                    loras[f'{lora_name}.lora_up.weight'] = extract_b.detach().cpu().contiguous().half()
-                    loras[f'{lora_name}.alpha'] = torch.Tensor([extract_a.shape[0]]).half()
-                    if use_bias:
-                        diff = diff.detach().cpu().reshape(extract_b.size(0), -1)
-                        sparse_diff = make_sparse(diff, sparsity).to_sparse().coalesce()
-
-                        indices = sparse_diff.indices().to(torch.int16)
-                        values = sparse_diff.values().half()
-                        loras[f'{lora_name}.bias_indices'] = indices
-                        loras[f'{lora_name}.bias_values'] = values
-                        loras[f'{lora_name}.bias_size'] = torch.tensor(diff.shape).to(torch.int16)
-                    del extract_a, extract_b, diff
-                elif decompose_mode == 'full':
-                    loras[f'{lora_name}.diff'] = weight.detach().cpu().contiguous().half()
-                else:
-                    raise NotImplementedError
-        return loras
-
-    text_encoder_loras = make_state_dict(
+    text_encoder_tasks = collect_tasks(
         LORA_PREFIX_TEXT_ENCODER,
         base_model[0], db_model[0],
         TEXT_ENCODER_TARGET_REPLACE_MODULE
     )
 
-    unet_loras = make_state_dict(
+    unet_tasks = collect_tasks(
         LORA_PREFIX_UNET,
         base_model[2], db_model[2],
         UNET_TARGET_REPLACE_MODULE,
         UNET_TARGET_REPLACE_NAME
     )
-    print(len(text_encoder_loras), len(unet_loras))
-    # the | will
-    return (text_encoder_loras | unet_loras), meta
+
+    # nested targets, like an Attention inside a Transformer2DModel, give the same layer twice
+    tasks = OrderedDict()
+    for task in text_encoder_tasks + unet_tasks:
+        if task.lora_name not in tasks:
+            tasks[task.lora_name] = task
+
+    loras = run_extract_diff_tasks(
+        list(tasks.values()),
+        mode=mode,
+        linear_mode_param=linear_mode_param,
+        conv_mode_param=conv_mode_param,
+        extract_device=extract_device,
+        use_bias=use_bias,
+        sparsity=sparsity,
+        small_conv=small_conv,
+        num_workers=num_workers,
+        memory_budget_mb=memory_budget_mb,
+        writer=writer,
+    )
+    print(len(text_encoder_tasks), len(unet_tasks))
+    return loras, meta
+
+
+def run_extract_diff_tasks(
+        tasks: List[ExtractLayerTask],
+        num_workers: Optional[int] = None,
+        memory_budget_mb: int = 4096,
+        writer=None,
+        **extract_kwargs
+) -> 'OrderedDict':
+    # shared by the model and the file based extraction
+    loras = OrderedDict()
+    timings = []
+
+    def on_result(result: ExtractLayerResult):
+        timings.append((result.lora_name, result.seconds))
+        for key, value in result.tensors.items():
+            if writer is not None:
+                writer.add(key, value)
+            else:
+                loras[key] = value
+
+    run_extract_tasks(
+        tasks,
+        on_result,
+        num_workers=get_extract_num_workers(num_workers, extract_kwargs.get('extract_device', 'cpu')),
+        memory_budget_mb=memory_budget_mb,
+        **extract_kwargs
+    )
+    print_extract_timings(timings)
+    return loras
+
+
+# ldm checkpoints opened by this process, the tensors stay memory mapped until a layer needs them
+_safe_open_handles: Dict[str, object] = {}
+
+# diffusers module paths that extract_diff targets, by the module type it searches for
+UNET_EXTRACT_PATTERNS = ['.attentions.', '.resnets.', '.downsamplers.', '.upsamplers.']
+UNET_EXTRACT_LINEAR_ONLY_PATTERNS = ['.attentions.']
+UNET_EXTRACT_NAMES = ['conv_in', 'conv_out', 'time_embedding.linear_1', 'time_embedding.linear_2']
+UNET_EXTRACT_LINEAR_ONLY_NAMES = ['conv_in', 'conv_out']
+TEXT_ENCODER_EXTRACT_PATTERNS = ['.self_attn.', '.mlp.']
+
+# diffusers key prefix in the keymaps to lora name prefix
+LORA_PREFIXES = {
+    'unet': 'lora_unet',
+    'te': 'lora_te',
+    'te0': 'lora_te1',
+    'te1': 'lora_te2',
+}
+
+
+def get_safe_open_handle(file_path: str):
+    if file_path not in _safe_open_handles:
+        from safetensors import safe_open
+        _safe_open_handles[file_path] = safe_open(file_path, framework="pt", device="cpu")
+    return _safe_open_handles[file_path]
+
+
+def get_sd_version_from_keys(keys) -> str:
+    for key in keys:
+        if key.startswith('conditioner.embedders.'):
+            return 'sdxl'
+        if key.startswith('cond_stage_model.model.'):
+            return '2'
+    return '1'
+
+
+def get_ldm_lora_targets(sd_version: str) -> List[Tuple[str, str, str, str, Optional[str]]]:
+    """
+    Every weight in the keymap a lora can target, as (lora_name, prefix, module_path, ldm_key, ldm_slice).
+    ldm_slice is set when the diffusers weight is a slice of the ldm one.
+    """
+    from toolkit.saving import get_ldm_mapping, get_ldm_paths
+
+    _, mapping_path = get_ldm_paths(sd_version)
+    mapping = get_ldm_mapping(mapping_path)
+
+    # diffusers key -> (ldm key, slice)
+    sources = OrderedDict()
+    for ldm_key, diffusers_key in mapping['ldm_diffusers_keymap'].items():
+        sources[diffusers_key] = (ldm_key, None)
+    for diffusers_key, operator in mapping['diffusers_ldm_operator_map'].items():
+        if 'slice' in operator:
+            sources[diffusers_key] = (operator['slice'][0], operator['slice'][1])
+
+    targets = []
+    for diffusers_key, (ldm_key, ldm_slice) in sources.items():
+        if not diffusers_key.endswith('.weight') or '.MERGED.' in diffusers_key:
+            continue
+        prefix, module_path = diffusers_key[:-len('.weight')].split('_', 1)
+        if prefix not in LORA_PREFIXES:
+            continue
+        lora_name = f"{LORA_PREFIXES[prefix]}_{module_path.replace('.', '_')}"
+        targets.append((lora_name, prefix, module_path, ldm_key, ldm_slice))
+    return targets
+
+
+class SafetensorsExtractLayerTask(ExtractLayerTask):
+    """
+    A layer that is read from the two checkpoints when the worker gets to it, so only the layers being
+    decomposed are ever in memory. The task only holds the paths and keys, which also keeps it cheap to
+    send to the process pool.
+    """
+
+    def __init__(
+            self,
+            lora_name: str,
+            layer_type: str,
+            base_path: str,
+            tuned_path: str,
+            ldm_key: str,
+            ldm_slice: Optional[str],
+            shape: List[int],
+    ):
+        super().__init__(lora_name, layer_type, None, None)
+        self.base_path = base_path
+        self.tuned_path = tuned_path
+        self.ldm_key = ldm_key
+        # q, k and v are slices of in_proj in open clip
+        self.ldm_slice = ldm_slice
+        self.shape = shape
+
+    @property
+    def num_bytes(self) -> int:
+        # loaded as float32
+        return int(np.prod(self.shape)) * 4 * 4
+
+    def _load_tensor(self, file_path: str) -> torch.Tensor:
+        from toolkit.saving import get_slices_from_string
+        handle = get_safe_open_handle(file_path)
+        if self.ldm_slice is not None:
+            tensor = handle.get_slice(self.ldm_key)[get_slices_from_string(self.ldm_slice)]
+        else:
+            tensor = handle.get_tensor(self.ldm_key)
+        return tensor.reshape(self.shape).float()
+
+    def load(self) -> Tuple[torch.Tensor, torch.Tensor]:
+        return self._load_tensor(self.base_path), self._load_tensor(self.tuned_path)
+
+
+def get_extract_tasks_from_files(
+        base_path: str,
+        tuned_path: str,
+        sd_version: Optional[str] = None,
+        linear_only=False,
+        extract_unet=True,
+        extract_text_encoder=True,
+) -> List[SafetensorsExtractLayerTask]:
+    """
+    Builds the extraction tasks for two ldm safetensors checkpoints through the keymaps, without loading
+    any weights. The lora names match the ones extract_diff makes from the diffusers models.
+    """
+    from safetensors import safe_open
+    from toolkit.saving import get_ldm_mapping, get_ldm_paths, get_slices_from_string
+
+    with safe_open(base_path, framework="pt", device="cpu") as base_file, \
+            safe_open(tuned_path, framework="pt", device="cpu") as tuned_file:
+        base_keys = set(base_file.keys())
+        tuned_keys = set(tuned_file.keys())
+        if sd_version is None:
+            sd_version = get_sd_version_from_keys(base_keys)
+        _, mapping_path = get_ldm_paths(sd_version)
+        shape_map = get_ldm_mapping(mapping_path)['ldm_diffusers_shape_map']
+
+        unet_patterns = UNET_EXTRACT_LINEAR_ONLY_PATTERNS if linear_only else UNET_EXTRACT_PATTERNS
+        unet_names = UNET_EXTRACT_LINEAR_ONLY_NAMES if linear_only else UNET_EXTRACT_NAMES
+
+        tasks = []
+        num_missing = 0
+        for lora_name, prefix, module_path, ldm_key, ldm_slice in get_ldm_lora_targets(sd_version):
+            if prefix == 'unet':
+                if not extract_unet:
+                    continue
+                if module_path not in unet_names and not any([p in module_path for p in unet_patterns]):
+                    continue
+            else:
+                if not extract_text_encoder:
+                    continue
+                if not any([p in module_path for p in TEXT_ENCODER_EXTRACT_PATTERNS]):
+                    continue
+
+            if ldm_key not in base_keys or ldm_key not in tuned_keys:
+                num_missing += 1
+                continue
+
+            shape = base_file.get_slice(ldm_key).get_shape()
+            if shape != tuned_file.get_slice(ldm_key).get_shape():
+                raise ValueError(f"Shape mismatch for {ldm_key}, the models are not the same architecture")
+            if ldm_slice is not None:
+                # only need the shape, this does not read the tensor
+                shape = list(torch.empty(shape, device='meta')[get_slices_from_string(ldm_slice)].shape)
+            if ldm_key in shape_map:
+                shape = shape_map[ldm_key][1]
+            shape = list(shape)
+
+            if len(shape) == 2:
+                layer_type = 'linear'
+            elif len(shape) == 4:
+                if linear_only and (shape[2] != 1 or shape[3] != 1):
+                    continue
+                layer_type = 'conv'
+            else:
+                continue
+
+            tasks.append(SafetensorsExtractLayerTask(
+                lora_name, layer_type, base_path, tuned_path, ldm_key, ldm_slice, shape
+            ))
+
+    if num_missing > 0:
+        print(f"Skipped {num_missing} layers missing from one of the checkpoints")
+    return tasks
+
+
+def extract_diff_from_files(
+        base_path: str,
+        tuned_path: str,
+        mode='fixed',
+        linear_mode_param=0,
+        conv_mode_param=0,
+        extract_device='cpu',
+        use_bias=False,
+        sparsity=0.98,
+        small_conv=True,
+        linear_only=False,
+        extract_unet=True,
+        extract_text_encoder=True,
+        num_workers: Optional[int] = None,
+        memory_budget_mb: int = 4096,
+        writer=None,
+        sd_version: Optional[str] = None,
+):
+    """
+    Same as extract_diff, but reads the two ldm safetensors checkpoints one layer at a time instead of
+    taking loaded models.
+    """
+    meta = OrderedDict()
+    tasks = get_extract_tasks_from_files(
+        base_path,
+        tuned_path,
+        sd_version=sd_version,
+        linear_only=linear_only,
+        extract_unet=extract_unet,
+        extract_text_encoder=extract_text_encoder,
+    )
+    loras = run_extract_diff_tasks(
+        tasks,
+        mode=mode,
+        linear_mode_param=linear_mode_param,
+        conv_mode_param=conv_mode_param,
+        extract_device=extract_device,
+        use_bias=use_bias,
+        sparsity=sparsity,
+        small_conv=small_conv,
+        num_workers=num_workers,
+        memory_budget_mb=memory_budget_mb,
+        writer=writer,
+    )
+    return loras, meta
 
 
 def get_module(
@@ -0,0 +1,266 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import List, Optional, Dict, Literal, Tuple
+
+import torch
+from safetensors import safe_open
+from tqdm import tqdm
+
+from toolkit.config_modules import MergeModelConfig
+from toolkit.lycoris_utils import get_ldm_lora_targets, get_module, get_sd_version_from_keys, rebuild_weight
+from toolkit.saving import save_file_streaming, get_slices_from_string, SafetensorsStreamWriter, \
+    TORCH_DTYPES_FROM_SAFETENSORS
+
+MergeMethod = Literal['weighted_sum', 'add_difference']
+
+UNET_LDM_PREFIX = 'model.diffusion_model.'
+TEXT_ENCODER_LDM_PREFIXES = ('cond_stage_model.', 'conditioner.')
+
+
+def get_block_name(ldm_key: str) -> Optional[str]:
+    # block names used by block_weights, vae keys have none
+    if ldm_key.startswith(UNET_LDM_PREFIX):
+        parts = ldm_key[len(UNET_LDM_PREFIX):].split('.')
+        if parts[0] == 'input_blocks':
+            return f"IN{int(parts[1]):02d}"
+        if parts[0] == 'middle_block':
+            return 'M00'
+        if parts[0] == 'output_blocks':
+            return f"OUT{int(parts[1]):02d}"
+        return 'UNET'
+    if ldm_key.startswith(TEXT_ENCODER_LDM_PREFIXES):
+        return 'BASE'
+    return None
+
+
+class MergeInput:
+    # an open safetensors file and the config it came from
+    def __init__(self, config: MergeModelConfig):
+        self.config = config
+        self.handle = safe_open(config.path, framework="pt", device="cpu")
+        self.keys = set(self.handle.keys())
+
+    def get_tensor(self, key: str) -> torch.Tensor:
+        return self.handle.get_tensor(key)
+
+    def get_weight(self, key: str) -> float:
+        return self.config.get_weight(get_block_name(key))
+
+
+class LoraInput(MergeInput):
+    def __init__(self, config: MergeModelConfig):
+        super().__init__(config)
+        self.keys_by_name: Dict[str, List[str]] = OrderedDict()
+        for key in sorted(self.keys):
+            self.keys_by_name.setdefault(key.split('.')[0], []).append(key)
+
+    def get_module_state_dict(self, lora_name: str, device='cpu') -> 'OrderedDict':
+        state_dict = OrderedDict()
+        for key in self.keys_by_name.get(lora_name, []):
+            state_dict[key] = self.get_tensor(key).to(device, dtype=torch.float32)
+        return state_dict
+
+
+class CheckpointMerger:
+    """
+    Merges safetensors checkpoints one tensor at a time, so memory use is a few tensors per model no matter
+    how many models are merged. Loras can be merged into the result as it is built.
+
+    - weighted_sum: sum(weight * model) / sum(weight), or without dividing when normalize is off
+    - add_difference: first + sum(weight * (model - difference_base)) over the other models
+
+    Keys come from the first model. Tensors a model is missing are left out of the merge for that key.
+    """
+
+    def __init__(
+            self,
+            models: List[MergeModelConfig],
+            method: MergeMethod = 'weighted_sum',
+            difference_base: Optional[str] = None,
+            loras: Optional[List[MergeModelConfig]] = None,
+            normalize: bool = True,
+            sd_version: Optional[str] = None,
+            num_threads: int = 1,
+            device='cpu',
+    ):
+        if len(models) == 0:
+            raise ValueError("At least one model is needed to merge")
+        if method not in ['weighted_sum', 'add_difference']:
+            raise ValueError(f"Unknown merge method {method}")
+        if method == 'add_difference' and difference_base is None:
+            raise ValueError("add_difference needs a difference_base model")
+        self.method = method
+        self.normalize = normalize
+        self.num_threads = max(1, num_threads)
+        self.device = torch.device(device)
+
+        self.models = [MergeInput(model) for model in models]
+        self.difference_base = MergeInput(MergeModelConfig(path=difference_base)) \
+            if difference_base is not None else None
+        self.loras = [LoraInput(lora) for lora in (loras or [])]
+
+        # ldm key -> [(lora_name, slice)]
+        self.lora_targets: Dict[str, List[Tuple[str, Optional[str]]]] = {}
+        self.merged_lora_names = set()
+        if len(self.loras) > 0:
+            if sd_version is None:
+                sd_version = get_sd_version_from_keys(self.models[0].keys)
+            for lora_name, _, _, ldm_key, ldm_slice in get_ldm_lora_targets(sd_version):
+                self.lora_targets.setdefault(ldm_key, []).append((lora_name, ldm_slice))
+
+    def _merge_models(self, key: str) -> torch.Tensor:
+        models = [model for model in self.models if key in model.keys]
+        first = models[0].get_tensor(key)
+        if not first.is_floating_point():
+            # position ids and such
+            return first
+
+        if self.method == 'add_difference':
+            merged = first.to(self.device, dtype=torch.float32)
+            if key not in self.difference_base.keys:
+                return merged
+            base = self.difference_base.get_tensor(key).to(self.device, dtype=torch.float32)
+            for model in models[1:]:
+                merged += (model.get_tensor(key).to(self.device, dtype=torch.float32) - base) * model.get_weight(key)
+            return merged
+
+        weights = [model.get_weight(key) for model in models]
+        total_weight = sum(weights) if self.normalize else 1.0
+        if total_weight == 0:
+            # every model is turned off for this block, keep the first one as is
+            return first.to(self.device, dtype=torch.float32)
+        merged = None
+        for model, weight in zip(models, weights):
+            if weight == 0:
+                continue
+            tensor = model.get_tensor(key).to(self.device, dtype=torch.float32) * (weight / total_weight)
+            merged = tensor if merged is None else merged.add_(tensor)
+            del tensor
+        return merged
+
+    def _merge_loras(self, key: str, merged: torch.Tensor) -> torch.Tensor:
+        for lora_name, ldm_slice in self.lora_targets.get(key, []):
+            for lora in self.loras:
+                if lora_name not in lora.keys_by_name:
+                    continue
+                module_type, params = get_module(lora.get_module_state_dict(lora_name, self.device), lora_name)
+                if module_type == 'None':
+                    continue
+                if ldm_slice is not None:
+                    slices = get_slices_from_string(ldm_slice)
+                    merged[slices] = rebuild_weight(module_type, params, merged[slices], lora.get_weight(key))
+                else:
+                    merged = rebuild_weight(module_type, params, merged, lora.get_weight(key))
+                self.merged_lora_names.add(lora_name)
+        return merged
+
+    @torch.no_grad()
+    def get_tensor(self, key: str) -> torch.Tensor:
+        merged = self._merge_models(key)
+        if key in self.lora_targets:
+            merged = self._merge_loras(key, merged)
+        return merged
+
+    def save(self, output_path: str, dtype: torch.dtype = torch.float16, metadata: Optional[Dict[str, str]] = None):
+        first = self.models[0]
+        tensor_shapes = OrderedDict()
+        tensor_dtypes = {}
+        for key in sorted(first.keys):
+            tensor_slice = first.handle.get_slice(key)
+            tensor_shapes[key] = tensor_slice.get_shape()
+            tensor_dtype = TORCH_DTYPES_FROM_SAFETENSORS.get(tensor_slice.get_dtype(), None)
+            if tensor_dtype is not None and not tensor_dtype.is_floating_point:
+                tensor_dtypes[key] = tensor_dtype
+
+        keys = list(tensor_shapes.keys())
+        progress_bar = tqdm(total=len(keys), desc="Merging")
+        # merge the next few keys on other threads while the current one is written
+        with ThreadPoolExecutor(max_workers=self.num_threads) as executor:
+            futures: Dict[str, Future] = OrderedDict()
+            next_idx = 0
+
+            def get_tensor(key: str) -> torch.Tensor:
+                nonlocal next_idx
+                while next_idx < len(keys) and len(futures) < self.num_threads + 1:
+                    futures[keys[next_idx]] = executor.submit(self.get_tensor, keys[next_idx])
+                    next_idx += 1
+                tensor = futures.pop(key).result()
+                progress_bar.update(1)
+                return tensor
+
+            save_file_streaming(tensor_shapes, get_tensor, output_path, dtype, metadata, tensor_dtypes=tensor_dtypes)
+        progress_bar.close()
+
+        if len(self.loras) > 0:
+            num_lora_names = len(set([name for lora in self.loras for name in lora.keys_by_name.keys()]))
+            print(f"Merged {len(self.merged_lora_names)} of {num_lora_names} lora modules")
+
+
+def get_locon_delta(up: torch.Tensor, down: torch.Tensor, mid: Optional[torch.Tensor], alpha) -> torch.Tensor:
+    # the full weight change of a locon module, with alpha applied
+    if mid is not None:
+        shape = [up.size(0), down.size(1), mid.size(2), mid.size(3)]
+    else:
+        shape = [up.size(0)] + list(down.shape[1:])
+    return rebuild_weight('locon', (up, down, mid, alpha), torch.zeros(shape, device=up.device))
+
+
+@torch.no_grad()
+def merge_loras(
+        loras: List[MergeModelConfig],
+        output_path: str,
+        dtype: torch.dtype = torch.float16,
+        metadata: Optional[Dict[str, str]] = None,
+        device='cpu',
+):
+    """
+    Merges lora / locon files into one, a module at a time. Plain lora modules are merged exactly by
+    stacking their ranks, with each weight and alpha folded into the up weights. Modules with a cp mid
+    weight or full diffs are merged as full diffs. Other lycoris types can only be merged into a checkpoint.
+    """
+    inputs = [LoraInput(lora) for lora in loras]
+    lora_names = []
+    for lora_input in inputs:
+        for lora_name in lora_input.keys_by_name.keys():
+            if lora_name not in lora_names:
+                lora_names.append(lora_name)
+
+    writer = SafetensorsStreamWriter(output_path, dtype=dtype)
+    try:
+        for lora_name in tqdm(lora_names, desc="Merging"):
+            modules = []
+            for lora_input in inputs:
+                if lora_name not in lora_input.keys_by_name:
+                    continue
+                module_type, params = get_module(lora_input.get_module_state_dict(lora_name, device), lora_name)
+                if module_type not in ['locon', 'full']:
+                    raise ValueError(f"Cannot merge {module_type} module {lora_name} into another lora")
+                modules.append((module_type, params, lora_input.config.weight))
+
+            if all([module_type == 'locon' and params[2] is None for module_type, params, _ in modules]):
+                ups = []
+                downs = []
+                for _, (up, down, _, alpha), weight in modules:
+                    scale = weight
+                    if alpha is not None:
+                        scale = scale * alpha / up.size(1)
+                    ups.append(up * scale)
+                    downs.append(down)
+                up = torch.cat(ups, dim=1)
+                writer.add(f"{lora_name}.lora_up.weight", up)
+                writer.add(f"{lora_name}.lora_down.weight", torch.cat(downs, dim=0))
+                # the scale is already in up
+                writer.add(f"{lora_name}.alpha", torch.tensor(float(up.size(1))))
+            else:
+                diff = None
+                for module_type, params, weight in modules:
+                    if module_type == 'locon':
+                        delta = get_locon_delta(*params) * weight
+                    else:
+                        delta = params * weight
+                    diff = delta if diff is None else diff + delta.reshape(diff.shape)
+                writer.add(f"{lora_name}.diff", diff)
+    except Exception:
+        writer.abort()
+        raise
+    writer.close(metadata)
@@ -0,0 +1,46 @@
+from contextlib import nullcontext
+from itertools import chain
+from typing import Dict
+
+import torch
+
+
+def init_empty_weights(enabled: bool = True):
+    """
+    Context where new modules get their parameters on the meta device, so building them allocates no
+    memory and runs no initializers. Buffers stay real since non persistent ones, like position ids,
+    are not in checkpoints. Give the module real weights with load_model_state_dict.
+    """
+    if not enabled:
+        return nullcontext()
+    from accelerate import init_empty_weights as accelerate_init_empty_weights
+    return accelerate_init_empty_weights(include_buffers=False)
+
+
+def get_meta_tensor_names(module: torch.nn.Module):
+    return [
+        name for name, tensor in chain(module.named_parameters(), module.named_buffers()) if tensor.is_meta
+    ]
+
+
+def load_model_state_dict(module: torch.nn.Module, state_dict: Dict[str, torch.Tensor], strict: bool = True):
+    """
+    load_state_dict that also works on modules built under init_empty_weights. Then the state dict tensors
+    become the module tensors instead of being copied in, so tensors from a safetensors file stay memory
+    mapped until moved. Floating point tensors are cast to the dtype the module was built in, like a
+    copying load would.
+    """
+    if len(get_meta_tensor_names(module)) == 0:
+        return module.load_state_dict(state_dict, strict=strict)
+
+    module_state_dict = module.state_dict(keep_vars=True)
+    state_dict = {
+        key: value.to(module_state_dict[key].dtype)
+        if key in module_state_dict and value.is_floating_point() else value
+        for key, value in state_dict.items()
+    }
+    info = module.load_state_dict(state_dict, strict=strict, assign=True)
+    meta_names = get_meta_tensor_names(module)
+    if len(meta_names) > 0:
+        raise ValueError(f"{len(meta_names)} weights were not in the state dict, for example: {meta_names[:5]}")
+    return info
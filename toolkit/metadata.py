@@ -1,13 +1,13 @@
+import hashlib
 import json
+import mmap
+import struct
 from collections import OrderedDict
-from io import BytesIO
+from typing import Optional, Dict
 
-import safetensors
 from safetensors import safe_open
 
 from info import software_meta
-from toolkit.train_tools import addnet_hash_legacy
-from toolkit.train_tools import addnet_hash_safetensors
 
 
 def get_meta_for_safetensors(meta: OrderedDict, name=None, add_software_info=True) -> OrderedDict:
@@ -26,25 +26,99 @@ def get_meta_for_safetensors(meta: OrderedDict, name=None, add_software_info=Tru
     return save_meta
 
 
-def add_model_hash_to_meta(state_dict, meta: OrderedDict) -> OrderedDict:
-    """Precalculate the model hashes needed by sd-webui-additional-networks to
-    save time on indexing the model later."""
+# sd-webui-additional-networks hashes, see addnet_hash_safetensors and addnet_hash_legacy
+LEGACY_HASH_OFFSET = 0x100000
+LEGACY_HASH_SIZE = 0x10000
 
+
+def get_hash_metadata(meta: OrderedDict) -> OrderedDict:
     # Because writing user metadata to the file can change the result of
     # sd_models.model_hash(), only retain the training metadata for purposes of
     # calculating the hash, as they are meant to be immutable
-    metadata = {k: v for k, v in meta.items() if k.startswith("ss_")}
+    return OrderedDict([(k, v) for k, v in meta.items() if k.startswith("ss_")])
+
+
+class ModelHasher:
+    """
+    Computes the sshs hashes of a safetensors file while it is written. Feed it the data region in order,
+    it is seeded with the length and header of the file the hashes are defined over.
+    """
+
+    def __init__(self, hash_header: bytes):
+        self.sha256 = hashlib.sha256()
+        self.legacy_window = bytearray()
+        # position in the file the hashes are defined over
+        self.position = 0
+        self._update_legacy(hash_header)
+
+    def _update_legacy(self, data):
+        start = max(self.position, LEGACY_HASH_OFFSET)
+        end = min(self.position + len(data), LEGACY_HASH_OFFSET + LEGACY_HASH_SIZE)
+        if start < end:
+            self.legacy_window += data[start - self.position:end - self.position]
+        self.position += len(data)
+
+    def update(self, data):
+        # tensor data, the model hash only covers this part
+        self.sha256.update(data)
+        self._update_legacy(data)
+
+    def get_hashes(self):
+        return self.sha256.hexdigest(), hashlib.sha256(self.legacy_window).hexdigest()[0:8]
+
+    @staticmethod
+    def add_placeholder_hashes(meta: Optional[Dict[str, str]]) -> OrderedDict:
+        meta = OrderedDict(meta or {})
+        meta["sshs_model_hash"] = '0' * 64
+        meta["sshs_legacy_hash"] = '0' * 8
+        return meta
+
+    def add_hashes(self, meta: Dict[str, str]) -> OrderedDict:
+        meta = OrderedDict(meta)
+        meta["sshs_model_hash"], meta["sshs_legacy_hash"] = self.get_hashes()
+        return meta
 
-    bytes = safetensors.torch.save(state_dict, metadata)
-    b = BytesIO(bytes)
 
-    model_hash = addnet_hash_safetensors(b)
-    legacy_hash = addnet_hash_legacy(b)
-    meta["sshs_model_hash"] = model_hash
-    meta["sshs_legacy_hash"] = legacy_hash
+def add_model_hash_to_meta(state_dict, meta: OrderedDict) -> OrderedDict:
+    """Precalculate the model hashes needed by sd-webui-additional-networks to
+    save time on indexing the model later."""
+    from toolkit.saving import build_safetensors_header, get_safetensors_header_bytes, get_safetensors_key_order, \
+        tensor_to_bytes, SAFETENSORS_DTYPES
+
+    # hash the tensors in the order safetensors would write them instead of serializing a copy of the model
+    dtype_names = {key: SAFETENSORS_DTYPES[value.dtype] for key, value in state_dict.items()}
+    keys = get_safetensors_key_order(dtype_names)
+    tensor_shapes = OrderedDict([(key, list(state_dict[key].shape)) for key in keys])
+    header_bytes = get_safetensors_header_bytes(
+        build_safetensors_header(tensor_shapes, dtype_names, get_hash_metadata(meta))
+    )
+    hasher = ModelHasher(struct.pack('<Q', len(header_bytes)) + header_bytes)
+    for key in keys:
+        hasher.update(tensor_to_bytes(state_dict[key].detach().to('cpu').contiguous()))
+
+    meta["sshs_model_hash"], meta["sshs_legacy_hash"] = hasher.get_hashes()
     return meta
 
 
+def hash_file(file_path: str, block_size: int = 64 * 1024 * 1024):
+    """
+    The sshs model hash and legacy hash of a safetensors file on disk, the same as addnet_hash_safetensors
+    and addnet_hash_legacy. The file is memory mapped and hashed in large blocks.
+    """
+    with open(file_path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            header_size = struct.unpack('<Q', mm[:8])[0]
+            model_hasher = hashlib.sha256()
+            view = memoryview(mm)
+            try:
+                for start in range(header_size + 8, len(mm), block_size):
+                    model_hasher.update(view[start:start + block_size])
+                legacy_hash = hashlib.sha256(view[LEGACY_HASH_OFFSET:LEGACY_HASH_OFFSET + LEGACY_HASH_SIZE])
+            finally:
+                view.release()
+    return model_hasher.hexdigest(), legacy_hash.hexdigest()[0:8]
+
+
 def add_base_model_info_to_meta(
         meta: OrderedDict,
         base_model: str = None,
@@ -0,0 +1,167 @@
+import hashlib
+import json
+import os
+import uuid
+import weakref
+from collections import OrderedDict
+from typing import Dict, Optional, TYPE_CHECKING
+
+import torch
+from safetensors import safe_open
+from safetensors.torch import save_file
+
+from toolkit.file_lock import FileLock
+from toolkit.stable_diffusion_model import PromptEmbeds
+
+if TYPE_CHECKING:
+    from toolkit.stable_diffusion_model import StableDiffusion
+
+PROMPT_STORE_INDEX_FILE = 'index.json'
+PROMPT_STORE_VERSION = 1
+
+# hashing the text encoder weights takes a few seconds, only do it once per text encoder. Weak keys so
+# a new text encoder that reuses the memory of a freed one is never given its hash
+text_encoder_hash_cache: 'weakref.WeakKeyDictionary[torch.nn.Module, str]' = weakref.WeakKeyDictionary()
+
+
+def get_text_encoder_hash(text_encoder) -> str:
+    # hash the weights so a swapped or fine-tuned text encoder never reuses stale embeddings
+    if isinstance(text_encoder, list):
+        hashes = [get_text_encoder_hash(te) for te in text_encoder]
+        return hashlib.sha256('\n'.join(hashes).encode('utf-8')).hexdigest()
+    if text_encoder in text_encoder_hash_cache:
+        return text_encoder_hash_cache[text_encoder]
+    hasher = hashlib.sha256()
+    for key, value in text_encoder.state_dict().items():
+        value = value.detach().to('cpu').contiguous()
+        hasher.update(f"{key}:{value.dtype}".encode('utf-8'))
+        hasher.update(value.reshape(-1).view(torch.uint8).numpy().data)
+    text_encoder_hash = hasher.hexdigest()
+    text_encoder_hash_cache[text_encoder] = text_encoder_hash
+    return text_encoder_hash
+
+
+def get_prompt_store_model_key(sd: 'StableDiffusion') -> str:
+    tokenizers = sd.tokenizer if isinstance(sd.tokenizer, list) else [sd.tokenizer]
+    key_dict = OrderedDict({
+        'text_encoder_hash': get_text_encoder_hash(sd.text_encoder),
+        'is_xl': sd.is_xl,
+        'is_v2': sd.is_v2,
+        'use_text_encoder_1': sd.use_text_encoder_1,
+        'use_text_encoder_2': sd.use_text_encoder_2,
+        'max_length': [tokenizer.model_max_length for tokenizer in tokenizers],
+    })
+    return hashlib.sha256(json.dumps(key_dict).encode('utf-8')).hexdigest()
+
+
+class PromptEmbedsStore:
+    """
+    Prompt embeddings on disk, shared between runs and trainers. Embeddings are keyed by a hash of the
+    model key and the prompt, so one folder can hold embeddings for any number of models. They are
+    stored in safetensors shards with an index, read through memory mapped handles when asked for.
+    New embeddings are written as a new shard on flush, existing shards are never rewritten.
+    """
+
+    def __init__(self, store_dir: str, model_key: str, shard_size: int = 1024):
+        self.store_dir = store_dir
+        self.model_key = model_key
+        self.shard_size = shard_size
+        os.makedirs(store_dir, exist_ok=True)
+        self.index = self._load_index()
+        self.pending: OrderedDict = OrderedDict()
+        self.shard_handles: Dict[str, object] = {}
+        self.shard_keys: Dict[str, set] = {}
+
+    def _load_index(self) -> OrderedDict:
+        index_path = os.path.join(self.store_dir, PROMPT_STORE_INDEX_FILE)
+        if os.path.exists(index_path):
+            with open(index_path, 'r') as f:
+                index = json.load(f, object_pairs_hook=OrderedDict)
+            if index.get('version', None) == PROMPT_STORE_VERSION:
+                return index
+            print(f"  -  Prompt store version mismatch, rebuilding {index_path}")
+        return OrderedDict({
+            'version': PROMPT_STORE_VERSION,
+            'shards': [],
+            'prompts': OrderedDict(),
+        })
+
+    def _save_index(self):
+        index_path = os.path.join(self.store_dir, PROMPT_STORE_INDEX_FILE)
+        tmp_path = index_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.index, f)
+        os.replace(tmp_path, index_path)
+
+    def get_key(self, prompt: str) -> str:
+        return hashlib.sha256(f"{self.model_key}\n{prompt}".encode('utf-8')).hexdigest()
+
+    def __len__(self):
+        return len(self.index['prompts']) + len(self.pending)
+
+    def __contains__(self, prompt: str) -> bool:
+        key = self.get_key(prompt)
+        return key in self.pending or key in self.index['prompts']
+
+    def _get_shard_handle(self, shard_name: str):
+        if shard_name not in self.shard_handles:
+            self.shard_handles[shard_name] = safe_open(
+                os.path.join(self.store_dir, shard_name), framework="pt", device="cpu"
+            )
+            self.shard_keys[shard_name] = set(self.shard_handles[shard_name].keys())
+        return self.shard_handles[shard_name]
+
+    def get(self, prompt: str) -> Optional[PromptEmbeds]:
+        key = self.get_key(prompt)
+        if key in self.pending:
+            prompt_embeds = self.pending[key]
+            return PromptEmbeds([prompt_embeds.text_embeds, prompt_embeds.pooled_embeds])
+        shard_name = self.index['prompts'].get(key, None)
+        if shard_name is None:
+            return None
+        handle = self._get_shard_handle(shard_name)
+        text_embeds = handle.get_tensor(f"{key}.text_embeds")
+        pooled_embeds = None
+        if f"{key}.pooled_embeds" in self.shard_keys[shard_name]:
+            pooled_embeds = handle.get_tensor(f"{key}.pooled_embeds")
+        return PromptEmbeds([text_embeds, pooled_embeds])
+
+    def add(self, prompt: str, prompt_embeds: PromptEmbeds):
+        key = self.get_key(prompt)
+        if key in self.index['prompts'] or key in self.pending:
+            return
+        self.pending[key] = PromptEmbeds([
+            prompt_embeds.text_embeds.detach().to('cpu').clone(),
+            prompt_embeds.pooled_embeds.detach().to('cpu').clone() if prompt_embeds.pooled_embeds is not None else None
+        ])
+        if len(self.pending) >= self.shard_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.pending) == 0:
+            return
+        state_dict = OrderedDict()
+        for key, prompt_embeds in self.pending.items():
+            state_dict[f"{key}.text_embeds"] = prompt_embeds.text_embeds.contiguous()
+            if prompt_embeds.pooled_embeds is not None:
+                state_dict[f"{key}.pooled_embeds"] = prompt_embeds.pooled_embeds.contiguous()
+
+        # unique name so runs sharing the store never write the same shard
+        shard_name = f"prompts_{uuid.uuid4().hex}.safetensors"
+        shard_path = os.path.join(self.store_dir, shard_name)
+        tmp_path = shard_path + '.tmp'
+        save_file(state_dict, tmp_path)
+        os.replace(tmp_path, shard_path)
+
+        # pick up shards other runs added since we loaded the index. Locked so two runs flushing at
+        # once can not drop each other's shards from the index
+        with FileLock(os.path.join(self.store_dir, PROMPT_STORE_INDEX_FILE + '.lock')):
+            index = self._load_index()
+            for key, value in self.index['prompts'].items():
+                index['prompts'].setdefault(key, value)
+            index['shards'] = list(dict.fromkeys(index['shards'] + self.index['shards'] + [shard_name]))
+            for key in self.pending.keys():
+                index['prompts'][key] = shard_name
+            self.index = index
+            self._save_index()
+        self.pending = OrderedDict()
@@ -1,8 +1,9 @@
 import os
-from typing import Optional, TYPE_CHECKING, List
+from typing import Optional, TYPE_CHECKING, List, Union
 
 import torch
-from safetensors.torch import load_file, save_file
+from safetensors import safe_open
+from safetensors.torch import save_file
 from tqdm import tqdm
 import random
 
@@ -173,7 +174,9 @@ def split_prompt_pairs(concatenated: EncodedPromptPair, num_embeds=None) -> List
 
 
 class PromptEmbedsCache:
-    prompts: dict[str, PromptEmbeds] = {}
+    def __init__(self):
+        # per instance so embeddings do not leak between jobs
+        self.prompts: dict[str, PromptEmbeds] = {}
 
     def __setitem__(self, __name: str, __value: PromptEmbeds) -> None:
         self.prompts[__name] = __value
@@ -279,63 +282,75 @@ if TYPE_CHECKING:
     from toolkit.stable_diffusion_model import StableDiffusion
 
 
+def load_prompt_tensor_file(prompt_tensor_file: str, cache: PromptEmbedsCache):
+    # single file format, te:prompt and pe:prompt keys
+    print(f"Loading prompt tensors from {prompt_tensor_file}")
+    with safe_open(prompt_tensor_file, framework="pt", device="cpu") as f:
+        keys = set(f.keys())
+        for key in tqdm(list(keys), desc="Loading prompts", leave=False):
+            if not key.startswith("te:"):
+                continue
+            prompt = key[3:]
+            pooled_embeds = None
+            if f"pe:{prompt}" in keys:
+                pooled_embeds = f.get_tensor(f"pe:{prompt}")
+            cache[prompt] = PromptEmbeds([f.get_tensor(key), pooled_embeds]).to(device='cpu', dtype=torch.float32)
+
+
+def save_prompt_tensor_file(prompt_tensor_file: str, cache: PromptEmbedsCache):
+    print(f"Saving prompt tensors to {prompt_tensor_file}")
+    state_dict = {}
+    for prompt_txt, prompt_embeds in cache.prompts.items():
+        state_dict[f"te:{prompt_txt}"] = prompt_embeds.text_embeds.to("cpu", dtype=get_torch_dtype('fp16'))
+        if prompt_embeds.pooled_embeds is not None:
+            state_dict[f"pe:{prompt_txt}"] = prompt_embeds.pooled_embeds.to("cpu", dtype=get_torch_dtype('fp16'))
+    tmp_path = prompt_tensor_file + '.tmp'
+    save_file(state_dict, tmp_path)
+    os.replace(tmp_path, prompt_tensor_file)
+
+
 @torch.no_grad()
 def encode_prompts_to_cache(
         prompt_list: list[str],
         sd: "StableDiffusion",
         cache: Optional[PromptEmbedsCache] = None,
         prompt_tensor_file: Optional[str] = None,
+        batch_size: int = 32,
 ) -> PromptEmbedsCache:
+    """
+    Encodes the prompts that are not in the cache yet. prompt_tensor_file is either a single
+    .safetensors file, which is rewritten when prompts are added, or a folder used as the prompt
+    embeds store of the model, which is shared between runs and only ever appended to.
+    """
     # TODO: add support for larger prompts
     if cache is None:
         cache = PromptEmbedsCache()
 
-    if prompt_tensor_file is not None:
-        # check to see if it exists
-        if os.path.exists(prompt_tensor_file):
-            # load it.
-            print(f"Loading prompt tensors from {prompt_tensor_file}")
-            prompt_tensors = load_file(prompt_tensor_file, device='cpu')
-            # add them to the cache
-            for prompt_txt, prompt_tensor in tqdm(prompt_tensors.items(), desc="Loading prompts", leave=False):
-                if prompt_txt.startswith("te:"):
-                    prompt = prompt_txt[3:]
-                    # text_embeds
-                    text_embeds = prompt_tensor
-                    pooled_embeds = None
-                    # find pool embeds
-                    if f"pe:{prompt}" in prompt_tensors:
-                        pooled_embeds = prompt_tensors[f"pe:{prompt}"]
-
-                    # make it
-                    prompt_embeds = PromptEmbeds([text_embeds, pooled_embeds])
-                    cache[prompt] = prompt_embeds.to(device='cpu', dtype=torch.float32)
-
-    if len(cache.prompts) == 0:
-        print("Prompt tensors not found. Encoding prompts..")
-        empty_prompt = ""
-        # encode empty_prompt
-        cache[empty_prompt] = sd.encode_prompt(empty_prompt)
-
-        for p in tqdm(prompt_list, desc="Encoding prompts", leave=False):
-            # build the cache
-            if cache[p] is None:
-                cache[p] = sd.encode_prompt(p).to(device="cpu", dtype=torch.float16)
-
-        # should we shard? It can get large
-        if prompt_tensor_file:
-            print(f"Saving prompt tensors to {prompt_tensor_file}")
-            state_dict = {}
-            for prompt_txt, prompt_embeds in cache.prompts.items():
-                state_dict[f"te:{prompt_txt}"] = prompt_embeds.text_embeds.to(
-                    "cpu", dtype=get_torch_dtype('fp16')
-                )
-                if prompt_embeds.pooled_embeds is not None:
-                    state_dict[f"pe:{prompt_txt}"] = prompt_embeds.pooled_embeds.to(
-                        "cpu",
-                        dtype=get_torch_dtype('fp16')
-                    )
-            save_file(state_dict, prompt_tensor_file)
+    is_single_file = prompt_tensor_file is not None and prompt_tensor_file.endswith('.safetensors')
+    if is_single_file and os.path.exists(prompt_tensor_file):
+        load_prompt_tensor_file(prompt_tensor_file, cache)
+    elif prompt_tensor_file is not None and not is_single_file:
+        sd.set_prompt_embeds_store(prompt_tensor_file)
+
+    empty_prompt = ""
+    prompts_to_encode = [p for p in dict.fromkeys([empty_prompt] + prompt_list) if cache[p] is None]
+    if len(prompts_to_encode) > 0:
+        print(f"Encoding {len(prompts_to_encode)} prompts..")
+        for i in tqdm(range(0, len(prompts_to_encode), batch_size), desc="Encoding prompts", leave=False):
+            batch = prompts_to_encode[i:i + batch_size]
+            # the model checks its own prompt embeds store before encoding
+            prompt_embeds = sd.encode_prompt(batch)
+            for idx, p in enumerate(batch):
+                cache[p] = PromptEmbeds([
+                    prompt_embeds.text_embeds[idx:idx + 1],
+                    prompt_embeds.pooled_embeds[idx:idx + 1] if prompt_embeds.pooled_embeds is not None else None
+                ]).to(device="cpu", dtype=torch.float16)
+
+        if is_single_file:
+            save_prompt_tensor_file(prompt_tensor_file, cache)
+
+    if sd.prompt_embeds_store is not None:
+        sd.prompt_embeds_store.flush()
 
     return cache
 
@@ -437,17 +452,230 @@ def build_prompt_pair_batch_from_cache(
     return prompt_pair_batch
 
 
+PROMPT_PAIR_ROLES = [
+    'target_class',
+    'target_class_with_neutral',
+    'positive_target',
+    'positive_target_with_neutral',
+    'negative_target',
+    'negative_target_with_neutral',
+    'neutral',
+    'empty_prompt',
+    'both_targets',
+]
+
+# (negative, positive) role pairs the slider trainers predict with
+SLIDER_CFG_ROLES = [
+    ('positive_target', 'negative_target'),
+    ('positive_target', 'empty_prompt'),
+    ('positive_target', 'positive_target'),
+    ('positive_target', 'target_class'),
+]
+
+
+class PackedPromptPair:
+    """
+    A prompt pair in a PromptPairBank. Holds row indices into the bank instead of embeddings,
+    so getting the embeddings for a role, or a cfg batch of two roles, is a single index select.
+    """
+
+    def __init__(
+            self,
+            bank: 'PromptPairBank',
+            indices: dict,
+            action_list: list[int],
+            multiplier_list: list[float],
+            weight: float,
+            target: 'SliderTargetConfig',
+    ):
+        self.bank = bank
+        self.indices: dict[str, torch.Tensor] = indices
+        self.action_list = action_list
+        self.multiplier_list = multiplier_list
+        self.weight = weight
+        self.target = target
+        # erase is -1, enhance is 1. shaped to multiply a latent batch
+        self.offset_multiplier = torch.tensor(
+            [-1.0 if action == ACTION_TYPES_SLIDER.ERASE_NEGATIVE else 1.0 for action in action_list],
+            device=bank.device, dtype=bank.dtype
+        ).view(-1, 1, 1, 1)
+        self.cfg_indices: dict[tuple[str, str], torch.Tensor] = {}
+        self.chunks: dict[int, List['PackedPromptPair']] = {}
+        for negative_role, positive_role in SLIDER_CFG_ROLES:
+            self._get_cfg_indices(negative_role, positive_role)
+
+    def __len__(self):
+        return len(self.action_list)
+
+    def _get_cfg_indices(self, negative_role: str, positive_role: str) -> torch.Tensor:
+        key = (negative_role, positive_role)
+        if key not in self.cfg_indices:
+            # same layout as train_tools.concat_prompt_embeddings
+            self.cfg_indices[key] = torch.cat([
+                self.indices[negative_role], self.indices[positive_role]
+            ]).repeat_interleave(self.bank.num_images)
+        return self.cfg_indices[key]
+
+    def get_embeds(self, role: str) -> PromptEmbeds:
+        return self.bank.index_select(self.indices[role])
+
+    def get_cfg_embeds(self, negative_role: str, positive_role: str) -> PromptEmbeds:
+        return self.bank.index_select(self._get_cfg_indices(negative_role, positive_role))
+
+    def split(self, num_chunks: int) -> List['PackedPromptPair']:
+        # same chunks as split_prompt_pairs, built once per chunk count
+        if num_chunks not in self.chunks:
+            index_chunks = {role: torch.chunk(idx, num_chunks) for role, idx in self.indices.items()}
+            num_splits = len(index_chunks['target_class'])
+            chunks = []
+            for i in range(num_splits):
+                chunks.append(PackedPromptPair(
+                    bank=self.bank,
+                    indices={role: idx_chunks[i] for role, idx_chunks in index_chunks.items()},
+                    action_list=self.action_list[i::num_splits],
+                    multiplier_list=self.multiplier_list[i::num_splits],
+                    weight=self.weight,
+                    target=self.target,
+                ))
+            self.chunks[num_chunks] = chunks
+        return self.chunks[num_chunks]
+
+
+class PromptPairBank:
+    """
+    All slider prompt pairs packed into one embedding table with each unique prompt stored once,
+    kept on the training device, or in pinned host memory when keep_on_device is off. Pairs are
+    PackedPromptPair row indices into the table, with the cfg layouts the trainers use built up front,
+    so a training step does no host to device copies or cats of prompt embeddings.
+    """
+
+    def __init__(
+            self,
+            prompt_pairs: List[List[EncodedPromptPair]],
+            num_images: int = 1,
+            chunk_size: int = 1,
+            device='cpu',
+            dtype=torch.float32,
+            keep_on_device: bool = True,
+    ):
+        self.device = torch.device(device)
+        self.dtype = dtype
+        self.num_images = num_images
+        self.keep_on_device = keep_on_device
+        index_device = self.device if keep_on_device else torch.device('cpu')
+
+        # the cache hands out the same PromptEmbeds for the same prompt, so dedupe by identity
+        rows: dict[int, int] = {}
+        embeds_list: list[PromptEmbeds] = []
+
+        def get_row(prompt_embeds: PromptEmbeds) -> int:
+            if id(prompt_embeds) not in rows:
+                rows[id(prompt_embeds)] = len(embeds_list)
+                embeds_list.append(prompt_embeds)
+            return rows[id(prompt_embeds)]
+
+        self.pairs: List[PackedPromptPair] = []
+        for pair_batch in prompt_pairs:
+            indices = {
+                role: torch.tensor(
+                    [get_row(getattr(pair, role)) for pair in pair_batch], dtype=torch.long, device=index_device
+                ) for role in PROMPT_PAIR_ROLES
+            }
+            action_list = []
+            multiplier_list = []
+            for pair in pair_batch:
+                action_list += pair.action_list
+                multiplier_list += pair.multiplier_list
+            self.pairs.append(PackedPromptPair(
+                bank=self,
+                indices=indices,
+                action_list=action_list,
+                multiplier_list=multiplier_list,
+                weight=pair_batch[0].weight,
+                target=pair_batch[0].target,
+            ))
+            self.pairs[-1].split(chunk_size)
+
+        table_device = self.device if keep_on_device else torch.device('cpu')
+        self.text_embeds = torch.cat(
+            [p.text_embeds.to(table_device, dtype=dtype) for p in embeds_list], dim=0
+        )
+        self.pooled_embeds = None
+        if embeds_list[0].pooled_embeds is not None:
+            self.pooled_embeds = torch.cat(
+                [p.pooled_embeds.to(table_device, dtype=dtype) for p in embeds_list], dim=0
+            )
+        if not keep_on_device and torch.cuda.is_available():
+            self.text_embeds = self.text_embeds.pin_memory()
+            if self.pooled_embeds is not None:
+                self.pooled_embeds = self.pooled_embeds.pin_memory()
+
+    def __len__(self):
+        return len(self.pairs)
+
+    def __getitem__(self, idx: int) -> PackedPromptPair:
+        return self.pairs[idx]
+
+    def sample(self) -> PackedPromptPair:
+        return self.pairs[torch.randint(0, len(self.pairs), (1,)).item()]
+
+    def index_select(self, indices: torch.Tensor) -> PromptEmbeds:
+        text_embeds = self.text_embeds.index_select(0, indices)
+        pooled_embeds = None
+        if self.pooled_embeds is not None:
+            pooled_embeds = self.pooled_embeds.index_select(0, indices)
+        if not self.keep_on_device:
+            text_embeds = text_embeds.to(self.device, non_blocking=True)
+            if pooled_embeds is not None:
+                pooled_embeds = pooled_embeds.to(self.device, non_blocking=True)
+        return PromptEmbeds([text_embeds, pooled_embeds])
+
+
+@torch.no_grad()
+def build_prompt_pair_bank_from_cache(
+        cache: PromptEmbedsCache,
+        targets: List['SliderTargetConfig'],
+        neutral_list: List[str],
+        batch_full_slide: bool = True,
+        num_images: int = 1,
+        device='cpu',
+        dtype=torch.float32,
+        keep_on_device: bool = True,
+) -> PromptPairBank:
+    # batch_full_slide runs every pair of a target and neutral in one batch, otherwise one pair at a time
+    chunk_size = 4 if batch_full_slide else 1
+    prompt_pairs = []
+    for neutral in tqdm(neutral_list, desc="Building Prompt Pairs", leave=False):
+        for target in targets:
+            prompt_pair_batch = build_prompt_pair_batch_from_cache(cache=cache, target=target, neutral=neutral)
+            if batch_full_slide:
+                prompt_pairs.append(prompt_pair_batch)
+            else:
+                prompt_pairs += [[prompt_pair] for prompt_pair in prompt_pair_batch]
+    return PromptPairBank(
+        prompt_pairs,
+        num_images=num_images,
+        chunk_size=chunk_size,
+        device=device,
+        dtype=dtype,
+        keep_on_device=keep_on_device,
+    )
+
+
 def build_latent_image_batch_for_prompt_pair(
         pos_latent,
         neg_latent,
-        prompt_pair: EncodedPromptPair,
+        prompt_pair: Union[EncodedPromptPair, PackedPromptPair],
         prompt_chunk_size
 ):
     erase_negative = len(prompt_pair.target.positive.strip()) == 0
     enhance_positive = len(prompt_pair.target.negative.strip()) == 0
     both = not erase_negative and not enhance_positive
 
-    prompt_pair_chunks = split_prompt_pairs(prompt_pair, prompt_chunk_size)
+    if isinstance(prompt_pair, PackedPromptPair):
+        prompt_pair_chunks = prompt_pair.split(prompt_chunk_size)
+    else:
+        prompt_pair_chunks = split_prompt_pairs(prompt_pair, prompt_chunk_size)
     if both and len(prompt_pair_chunks) != 4:
         raise Exception("Invalid prompt pair chunks")
     if (erase_negative or enhance_positive) and len(prompt_pair_chunks) != 2:
@@ -1,9 +1,12 @@
 import json
 import os
+import shutil
+import struct
 from collections import OrderedDict
-from typing import TYPE_CHECKING, Literal, Optional, Union
+from typing import TYPE_CHECKING, Literal, Optional, Union, Dict, Callable, List
 
 import torch
+from safetensors import safe_open
 from safetensors.torch import load_file, save_file
 
 from toolkit.train_tools import get_torch_dtype
@@ -14,11 +17,245 @@ if TYPE_CHECKING:
 
 
 def get_slices_from_string(s: str) -> tuple:
-    slice_strings = s.split(',')
-    slices = [eval(f"slice({component.strip()})") for component in slice_strings]
+    # numpy style, "0:1024, :"
+    slices = []
+    for component in s.split(','):
+        bounds = [int(b) if b.strip() != '' else None for b in component.strip().split(':')]
+        slices.append(slice(*bounds))
     return tuple(slices)
 
 
+# parsed keymaps by path, they are large and do not change while running
+_mapping_cache: Dict[str, 'OrderedDict'] = {}
+
+SAFETENSORS_DTYPES: Dict[torch.dtype, str] = {
+    torch.float64: 'F64',
+    torch.float32: 'F32',
+    torch.float16: 'F16',
+    torch.bfloat16: 'BF16',
+    torch.int64: 'I64',
+    torch.int32: 'I32',
+    torch.int16: 'I16',
+    torch.int8: 'I8',
+    torch.uint8: 'U8',
+    torch.bool: 'BOOL',
+}
+TORCH_DTYPES_FROM_SAFETENSORS: Dict[str, torch.dtype] = {v: k for k, v in SAFETENSORS_DTYPES.items()}
+# safetensors.torch.save writes the largest dtypes first, then by name. the model hashes depend on it
+SAFETENSORS_DTYPE_ORDER = ['BOOL', 'U8', 'I8', 'I16', 'U16', 'F16', 'BF16', 'I32', 'U32', 'F32', 'F64', 'I64', 'U64']
+
+
+def get_ldm_mapping(mapping_path: str) -> 'OrderedDict':
+    if mapping_path not in _mapping_cache:
+        with open(mapping_path, 'r') as f:
+            _mapping_cache[mapping_path] = json.load(f, object_pairs_hook=OrderedDict)
+    return _mapping_cache[mapping_path]
+
+
+def get_ldm_paths(sd_version: Literal['1', '2', 'sdxl'] = '2'):
+    if sd_version == '1':
+        base_path = os.path.join(KEYMAPS_ROOT, 'stable_diffusion_sd1_ldm_base.safetensors')
+        mapping_path = os.path.join(KEYMAPS_ROOT, 'stable_diffusion_sd1.json')
+    elif sd_version == '2':
+        base_path = os.path.join(KEYMAPS_ROOT, 'stable_diffusion_sd2_ldm_base.safetensors')
+        mapping_path = os.path.join(KEYMAPS_ROOT, 'stable_diffusion_sd2.json')
+    elif sd_version == 'sdxl':
+        # load our base
+        base_path = os.path.join(KEYMAPS_ROOT, 'stable_diffusion_sdxl_ldm_base.safetensors')
+        mapping_path = os.path.join(KEYMAPS_ROOT, 'stable_diffusion_sdxl.json')
+    else:
+        raise ValueError(f"Invalid sd_version {sd_version}")
+    return base_path, mapping_path
+
+
+def get_safetensors_header_bytes(header: 'OrderedDict') -> bytes:
+    header_bytes = json.dumps(header, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+    # pad so the data starts 8 byte aligned
+    header_bytes += b' ' * ((8 - len(header_bytes) % 8) % 8)
+    return header_bytes
+
+
+def tensor_to_bytes(tensor: torch.Tensor):
+    return tensor.reshape(-1).view(torch.uint8).numpy().data
+
+
+class SafetensorsStreamWriter:
+    """
+    Writes a safetensors file when the tensors are produced one at a time and their shapes are not known
+    up front. Tensor data is appended to a spool file as it arrives and the header is written on close,
+    so nothing is held in memory. Pass a dtype to convert everything to it, which also keeps it aligned.
+    """
+
+    def __init__(self, output_file: str, dtype: Optional[torch.dtype] = None):
+        self.output_file = output_file
+        self.dtype = dtype
+        os.makedirs(os.path.dirname(output_file) or '.', exist_ok=True)
+        self.spool_path = output_file + '.data.tmp'
+        self.spool = open(self.spool_path, 'wb')
+        self.tensor_header = OrderedDict()
+        self.offset = 0
+
+    def __len__(self):
+        return len(self.tensor_header)
+
+    def add(self, key: str, tensor: torch.Tensor):
+        if key in self.tensor_header:
+            raise ValueError(f"Duplicate key {key}")
+        dtype = self.dtype if self.dtype is not None else tensor.dtype
+        tensor = tensor.detach().to('cpu', dtype=dtype).contiguous()
+        num_bytes = tensor.numel() * tensor.element_size()
+        self.tensor_header[key] = {
+            'dtype': SAFETENSORS_DTYPES[dtype],
+            'shape': list(tensor.shape),
+            'data_offsets': [self.offset, self.offset + num_bytes],
+        }
+        self.spool.write(tensor_to_bytes(tensor))
+        self.offset += num_bytes
+
+    def close(self, metadata: Optional[Dict[str, str]] = None):
+        self.spool.close()
+        header = OrderedDict()
+        if metadata is not None and len(metadata) > 0:
+            header['__metadata__'] = metadata
+        header.update(self.tensor_header)
+
+        tmp_path = self.output_file + '.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                header_bytes = get_safetensors_header_bytes(header)
+                f.write(struct.pack('<Q', len(header_bytes)))
+                f.write(header_bytes)
+                with open(self.spool_path, 'rb') as spool:
+                    shutil.copyfileobj(spool, f, length=16 * 1024 * 1024)
+            os.replace(tmp_path, self.output_file)
+        finally:
+            for path in [tmp_path, self.spool_path]:
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def abort(self):
+        self.spool.close()
+        if os.path.exists(self.spool_path):
+            os.remove(self.spool_path)
+
+
+def get_safetensors_key_order(dtype_names: Dict[str, str]) -> List[str]:
+    # dtype_names is key -> safetensors dtype name, like F16
+    return sorted(dtype_names.keys(), key=lambda k: (-SAFETENSORS_DTYPE_ORDER.index(dtype_names[k]), k))
+
+
+def build_safetensors_header(
+        tensor_shapes: 'OrderedDict',
+        dtype_names: Dict[str, str],
+        metadata: Optional[Dict[str, str]] = None,
+) -> 'OrderedDict':
+    # tensors are laid out in the order of tensor_shapes
+    header = OrderedDict()
+    if metadata is not None:
+        header['__metadata__'] = metadata
+    offset = 0
+    for key, shape in tensor_shapes.items():
+        num_bytes = TORCH_DTYPES_FROM_SAFETENSORS[dtype_names[key]].itemsize
+        for dim in shape:
+            num_bytes *= dim
+        header[key] = {
+            'dtype': dtype_names[key],
+            'shape': list(shape),
+            'data_offsets': [offset, offset + num_bytes],
+        }
+        offset += num_bytes
+    return header
+
+
+def save_file_streaming(
+        tensor_shapes: 'OrderedDict',
+        get_tensor: Callable[[str], torch.Tensor],
+        output_file: str,
+        dtype: torch.dtype,
+        metadata: Optional[Dict[str, str]] = None,
+        tensor_dtypes: Optional[Dict[str, torch.dtype]] = None,
+        add_model_hash: bool = False,
+) -> Optional[Dict[str, str]]:
+    """
+    Writes a safetensors file one tensor at a time. The header is built from the shapes up front so
+    only a single tensor has to be in memory. All tensors are saved as dtype, unless they are in
+    tensor_dtypes.
+
+    With add_model_hash, the tensors are written in the order safetensors uses and the sshs hashes are
+    computed from the data as it is written, then filled into the header. Returns the saved metadata.
+    """
+    if tensor_dtypes is None:
+        tensor_dtypes = {}
+    if metadata is not None and len(metadata) == 0:
+        metadata = None
+    dtype_names = {key: SAFETENSORS_DTYPES[tensor_dtypes.get(key, dtype)] for key in tensor_shapes.keys()}
+
+    hasher = None
+    if add_model_hash:
+        from toolkit.metadata import ModelHasher, get_hash_metadata
+        tensor_shapes = OrderedDict(
+            [(key, tensor_shapes[key]) for key in get_safetensors_key_order(dtype_names)]
+        )
+        # the hashes are defined over the file with only the ss_ metadata
+        hash_header_bytes = get_safetensors_header_bytes(
+            build_safetensors_header(tensor_shapes, dtype_names, get_hash_metadata(metadata or {}))
+        )
+        hasher = ModelHasher(struct.pack('<Q', len(hash_header_bytes)) + hash_header_bytes)
+        # same length as the real hashes, so the header can be rewritten in place
+        metadata = ModelHasher.add_placeholder_hashes(metadata)
+
+    header_bytes = get_safetensors_header_bytes(build_safetensors_header(tensor_shapes, dtype_names, metadata))
+
+    os.makedirs(os.path.dirname(output_file) or '.', exist_ok=True)
+    tmp_path = output_file + '.tmp'
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(struct.pack('<Q', len(header_bytes)))
+            f.write(header_bytes)
+            for key, shape in tensor_shapes.items():
+                tensor = get_tensor(key).to('cpu', dtype=tensor_dtypes.get(key, dtype)).contiguous()
+                if list(tensor.shape) != list(shape):
+                    raise ValueError(f"Shape mismatch for {key}: expected {list(shape)}, got {list(tensor.shape)}")
+                tensor_bytes = tensor_to_bytes(tensor)
+                f.write(tensor_bytes)
+                if hasher is not None:
+                    hasher.update(tensor_bytes)
+                del tensor, tensor_bytes
+            if hasher is not None:
+                metadata = hasher.add_hashes(metadata)
+                final_header_bytes = get_safetensors_header_bytes(
+                    build_safetensors_header(tensor_shapes, dtype_names, metadata)
+                )
+                if len(final_header_bytes) != len(header_bytes):
+                    raise ValueError("Model hash changed the header size")
+                f.seek(8)
+                f.write(final_header_bytes)
+        os.replace(tmp_path, output_file)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return metadata
+
+
+def save_file_with_model_hash(
+        state_dict: Dict[str, torch.Tensor],
+        output_file: str,
+        metadata: Optional[Dict[str, str]] = None,
+) -> Dict[str, str]:
+    # saves like safetensors save_file, with the sshs hashes added to the metadata in the same pass
+    tensor_shapes = OrderedDict([(key, list(value.shape)) for key, value in state_dict.items()])
+    tensor_dtypes = {key: value.dtype for key, value in state_dict.items()}
+    return save_file_streaming(
+        tensor_shapes,
+        lambda key: state_dict[key].detach(),
+        output_file,
+        torch.float32,
+        metadata,
+        tensor_dtypes=tensor_dtypes,
+        add_model_hash=True,
+    )
+
+
 def convert_state_dict_to_ldm_with_mapping(
         diffusers_state_dict: 'OrderedDict',
         mapping_path: str,
@@ -28,9 +265,7 @@ def convert_state_dict_to_ldm_with_mapping(
 ) -> 'OrderedDict':
     converted_state_dict = OrderedDict()
 
-    # load mapping
-    with open(mapping_path, 'r') as f:
-        mapping = json.load(f, object_pairs_hook=OrderedDict)
+    mapping = get_ldm_mapping(mapping_path)
 
     ldm_diffusers_keymap = mapping['ldm_diffusers_keymap']
     ldm_diffusers_shape_map = mapping['ldm_diffusers_shape_map']
@@ -77,20 +312,9 @@ def get_ldm_state_dict_from_diffusers(
         device='cpu',
         dtype=get_torch_dtype('fp32'),
 ):
-    if sd_version == '1':
-        base_path = os.path.join(KEYMAPS_ROOT, 'stable_diffusion_sd1_ldm_base.safetensors')
-        mapping_path = os.path.join(KEYMAPS_ROOT, 'stable_diffusion_sd1.json')
-    elif sd_version == '2':
-        base_path = os.path.join(KEYMAPS_ROOT, 'stable_diffusion_sd2_ldm_base.safetensors')
-        mapping_path = os.path.join(KEYMAPS_ROOT, 'stable_diffusion_sd2.json')
-    elif sd_version == 'sdxl':
-        # load our base
-        base_path = os.path.join(KEYMAPS_ROOT, 'stable_diffusion_sdxl_ldm_base.safetensors')
-        mapping_path = os.path.join(KEYMAPS_ROOT, 'stable_diffusion_sdxl.json')
-    else:
-        raise ValueError(f"Invalid sd_version {sd_version}")
+    base_path, mapping_path = get_ldm_paths(sd_version)
 
-        # convert the state dict
+    # convert the state dict
     return convert_state_dict_to_ldm_with_mapping(
         state_dict,
         mapping_path,
@@ -107,13 +331,78 @@ def save_ldm_model_from_diffusers(
         save_dtype=get_torch_dtype('fp16'),
         sd_version: Literal['1', '2', 'sdxl'] = '2'
 ):
-    converted_state_dict = get_ldm_state_dict_from_diffusers(
+    save_ldm_state_dict_from_diffusers(
         sd.state_dict(),
-        sd_version,
-        device='cpu',
-        dtype=save_dtype
+        output_file,
+        meta,
+        save_dtype=save_dtype,
+        sd_version=sd_version
     )
 
-    # make sure parent folder exists
-    os.makedirs(os.path.dirname(output_file), exist_ok=True)
-    save_file(converted_state_dict, output_file, metadata=meta)
+
+def save_ldm_state_dict_from_diffusers(
+        state_dict: 'OrderedDict',
+        output_file: str,
+        meta: 'OrderedDict',
+        save_dtype=get_torch_dtype('fp16'),
+        sd_version: Literal['1', '2', 'sdxl'] = '2'
+):
+    # works on a state dict so it can run on a cpu snapshot in the background writer.
+    # streams tensor by tensor, so peak memory is a single converted tensor on top of the model
+    base_path, mapping_path = get_ldm_paths(sd_version)
+    mapping = get_ldm_mapping(mapping_path)
+
+    ldm_diffusers_keymap = mapping['ldm_diffusers_keymap']
+    ldm_diffusers_shape_map = mapping['ldm_diffusers_shape_map']
+    ldm_diffusers_operator_map = mapping['ldm_diffusers_operator_map']
+
+    base_file = None
+    if os.path.exists(base_path):
+        base_file = safe_open(base_path, framework='pt', device='cpu')
+
+    # build where each key comes from, in the same precedence as convert_state_dict_to_ldm_with_mapping:
+    # base, then operators, then the keymap
+    sources = OrderedDict()
+    tensor_shapes = OrderedDict()
+    if base_file is not None:
+        for key in base_file.keys():
+            sources[key] = ('base', key)
+            tensor_shapes[key] = base_file.get_slice(key).get_shape()
+
+    for ldm_key in ldm_diffusers_operator_map:
+        if 'cat' in ldm_diffusers_operator_map[ldm_key]:
+            cat_keys: List[str] = ldm_diffusers_operator_map[ldm_key]['cat']
+            shapes = [state_dict[k].shape for k in cat_keys]
+            sources[ldm_key] = ('cat', cat_keys)
+            tensor_shapes[ldm_key] = [sum([s[0] for s in shapes])] + list(shapes[0][1:])
+        if 'slice' in ldm_diffusers_operator_map[ldm_key]:
+            slice_keys = ldm_diffusers_operator_map[ldm_key]['slice']
+            slices = get_slices_from_string(state_dict[slice_keys[1]])
+            sources[ldm_key] = ('slice', (slice_keys[0], slices))
+            # shape without materializing the tensor
+            tensor_shapes[ldm_key] = torch.empty(state_dict[slice_keys[0]].shape, device='meta')[slices].shape
+
+    for ldm_key in ldm_diffusers_keymap:
+        diffusers_key = ldm_diffusers_keymap[ldm_key]
+        if diffusers_key in state_dict:
+            sources[ldm_key] = ('map', diffusers_key)
+            if ldm_key in ldm_diffusers_shape_map:
+                tensor_shapes[ldm_key] = ldm_diffusers_shape_map[ldm_key][0]
+            else:
+                tensor_shapes[ldm_key] = state_dict[diffusers_key].shape
+
+    def get_tensor(ldm_key):
+        source_type, source = sources[ldm_key]
+        if source_type == 'base':
+            return base_file.get_tensor(source)
+        elif source_type == 'cat':
+            return torch.cat([state_dict[k].detach().to('cpu', dtype=save_dtype) for k in source], dim=0)
+        elif source_type == 'slice':
+            return state_dict[source[0]][source[1]].detach()
+        else:
+            tensor = state_dict[source].detach().to('cpu', dtype=save_dtype)
+            if ldm_key in ldm_diffusers_shape_map:
+                tensor = tensor.view(ldm_diffusers_shape_map[ldm_key][0])
+            return tensor
+
+    save_file_streaming(tensor_shapes, get_tensor, output_file, save_dtype, metadata=meta)
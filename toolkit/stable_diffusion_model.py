@@ -1,6 +1,6 @@
 import gc
 import typing
-from typing import Union, List, Tuple
+from typing import Union, List, Tuple, Optional
 import sys
 import os
 from collections import OrderedDict
@@ -11,9 +11,11 @@ from tqdm import tqdm
 from torchvision.transforms import Resize
 
 from library.model_util import convert_unet_state_dict_to_sd, convert_text_encoder_state_dict_to_sd_v2, \
-    convert_vae_state_dict, load_vae
+    convert_vae_state_dict
 from toolkit import train_tools
 from toolkit.config_modules import ModelConfig, GenerateImageConfig
+from toolkit.converted_model_cache import load_converted_or_convert
+from toolkit.kohya_model_util import load_vae
 from toolkit.metadata import get_meta_for_safetensors
 from toolkit.paths import REPOS_ROOT
 from toolkit.saving import save_ldm_model_from_diffusers
@@ -23,7 +25,7 @@ from library import model_util
 from library.sdxl_model_util import convert_text_encoder_2_state_dict_to_sdxl
 from diffusers.schedulers import DDPMScheduler
 from toolkit.pipelines import CustomStableDiffusionXLPipeline, CustomStableDiffusionPipeline
-from diffusers import StableDiffusionPipeline, StableDiffusionXLPipeline
+from diffusers import StableDiffusionPipeline, StableDiffusionXLPipeline, AutoencoderKL
 import diffusers
 
 # tell it to shut up
@@ -84,6 +86,45 @@ class PromptEmbeds:
         return self
 
 
+class PromptEmbedsLRUCache:
+    # keeps the most recently used embeddings on device and offloads evicted ones to the cpu
+    # before dropping them entirely
+
+    def __init__(self, max_size: int = 256, max_offload_size: int = 2048):
+        self.max_size = max_size
+        self.max_offload_size = max_offload_size
+        self.device_cache: OrderedDict = OrderedDict()
+        self.offload_cache: OrderedDict = OrderedDict()
+
+    def __len__(self):
+        return len(self.device_cache) + len(self.offload_cache)
+
+    def get(self, key, device) -> Union[PromptEmbeds, None]:
+        if key in self.device_cache:
+            self.device_cache.move_to_end(key)
+            return self.device_cache[key]
+        if key in self.offload_cache:
+            # promote it back to the device
+            prompt_embeds = self.offload_cache.pop(key).to(device)
+            self.set(key, prompt_embeds)
+            return prompt_embeds
+        return None
+
+    def set(self, key, prompt_embeds: PromptEmbeds):
+        self.device_cache[key] = prompt_embeds
+        self.device_cache.move_to_end(key)
+        while len(self.device_cache) > self.max_size:
+            evicted_key, evicted = self.device_cache.popitem(last=False)
+            if self.max_offload_size > 0:
+                self.offload_cache[evicted_key] = evicted.to('cpu')
+        while len(self.offload_cache) > self.max_offload_size:
+            self.offload_cache.popitem(last=False)
+
+    def clear(self):
+        self.device_cache.clear()
+        self.offload_cache.clear()
+
+
 # if is type checking
 if typing.TYPE_CHECKING:
     from diffusers import \
@@ -92,6 +133,7 @@ if typing.TYPE_CHECKING:
         UNet2DConditionModel
     from diffusers.schedulers import KarrasDiffusionSchedulers
     from transformers import CLIPTextModel, CLIPTokenizer, CLIPTextModelWithProjection
+    from toolkit.prompt_store import PromptEmbedsStore
 
 
 class StableDiffusion:
@@ -129,12 +171,24 @@ class StableDiffusion:
 
         # to hold network if there is one
         self.network = None
+        # built on first sample and reused, it only holds references to our modules
+        self.sample_pipeline = None
         self.is_xl = model_config.is_xl
         self.is_v2 = model_config.is_v2
 
         self.use_text_encoder_1 = model_config.use_text_encoder_1
         self.use_text_encoder_2 = model_config.use_text_encoder_2
 
+        # only used when encoding without grads, ie. the text encoder is frozen
+        self.prompt_embeds_cache = None
+        if model_config.text_embedding_cache_size > 0:
+            self.prompt_embeds_cache = PromptEmbedsLRUCache(
+                max_size=model_config.text_embedding_cache_size,
+                max_offload_size=model_config.text_embedding_cpu_cache_size,
+            )
+        # on disk, shared between runs. set up once the text encoder is loaded
+        self.prompt_embeds_store: Optional['PromptEmbedsStore'] = None
+
     def load_model(self):
         if self.is_loaded:
             return
@@ -182,11 +236,29 @@ class StableDiffusion:
                     device=self.device_torch,
                 ).to(self.device_torch)
             else:
-                pipe = pipln.from_single_file(
+                def convert_xl():
+                    converted = pipln.from_single_file(
+                        model_path,
+                        dtype=dtype,
+                        scheduler_type='ddpm',
+                        device=self.device_torch,
+                    )
+                    for component in [converted.unet, converted.vae, converted.text_encoder, converted.text_encoder_2]:
+                        component.to(dtype=dtype)
+                    return converted
+
+                pipe = load_converted_or_convert(
+                    self.model_config.converted_model_cache,
                     model_path,
-                    dtype=dtype,
-                    scheduler_type='ddpm',
-                    device=self.device_torch,
+                    dtype,
+                    convert_fn=convert_xl,
+                    load_fn=lambda converted_path: pipln.from_pretrained(
+                        converted_path,
+                        torch_dtype=dtype,
+                        low_cpu_mem_usage=True,
+                    ),
+                    is_xl=True,
+                    is_v2=self.model_config.is_v2,
                 ).to(self.device_torch)
 
             text_encoders = [pipe.text_encoder, pipe.text_encoder_2]
@@ -215,14 +287,36 @@ class StableDiffusion:
                     safety_checker=None
                 ).to(self.device_torch)
             else:
-                pipe = pipln.from_single_file(
+                def convert_sd():
+                    converted = pipln.from_single_file(
+                        model_path,
+                        dtype=dtype,
+                        scheduler_type='dpm',
+                        device=self.device_torch,
+                        load_safety_checker=False,
+                        requires_safety_checker=False,
+                        safety_checker=False
+                    )
+                    # nothing to save for it
+                    converted.register_modules(safety_checker=None)
+                    for component in [converted.unet, converted.vae, converted.text_encoder]:
+                        component.to(dtype=dtype)
+                    return converted
+
+                pipe = load_converted_or_convert(
+                    self.model_config.converted_model_cache,
                     model_path,
-                    dtype=dtype,
-                    scheduler_type='dpm',
-                    device=self.device_torch,
-                    load_safety_checker=False,
-                    requires_safety_checker=False,
-                    safety_checker=False
+                    dtype,
+                    convert_fn=convert_sd,
+                    load_fn=lambda converted_path: pipln.from_pretrained(
+                        converted_path,
+                        torch_dtype=dtype,
+                        low_cpu_mem_usage=True,
+                        safety_checker=None,
+                        requires_safety_checker=False,
+                    ),
+                    is_xl=False,
+                    is_v2=self.model_config.is_v2,
                 ).to(self.device_torch)
 
             pipe.register_to_config(requires_safety_checker=False)
@@ -236,7 +330,20 @@ class StableDiffusion:
         pipe.scheduler = scheduler
 
         if self.model_config.vae_path is not None:
-            external_vae = load_vae(self.model_config.vae_path, dtype)
+            external_vae = load_converted_or_convert(
+                self.model_config.converted_model_cache,
+                self.model_config.vae_path,
+                dtype,
+                convert_fn=lambda: load_vae(
+                    self.model_config.vae_path, dtype, low_cpu_mem_usage=self.model_config.low_cpu_mem_usage
+                ).to(dtype=dtype),
+                load_fn=lambda converted_path: AutoencoderKL.from_pretrained(
+                    converted_path,
+                    torch_dtype=dtype,
+                    low_cpu_mem_usage=True,
+                ),
+                model_type='vae',
+            )
             pipe.vae = external_vae
 
         self.unet = pipe.unet
@@ -253,7 +360,77 @@ class StableDiffusion:
         self.pipeline = pipe
         self.is_loaded = True
 
-    def generate_images(self, image_configs: List[GenerateImageConfig]):
+        if self.model_config.prompt_embeds_store is not None:
+            self.set_prompt_embeds_store(self.model_config.prompt_embeds_store)
+
+    def set_prompt_embeds_store(self, store_dir: str):
+        from toolkit.prompt_store import PromptEmbedsStore, get_prompt_store_model_key
+        if self.prompt_embeds_store is not None and self.prompt_embeds_store.store_dir == store_dir:
+            return
+        if self.prompt_embeds_store is not None:
+            self.prompt_embeds_store.flush()
+        self.prompt_embeds_store = PromptEmbedsStore(store_dir, get_prompt_store_model_key(self))
+
+    def get_sample_pipeline(self):
+        if self.sample_pipeline is not None:
+            return self.sample_pipeline
+        # TODO add clip skip
+        if self.is_xl:
+            pipeline = StableDiffusionXLPipeline(
+                vae=self.vae,
+                unet=self.unet,
+                text_encoder=self.text_encoder[0],
+                text_encoder_2=self.text_encoder[1],
+                tokenizer=self.tokenizer[0],
+                tokenizer_2=self.tokenizer[1],
+                scheduler=self.noise_scheduler,
+                add_watermarker=False,
+            ).to(self.device_torch)
+            # force turn that (ruin your images with obvious green and red dots) the #$@@ off!!!
+            pipeline.watermark = None
+        else:
+            pipeline = StableDiffusionPipeline(
+                vae=self.vae,
+                unet=self.unet,
+                text_encoder=self.text_encoder,
+                tokenizer=self.tokenizer,
+                scheduler=self.noise_scheduler,
+                safety_checker=None,
+                feature_extractor=None,
+                requires_safety_checker=False,
+            ).to(self.device_torch)
+        # disable progress bar
+        pipeline.set_progress_bar_config(disable=True)
+        self.sample_pipeline = pipeline
+        return pipeline
+
+    def _get_generate_batches(self, image_configs: List[GenerateImageConfig], max_batch_size: int) -> List[List[int]]:
+        # group images that can share a pipeline call, keeping the order they were requested in
+        groups: OrderedDict = OrderedDict()
+        for i, gen_config in enumerate(image_configs):
+            key = (
+                gen_config.width,
+                gen_config.height,
+                gen_config.num_inference_steps,
+                gen_config.guidance_scale,
+                gen_config.guidance_rescale,
+                gen_config.network_multiplier,
+                # None and an empty negative prompt are not the same thing to the sdxl pipeline
+                gen_config.negative_prompt is None,
+                gen_config.negative_prompt_2 is None,
+            )
+            if key not in groups:
+                groups[key] = []
+            groups[key].append(i)
+
+        batch_size = max(1, max_batch_size)
+        batches = []
+        for indices in groups.values():
+            for start in range(0, len(indices), batch_size):
+                batches.append(indices[start:start + batch_size])
+        return batches
+
+    def generate_images(self, image_configs: List[GenerateImageConfig], max_batch_size: int = 4):
         # sample_folder = os.path.join(self.save_root, 'samples')
         if self.network is not None:
             self.network.eval()
@@ -289,33 +466,7 @@ class StableDiffusion:
         self.vae.to(self.device_torch)
         self.unet.to(self.device_torch)
 
-        # TODO add clip skip
-        if self.is_xl:
-            pipeline = StableDiffusionXLPipeline(
-                vae=self.vae,
-                unet=self.unet,
-                text_encoder=self.text_encoder[0],
-                text_encoder_2=self.text_encoder[1],
-                tokenizer=self.tokenizer[0],
-                tokenizer_2=self.tokenizer[1],
-                scheduler=self.noise_scheduler,
-                add_watermarker=False,
-            ).to(self.device_torch)
-            # force turn that (ruin your images with obvious green and red dots) the #$@@ off!!!
-            pipeline.watermark = None
-        else:
-            pipeline = StableDiffusionPipeline(
-                vae=self.vae,
-                unet=self.unet,
-                text_encoder=self.text_encoder,
-                tokenizer=self.tokenizer,
-                scheduler=self.noise_scheduler,
-                safety_checker=None,
-                feature_extractor=None,
-                requires_safety_checker=False,
-            ).to(self.device_torch)
-        # disable progress bar
-        pipeline.set_progress_bar_config(disable=True)
+        pipeline = self.get_sample_pipeline()
 
         start_multiplier = 1.0
         if self.network is not None:
@@ -327,48 +478,72 @@ class StableDiffusion:
                 if self.network is not None:
                     assert self.network.is_active
 
-                for i in tqdm(range(len(image_configs)), desc=f"Generating Images", leave=False):
-                    gen_config = image_configs[i]
+                batches = self._get_generate_batches(image_configs, max_batch_size)
+                progress_bar = tqdm(total=len(image_configs), desc=f"Generating Images", leave=False)
+                for batch in batches:
+                    first_config = image_configs[batch[0]]
+                    batch_configs = [image_configs[i] for i in batch]
 
                     if self.network is not None:
-                        self.network.multiplier = gen_config.network_multiplier
-                    torch.manual_seed(gen_config.seed)
-                    torch.cuda.manual_seed(gen_config.seed)
+                        self.network.multiplier = first_config.network_multiplier
+                        if hasattr(self.network, 'merge_in'):
+                            # fold the lora into the weights so sampling runs at base model speed.
+                            # it is unmerged when we leave the network context
+                            self.network.merge_in()
+
+                    # a generator per image so every image matches what it would be when generated on its own
+                    generator = [
+                        torch.Generator(device=self.device_torch).manual_seed(gen_config.seed)
+                        for gen_config in batch_configs
+                    ]
+
+                    negative_prompt = None
+                    if first_config.negative_prompt is not None:
+                        negative_prompt = [gen_config.negative_prompt or '' for gen_config in batch_configs]
 
                     # todo do we disable text encoder here as well if disabled for model, or only do that for training?
                     if self.is_xl:
                         # fix guidance rescale for sdxl
                         # was trained on 0.7 (I believe)
 
-                        grs = gen_config.guidance_rescale
+                        grs = first_config.guidance_rescale
                         if grs is None or grs < 0.00001:
                             grs = 0.7
 
-                        img = pipeline(
-                            prompt=gen_config.prompt,
-                            prompt_2=gen_config.prompt_2,
-                            negative_prompt=gen_config.negative_prompt,
-                            negative_prompt_2=gen_config.negative_prompt_2,
-                            height=gen_config.height,
-                            width=gen_config.width,
-                            num_inference_steps=gen_config.num_inference_steps,
-                            guidance_scale=gen_config.guidance_scale,
+                        negative_prompt_2 = None
+                        if first_config.negative_prompt_2 is not None:
+                            negative_prompt_2 = [gen_config.negative_prompt_2 or '' for gen_config in batch_configs]
+
+                        images = pipeline(
+                            prompt=[gen_config.prompt for gen_config in batch_configs],
+                            prompt_2=[gen_config.prompt_2 for gen_config in batch_configs],
+                            negative_prompt=negative_prompt,
+                            negative_prompt_2=negative_prompt_2,
+                            height=first_config.height,
+                            width=first_config.width,
+                            num_inference_steps=first_config.num_inference_steps,
+                            guidance_scale=first_config.guidance_scale,
                             guidance_rescale=grs,
-                        ).images[0]
+                            generator=generator,
+                        ).images
                     else:
-                        img = pipeline(
-                            prompt=gen_config.prompt,
-                            negative_prompt=gen_config.negative_prompt,
-                            height=gen_config.height,
-                            width=gen_config.width,
-                            num_inference_steps=gen_config.num_inference_steps,
-                            guidance_scale=gen_config.guidance_scale,
-                        ).images[0]
-
-                    gen_config.save_image(img)
-
-        # clear pipeline and cache to reduce vram usage
-        del pipeline
+                        images = pipeline(
+                            prompt=[gen_config.prompt for gen_config in batch_configs],
+                            negative_prompt=negative_prompt,
+                            height=first_config.height,
+                            width=first_config.width,
+                            num_inference_steps=first_config.num_inference_steps,
+                            guidance_scale=first_config.guidance_scale,
+                            generator=generator,
+                        ).images
+
+                    # the count keeps file names unique when a batch is saved in the same millisecond
+                    for idx, img in zip(batch, images):
+                        image_configs[idx].save_image(img, count=idx, max_count=len(image_configs) - 1)
+                    progress_bar.update(len(batch))
+                progress_bar.close()
+
+        # clear cache to reduce vram usage
         torch.cuda.empty_cache()
 
         # restore training state
@@ -588,10 +763,95 @@ class StableDiffusion:
         return latents
 
     def encode_prompt(self, prompt, num_images_per_prompt=1) -> PromptEmbeds:
-        prompt = prompt
         # if it is not a list, make it one
         if not isinstance(prompt, list):
             prompt = [prompt]
+        if num_images_per_prompt != 1:
+            return self._encode_prompt_list(prompt, num_images_per_prompt)
+
+        # cache only when the text encoder is frozen, otherwise embeddings need grads
+        use_cache = self.prompt_embeds_cache is not None and not torch.is_grad_enabled()
+        use_store = self.prompt_embeds_store is not None and not torch.is_grad_enabled()
+
+        # encode each unique prompt once
+        unique_prompts = list(dict.fromkeys(prompt))
+        embeds_by_prompt = {}
+        prompts_to_encode = []
+        for p in unique_prompts:
+            if use_cache:
+                cached = self.prompt_embeds_cache.get(self._get_prompt_cache_key(p), self._get_text_encoder_device())
+                if cached is not None:
+                    embeds_by_prompt[p] = cached
+                    continue
+            if use_store:
+                stored = self.prompt_embeds_store.get(p)
+                if stored is not None:
+                    stored = stored.to(self._get_text_encoder_device())
+                    if use_cache:
+                        self._add_to_prompt_cache([p], stored)
+                    embeds_by_prompt[p] = stored
+                    continue
+            prompts_to_encode.append(p)
+
+        if len(prompts_to_encode) > 0:
+            # one padded forward for the whole batch
+            encoded = self._encode_prompt_list(prompts_to_encode)
+            if use_store:
+                self._add_to_prompt_store(prompts_to_encode, encoded)
+            if len(prompts_to_encode) == len(prompt):
+                # nothing duplicated or cached, return as is
+                if use_cache:
+                    self._add_to_prompt_cache(prompts_to_encode, encoded)
+                return encoded
+            for i, p in enumerate(prompts_to_encode):
+                embeds_by_prompt[p] = PromptEmbeds([
+                    encoded.text_embeds[i:i + 1],
+                    encoded.pooled_embeds[i:i + 1] if encoded.pooled_embeds is not None else None
+                ])
+            if use_cache:
+                self._add_to_prompt_cache(prompts_to_encode, encoded)
+
+        # rebuild the batch in the original order
+        text_embeds = torch.cat([embeds_by_prompt[p].text_embeds for p in prompt], dim=0)
+        pooled_embeds = None
+        if embeds_by_prompt[prompt[0]].pooled_embeds is not None:
+            pooled_embeds = torch.cat([embeds_by_prompt[p].pooled_embeds for p in prompt], dim=0)
+        return PromptEmbeds([text_embeds, pooled_embeds])
+
+    def _get_text_encoder_device(self):
+        if isinstance(self.text_encoder, list):
+            return self.text_encoder[0].device
+        return self.text_encoder.device
+
+    def _get_prompt_cache_key(self, prompt: str):
+        if isinstance(self.text_encoder, list):
+            encoder_ids = tuple([id(te) for te in self.text_encoder])
+        else:
+            encoder_ids = (id(self.text_encoder),)
+        return prompt, encoder_ids, self.use_text_encoder_1, self.use_text_encoder_2
+
+    def _add_to_prompt_cache(self, prompt_list: List[str], prompt_embeds: PromptEmbeds):
+        for i, p in enumerate(prompt_list):
+            self.prompt_embeds_cache.set(
+                self._get_prompt_cache_key(p),
+                PromptEmbeds([
+                    prompt_embeds.text_embeds[i:i + 1].detach().clone(),
+                    prompt_embeds.pooled_embeds[i:i + 1].detach().clone()
+                    if prompt_embeds.pooled_embeds is not None else None
+                ])
+            )
+
+    def _add_to_prompt_store(self, prompt_list: List[str], prompt_embeds: PromptEmbeds):
+        for i, p in enumerate(prompt_list):
+            self.prompt_embeds_store.add(
+                p,
+                PromptEmbeds([
+                    prompt_embeds.text_embeds[i:i + 1],
+                    prompt_embeds.pooled_embeds[i:i + 1] if prompt_embeds.pooled_embeds is not None else None
+                ])
+            )
+
+    def _encode_prompt_list(self, prompt: List[str], num_images_per_prompt=1) -> PromptEmbeds:
         if self.is_xl:
             return PromptEmbeds(
                 train_tools.encode_prompts_xl(
@@ -622,7 +882,34 @@ class StableDiffusion:
         if dtype is None:
             dtype = self.torch_dtype
 
-        latent_list = []
+        images = self._prepare_images_for_vae(image_list)
+        latents = self.vae.encode(images).latent_dist.sample()
+        latents = latents * self.vae.config['scaling_factor']
+        latents = latents.to(device, dtype=dtype)
+
+        return latents
+
+    @torch.no_grad()
+    def encode_images_to_latent_dist(
+            self,
+            image_list: List[torch.Tensor],
+            device=None,
+            dtype=None
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        # returns the unscaled mean and std of the latent distribution so it can be cached and sampled later
+        if device is None:
+            device = self.device
+        if dtype is None:
+            dtype = self.torch_dtype
+
+        images = self._prepare_images_for_vae(image_list)
+        latent_dist = self.vae.encode(images).latent_dist
+        mean = latent_dist.mean.to(device, dtype=dtype)
+        std = latent_dist.std.to(device, dtype=dtype)
+
+        return mean, std
+
+    def _prepare_images_for_vae(self, image_list: List[torch.Tensor]) -> torch.Tensor:
         # Move to vae to device if on cpu
         if self.vae.device == 'cpu':
             self.vae.to(self.device)
@@ -639,11 +926,7 @@ class StableDiffusion:
 
         images = torch.stack(image_list)
         flush()
-        latents = self.vae.encode(images).latent_dist.sample()
-        latents = latents * self.vae.config['scaling_factor']
-        latents = latents.to(device, dtype=dtype)
-
-        return latents
+        return images
 
     def decode_latents(
             self,
@@ -764,16 +1047,19 @@ class StableDiffusion:
                 state_dict[new_key] = v
         return state_dict
 
-    def save(self, output_file: str, meta: OrderedDict, save_dtype=get_torch_dtype('fp16'), logit_scale=None):
+    def get_version_string(self):
         version_string = '1'
         if self.is_v2:
             version_string = '2'
         if self.is_xl:
             version_string = 'sdxl'
+        return version_string
+
+    def save(self, output_file: str, meta: OrderedDict, save_dtype=get_torch_dtype('fp16'), logit_scale=None):
         save_ldm_model_from_diffusers(
             sd=self,
             output_file=output_file,
             meta=meta,
             save_dtype=save_dtype,
-            sd_version=version_string,
+            sd_version=self.get_version_string(),
         )
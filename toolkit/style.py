@@ -1,7 +1,6 @@
 from torch import nn
 import torch.nn.functional as F
 import torch
-from torchvision import models
 
 
 # device = 'cuda' if torch.cuda.is_available() else 'cpu'
@@ -31,18 +30,8 @@ class ContentLoss(nn.Module):
 
         content_size = tensor_size(pred_layer)
 
-        # Define the separate loss function
-        def separated_loss(y_pred, y_true):
-            diff = torch.abs(y_pred - y_true)
-            l2 = torch.sum(diff ** 2, dim=[1, 2, 3], keepdim=True) / 2.0
-            return 2. * l2 / content_size
-
-        # Calculate itemized loss
-        pred_itemized_loss = separated_loss(pred_layer, target_layer)
-
-        # Calculate the mean of itemized loss
-        loss = torch.mean(pred_itemized_loss, dim=(1, 2, 3), keepdim=True)
-        self.loss = loss
+        # squared error per item, (batch, 1, 1, 1)
+        self.loss = torch.sum((pred_layer - target_layer) ** 2, dim=[1, 2, 3], keepdim=True) / content_size
 
         return stacked_input
 
@@ -149,6 +138,7 @@ def get_style_model_and_losses(
 ):
     # content_layers = ['conv_4']
     # style_layers = ['conv_1', 'conv_2', 'conv_3', 'conv_4', 'conv_5']
+    from torchvision import models
     content_layers = ['conv4_2']
     style_layers = ['conv2_1', 'conv3_1', 'conv4_1']
     cnn = models.vgg19(pretrained=True).features.to(device, dtype=dtype).eval()
@@ -6,6 +6,7 @@ import time
 from typing import TYPE_CHECKING, Union
 import sys
 from toolkit.paths import SD_SCRIPTS_ROOT
+from toolkit.loss_weighting import get_snr_table, timesteps_to_index
 
 sys.path.append(SD_SCRIPTS_ROOT)
 
@@ -589,18 +590,8 @@ def add_all_snr_to_noise_scheduler(noise_scheduler, device):
 
 
 def get_all_snr(noise_scheduler, device):
-    if hasattr(noise_scheduler, "all_snr"):
-        return noise_scheduler.all_snr.to(device)
-    # compute it
-    with torch.no_grad():
-        alphas_cumprod = noise_scheduler.alphas_cumprod
-        sqrt_alphas_cumprod = torch.sqrt(alphas_cumprod)
-        sqrt_one_minus_alphas_cumprod = torch.sqrt(1.0 - alphas_cumprod)
-        alpha = sqrt_alphas_cumprod
-        sigma = sqrt_one_minus_alphas_cumprod
-        all_snr = (alpha / sigma) ** 2
-        all_snr.requires_grad = False
-    return all_snr.to(device)
+    # cached on the scheduler per device
+    return get_snr_table(noise_scheduler, device)
 
 
 def apply_snr_weight(
@@ -612,8 +603,7 @@ def apply_snr_weight(
     # will get it form noise scheduler if exist or will calculate it if not
     all_snr = get_all_snr(noise_scheduler, loss.device)
 
-    snr = torch.stack([all_snr[t] for t in timesteps])
-    gamma_over_snr = torch.div(torch.ones_like(snr) * gamma, snr)
-    snr_weight = torch.minimum(gamma_over_snr, torch.ones_like(gamma_over_snr)).float().to(loss.device)  # from paper
+    snr = all_snr[timesteps_to_index(timesteps, loss.device)]
+    snr_weight = torch.clamp(gamma / snr, max=1.0).float()  # from paper
     loss = loss * snr_weight
     return loss
@@ -0,0 +1,132 @@
+import json
+import os
+from typing import Callable, List, Optional
+
+import torch
+from safetensors import safe_open
+from safetensors.torch import save_file
+from tqdm import tqdm
+
+from toolkit.config_modules import TrajectoryBankConfig
+
+# (pair_idx, seed, denoising steps) -> latents after each of the steps
+GenerateTrajectoryFn = Callable[[int, int, List[int]], List[torch.Tensor]]
+
+
+class Trajectory:
+    def __init__(
+            self,
+            pair_idx: int,
+            seed: int,
+            timesteps_to: List[int],
+            network_version: int,
+            latents: Optional[List[torch.Tensor]] = None,
+            path: Optional[str] = None,
+    ):
+        self.pair_idx = pair_idx
+        self.seed = seed
+        self.timesteps_to = timesteps_to
+        # training step the network was at when the latents were generated
+        self.network_version = network_version
+        self.latents = latents
+        self.path = path
+
+    def get_latents(self, idx: int) -> torch.Tensor:
+        if self.latents is not None:
+            return self.latents[idx]
+        with safe_open(self.path, framework="pt", device="cpu") as f:
+            return f.get_tensor(f"latents_{idx}")
+
+
+class TrajectoryEntry:
+    def __init__(self, trajectory: Trajectory, idx: int):
+        self.pair_idx = trajectory.pair_idx
+        self.seed = trajectory.seed
+        self.network_version = trajectory.network_version
+        self.timesteps_to = trajectory.timesteps_to[idx]
+        self.latents = trajectory.get_latents(idx)
+
+
+class DenoisingTrajectoryBank:
+    """
+    Partly denoised latents kept between slider steps, so a step can start from latents denoised
+    with a slightly older network instead of denoising from noise. Each trajectory is denoised once
+    from seeded noise and its latents are saved at a few denoising steps along the way. Trajectories
+    older than max_age steps are regenerated a few at a time on the refresh schedule.
+    """
+
+    def __init__(
+            self,
+            config: TrajectoryBankConfig,
+            generate_fn: GenerateTrajectoryFn,
+            num_pairs: int,
+            max_denoising_steps: int,
+    ):
+        self.config = config
+        self.generate_fn = generate_fn
+        self.num_pairs = num_pairs
+        self.max_denoising_steps = max_denoising_steps
+        self.trajectories: List[Optional[Trajectory]] = [None] * config.size
+        self.pin_memory = torch.cuda.is_available()
+        if config.cache_dir is not None:
+            os.makedirs(config.cache_dir, exist_ok=True)
+
+    def _get_timesteps_to(self) -> List[int]:
+        # distinct steps in [1, max_denoising_steps), like the random steps of a normal slider step
+        num_steps = min(self.config.timesteps_per_trajectory, self.max_denoising_steps - 1)
+        steps = torch.randperm(self.max_denoising_steps - 1)[:num_steps] + 1
+        return sorted(steps.tolist())
+
+    @torch.no_grad()
+    def _generate(self, slot: int, network_version: int):
+        pair_idx = torch.randint(0, self.num_pairs, (1,)).item()
+        seed = torch.randint(0, 2 ** 31 - 1, (1,)).item()
+        timesteps_to = self._get_timesteps_to()
+        latents_list = self.generate_fn(pair_idx, seed, timesteps_to)
+        latents_list = [latents.detach().to('cpu') for latents in latents_list]
+
+        if self.config.cache_dir is not None:
+            path = os.path.join(self.config.cache_dir, f"trajectory_{slot}.safetensors")
+            metadata = {
+                'pair_idx': str(pair_idx),
+                'seed': str(seed),
+                'timesteps_to': json.dumps(timesteps_to),
+                'network_version': str(network_version),
+            }
+            tmp_path = path + '.tmp'
+            save_file(
+                {f"latents_{i}": latents.contiguous() for i, latents in enumerate(latents_list)}, tmp_path, metadata
+            )
+            os.replace(tmp_path, path)
+            trajectory = Trajectory(pair_idx, seed, timesteps_to, network_version, path=path)
+        else:
+            if self.pin_memory:
+                latents_list = [latents.pin_memory() for latents in latents_list]
+            trajectory = Trajectory(pair_idx, seed, timesteps_to, network_version, latents=latents_list)
+        self.trajectories[slot] = trajectory
+
+    def fill(self, network_version: int):
+        # the pre pass, generates every trajectory that is missing
+        empty_slots = [i for i, trajectory in enumerate(self.trajectories) if trajectory is None]
+        for slot in tqdm(empty_slots, desc="Generating trajectories", leave=False):
+            self._generate(slot, network_version)
+
+    def refresh(self, network_version: int):
+        if any([trajectory is None for trajectory in self.trajectories]):
+            self.fill(network_version)
+            return
+        if self.config.max_age <= 0 or network_version % max(1, self.config.refresh_every) != 0:
+            return
+        stale_slots = [
+            i for i, trajectory in enumerate(self.trajectories)
+            if network_version - trajectory.network_version >= self.config.max_age
+        ]
+        # oldest first
+        stale_slots.sort(key=lambda i: self.trajectories[i].network_version)
+        for slot in stale_slots[:self.config.refresh_count]:
+            self._generate(slot, network_version)
+
+    def sample(self) -> TrajectoryEntry:
+        trajectory = self.trajectories[torch.randint(0, len(self.trajectories), (1,)).item()]
+        idx = torch.randint(0, len(trajectory.timesteps_to), (1,)).item()
+        return TrajectoryEntry(trajectory, idx)